@@ -71,6 +71,21 @@ CREATE TABLE IF NOT EXISTS logs (
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Table phase_timings : durée de chaque phase d'un tour (partition, téléchargements, exécution, upload, agrégation...)
+-- hub_name est NULL pour les phases du serveur
+CREATE TABLE IF NOT EXISTS phase_timings (
+    timing_id SERIAL PRIMARY KEY,
+    job_id INT NOT NULL REFERENCES jobs(jobs_id) ON DELETE CASCADE,
+    turn INT NOT NULL,
+    hub_name VARCHAR(255),
+    phase VARCHAR(50) NOT NULL,
+    start_time TIMESTAMP NOT NULL,
+    end_time TIMESTAMP NOT NULL,
+    duration DOUBLE PRECISION NOT NULL,
+    bytes BIGINT
+);
+CREATE INDEX IF NOT EXISTS idx_phase_timings_job_turn ON phase_timings (job_id, turn);
+
 -- ************************************************************
 -- Partie 3 : Données temps réel (devices, measurements)
 -- ************************************************************
@@ -2,14 +2,18 @@
 # ║                Modules               ║
 # ╚══════════════════════════════════════╝
 import base64
+import hashlib
 import os
 from pathlib import Path
 import shutil
 from paho.mqtt import client as mqtt_client
 import re, uuid, random,time
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from urllib.request import urlretrieve
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import requests
+import protocol
 # ╔══════════════════════════════════════╗
 # ║             Présentation             ║
 # ╚══════════════════════════════════════╝
@@ -38,6 +42,9 @@ topicConnexion=""
 topicCommande = ""
 topicLog = ""
 topicMetric = ""
+# Retained topics of presence : the one of the server, and the one of this hub
+topicServerPresence = "presence/server"
+topicPresence = ""
 
 global client
 
@@ -45,6 +52,16 @@ connexion_handled = False
 
 last_hb_server=0
 global server_alive
+server_alive=False
+
+# Keepalive of the MQTT connexion : if the hub stays silent 1.5 times longer, the broker publishes his Last Will
+mqtt_keepalive = int(os.getenv("MQTT_KEEPALIVE", "15"))
+# The liveness is handled by the broker (Last Will & keepalive), the heartbeats of the application are optional
+app_heartbeats = os.getenv("APP_HEARTBEATS", "0") == "1"
+# MAC Address of the hub, client_id being replaced by his name once connected
+mac_address = ""
+# Version of the protocol given by the server when he accepted the connexion (0 : legacy text only, see protocol.py)
+server_proto = 0
 
 global part_number
 global weight_path
@@ -54,7 +71,17 @@ model_already_downloaded=False
 
 API_HOST = os.getenv("API_HOST")
 API_PORT = os.getenv("API_PORT")
+# Job in progress (given with the dataset & the weight), used to upload the result weight
+current_job = None
+# Size of the chunks of the upload of the result weight, and number of retries before sending it in the message (base64)
+artifact_chunk_size = int(os.getenv("ARTIFACT_CHUNK_SIZE", str(4 * 1024 * 1024)))
+artifact_retries = int(os.getenv("ARTIFACT_RETRIES", "5"))
 GLOBAL_PATH = Path("/") / "app" / "FL_hub"
+# sha256 of the files staged for the turn (see Staging the turn) : "dataset", "model", "weight" -> sha256
+staged_hashes = {}
+# Parts of the next turn downloaded in advance (see Prefetching the dataset) : (job, id, part_number, key) -> (path, thread)
+prefetched_parts = {}
+prefetch_lock = Lock()
 
 global current_thread
 # ╔══════════════════════════════════════╗
@@ -74,6 +101,10 @@ def construct_message(receiver_id,instructions,details=""):
         receiver_id=str(0)
     return "["+client_id+"] ["+receiver_id+"] ["+instructions+"] ["+details+"]"
 
+# Message for the server, with typed fields : binary if the server gave the version of the protocol, else legacy text
+def server_message(instructions,fields=None):
+    return protocol.encode(client_id,"0",instructions,fields,binary=server_proto>=protocol.VERSION)
+
 # ╔══════════════════════════════════════╗
 # ║    1. Handling the MQTT Connection   ║
 # ╚══════════════════════════════════════╝
@@ -102,16 +133,20 @@ def connect_mqtt():
 # - Else, wait 30 seconds and try reconnecting
 # [------------------------------------------------------]
 def launch_mqtt_connexion():
-    global client_id,topicConnexion, client
-    client_id=os.getenv("MAC_ADDRESS")
+    global client_id,topicConnexion,topicPresence,mac_address,client
+    mac_address=os.getenv("MAC_ADDRESS")
+    client_id=mac_address
     topicConnexion="connexion/"+client_id
+    topicPresence="presence/"+client_id
     client = connect_mqtt()
+    # If the connexion is lost, the broker tells the server on our connexion topic
+    client.will_set(topicConnexion,construct_message("0","OFFLINE"),qos=1)
     while True:
         try:
             if not client.is_connected():
-                client_id=os.getenv("MAC_ADDRESS")
+                client_id=mac_address
                 print("[INFO] Attempting to connect to broker...")
-                client.connect(broker, port)
+                client.connect(broker, port, keepalive=mqtt_keepalive)
                 ask_connexion()
                 client.loop_forever()
         except Exception as e:
@@ -123,6 +158,7 @@ def on_connect(client, userdata, flags, rc):
     """Callback exécuté lors de la connexion au broker MQTT"""
     if rc == 0:
         client.subscribe(topicConnexion)
+        client.subscribe(topicServerPresence)
         print(f"[INFO] Connected to MQTT Broker")
     else:
         print(f"[ERROR] Failed to connect, return code {rc}")
@@ -156,7 +192,8 @@ def final_subscribe():
 def ask_connexion():
         stat = shutil.disk_usage("/")
         free=str((int(str(stat).split("free=")[1].split(")")[0])/10**9)+2)
-        msg=construct_message("0","Asking for connexion","CAPACITY:"+free+"GO")
+        # The request is always sent with the MAC Address, even if we already got a name, and with our version of the protocol
+        msg="["+mac_address+"] [0] [Asking for connexion] [CAPACITY:"+free+"GO|proto:"+str(protocol.VERSION)+"|stage:1]"
         client.publish(topicConnexion,msg)
         Thread(target=is_connexion_handled).start()
         
@@ -180,20 +217,25 @@ def is_connexion_handled():
 # 2. If he isn't, he disconnect himself
 # [------------------------------------------------------]
 def received_connexion_message(payload_data):
-        global connexion_handled
+        global connexion_handled, server_proto
         if "NAME:" in payload_data[2]:
             connexion_handled=True
+            # An old server doesn't give his version : we keep sending legacy text
+            server_proto=int(payload_data.get("proto") or 0)
             global client_id
             # On split sur 'NAME:' pour récupérer le nom
             mac = payload_data[1]
             name = payload_data[2].split(":", 1)[1]
-            if mac.lower() == client_id.lower():  # compare MAC
+            if mac.lower() == mac_address.lower():  # compare MAC
                 client_id = name.strip()
                 print(f"[INFO] Received client name:{client_id}.")
                 global server_alive
+                already_alive=server_alive
                 server_alive=True
                 final_subscribe()
-                start_heartbeat()
+                client.publish(topicPresence,construct_message("0","ONLINE"),qos=1,retain=True)
+                if app_heartbeats and not already_alive:
+                    start_heartbeat()
             else:
                 print(f"[WARNING] MAC mismatch: {mac}")
         elif "NOT REGISTERED IN THE DATABASE" in payload_data[2]:
@@ -205,6 +247,8 @@ def received_connexion_message(payload_data):
 # ╚══════════════════════════════════════╝
 
 
+# The heartbeats are only used if APP_HEARTBEATS=1, otherwise the liveness comes from the presence of the server
+
 #SENDING A HEARTBEAT MESSAGE EVERY 30 SECONDS
 def sending_heartbeat():
     t=Thread(target=heartbeat_thread)
@@ -258,11 +302,27 @@ def check_heartbeat_thread():
                 break
         else:
             # si la boucle se termine sans break → aucun heartbeat reçu
-            print("[ERROR] Server Dead. Relaunching a connexion.")
-            server_alive=False
-            client.publish(topicConnexion,construct_message(client_id,"DISCONNECT"))
+            server_dead()
             return
 
+# ────────────────[The server is dead]───────────────
+def server_dead():
+    global server_alive
+    print("[ERROR] Server Dead. Relaunching a connexion.")
+    server_alive=False
+    client.publish(topicConnexion,construct_message(client_id,"DISCONNECT"))
+
+# ────────────────[Received the presence of the server]───────────────
+# [------------------------------------------------------]
+# 1. OFFLINE : the broker published the Last Will of the server, we relaunch a connexion
+# 2. ONLINE : if we already had a name, the server restarted and forgot us, so we ask a connexion again
+# [------------------------------------------------------]
+def received_server_presence(payload_data):
+    if payload_data[2]=="OFFLINE" and server_alive:
+        server_dead()
+    elif payload_data[2]=="ONLINE" and connexion_handled and server_alive:
+        ask_connexion()
+
 def start_heartbeat():
     sending_heartbeat()
     check_heartbeat()
@@ -272,12 +332,21 @@ def start_heartbeat():
 # ╚══════════════════════════════════════╝
 
 def on_message(client,userdata,message):
-    payload_data = re.findall(r"\[(.*?)\]",str(message.payload.decode("utf-8")))
+    # The message is decoded once, binary or legacy text (see protocol.py)
+    try:
+        payload_data = protocol.decode(message.payload)
+    except protocol.ProtocolError as e:
+        print("[WARNING] Message not recognized : "+str(e))
+        return
+    if payload_data is None:
+        return
     topic = message.topic
     if payload_data[0]!=client_id:
-        print("[RECEIVED]"+message.payload.decode("utf-8"))
+        print("[RECEIVED]"+str(payload_data))
         if topic==topicConnexion:
             received_connexion_message(payload_data)
+        elif topic==topicServerPresence:
+            received_server_presence(payload_data)
         elif topic==topicCommande:
             received_command_message(payload_data)
         elif topic==topicLog and payload_data[2]=="HEARTBEAT":
@@ -287,7 +356,7 @@ def on_message(client,userdata,message):
             client.disconnect()
 
 def received_command_message(payload_data):
-    global model_already_downloaded
+    global model_already_downloaded, current_job
     if payload_data[2]=="DOWNLOAD DATASETS":
         download_dataset(payload_data)
     elif payload_data[2]=="DOWNLOAD MODELS":
@@ -296,8 +365,15 @@ def received_command_message(payload_data):
         download_weight(payload_data)
     elif payload_data[2]=="LAUNCH THE MODEL":
         execution_model(payload_data)
+    elif payload_data[2]=="PREFETCH DATASETS":
+        prefetch_dataset(payload_data)
+    elif payload_data[2]=="STAGE JOB":
+        stage_job(payload_data)
     elif payload_data[2]=="END OF THE START PROGRAM":
         model_already_downloaded=False
+        current_job=None
+        staged_hashes.clear()
+        clear_prefetched_parts()
 
 # ╔══════════════════════════════════════╗
 # ║        5. Receiving the dataset      ║
@@ -308,18 +384,101 @@ def download_dataset(payload_data):
     current_thread=Thread(target=download_dataset_thread,args=(payload_data,)).start()
 
 def download_dataset_thread(payload_data):
-        global dataset_path, part_number, current_thread
+        global dataset_path, part_number, current_thread, current_job
         #D'abord on supprime les dossiers Dataset et Model   
-        part_number=payload_data[3].split("|")[1].split("part_number:")[1]
-        id=payload_data[3].split("|")[0].split("id:")[1]
-        name=payload_data[3].split("name:")[1]
-        print(str(f"http://{API_HOST}:{API_PORT}/dataset/"+str(id)+"/"+str(part_number)))
+        part_number=str(payload_data.get("part_number"))
+        id=payload_data.get("id")
+        name=payload_data.get("name")
         url=f"http://{API_HOST}:{API_PORT}/dataset/"+str(id)+"/"+str(part_number)
+        # Les parts sont propres au job en cours
+        job=payload_data.get("job")
+        if job is not None:
+            url+="?job="+str(job)
+            current_job=str(job)
+        print(url)
         dataset_path=Path(str(GLOBAL_PATH) + "/Dataset/"+name).expanduser()
         dataset_path.parent.mkdir(parents=True,exist_ok=True)
-        t=urlretrieve(url,dataset_path)
-        client.publish(topicCommande,construct_message("0","DATASET DOWNLOADED"))
+        # >>> The file staged is replaced : its sha256 isn't the one of the last STAGE JOB anymore
+        staged_hashes.pop("dataset",None)
+        if take_prefetched_part(payload_data,dataset_path):
+            print("[INFO] Part "+part_number+" already downloaded in advance.")
+        else:
+            t=urlretrieve(url,dataset_path)
+        client.publish(topicCommande,server_message("DATASET DOWNLOADED"))
         current_thread=None
+
+# ────────────────[Prefetching the dataset]───────────────
+# [------------------------------------------------------]
+# 1. While we work on a turn, the server tells us the part we should get at the next one (PREFETCH DATASETS),
+#    already made in his partition cache : it is downloaded in the background, in Prefetch/<key>
+# 2. When the part is then sent (DOWNLOAD DATASETS with the same job, dataset, part & key), the file is moved instead of downloaded
+#    (if the download is still in progress, we wait for it)
+# 3. Only the parts of the last partition announced are kept, and they are all deleted at the end of the job
+# 4. A part that isn't used (partition replaced, or file already staged with the same sha256) is deleted once downloaded
+# [------------------------------------------------------]
+def prefetched_entry(payload_data):
+    return (str(payload_data.get("job")),str(payload_data.get("id")),str(payload_data.get("part_number")),payload_data.get("key"))
+
+def prefetch_dataset(payload_data):
+    entry=prefetched_entry(payload_data)
+    key=entry[3]
+    if key is None or not re.fullmatch(r"[0-9a-f]{64}",key):
+        return
+    with prefetch_lock:
+        if entry in prefetched_parts:
+            return
+        for old in [old for old in prefetched_parts if old[3]!=key]:
+            discard_prefetched(prefetched_parts.pop(old))
+        path=GLOBAL_PATH / "Prefetch" / key / (entry[2]+"-"+payload_data.get("name"))
+        thread=Thread(target=prefetch_dataset_thread,args=(entry,path),daemon=True)
+        prefetched_parts[entry]=(path,thread)
+        thread.start()
+
+def prefetch_dataset_thread(entry,path):
+    job,id,part_number,key=entry
+    url=f"http://{API_HOST}:{API_PORT}/dataset/{id}/{part_number}?key={key}"
+    temporary_path=path.with_name(path.name+".tmp")
+    try:
+        path.parent.mkdir(parents=True,exist_ok=True)
+        urlretrieve(url,temporary_path)
+        os.replace(temporary_path,path)
+    except Exception as e:
+        print("[WARNING] The part "+part_number+" couldn't be downloaded in advance : "+str(e))
+        temporary_path.unlink(missing_ok=True)
+
+def take_prefetched_part(payload_data,dataset_path):
+    entry=prefetched_entry(payload_data)
+    if entry[3] is None:
+        return False
+    with prefetch_lock:
+        prefetched=prefetched_parts.pop(entry,None)
+    if prefetched is None:
+        return False
+    path,thread=prefetched
+    thread.join()
+    if not path.exists():
+        return False
+    os.replace(path,dataset_path)
+    return True
+
+# The download may still be in progress : the file is deleted when it is over
+def discard_prefetched(prefetched):
+    path,thread=prefetched
+    def remove():
+        thread.join()
+        path.unlink(missing_ok=True)
+    Thread(target=remove,daemon=True).start()
+
+def discard_prefetched_part(payload_data):
+    with prefetch_lock:
+        prefetched=prefetched_parts.pop(prefetched_entry(payload_data),None)
+    if prefetched is not None:
+        discard_prefetched(prefetched)
+
+def clear_prefetched_parts():
+    with prefetch_lock:
+        prefetched_parts.clear()
+    shutil.rmtree(GLOBAL_PATH / "Prefetch",ignore_errors=True)
  
 # ╔══════════════════════════════════════╗
 # ║         6. Receiving the model       ║
@@ -334,13 +493,14 @@ def download_model_thread(payload_data):
             model_already_downloaded=True
             print("[#### DOWNLOADING MODEL ####]")
             global model_path
-            id=payload_data[3].split("|")[0].split("id:")[1]
-            name=payload_data[3].split("name:")[1]
+            id=payload_data.get("id")
+            name=payload_data.get("name")
             url=f"http://{API_HOST}:{API_PORT}/model/"+str(id)
             model_path=Path(str(GLOBAL_PATH) + "/Model/"+name).expanduser()
             model_path.parent.mkdir(parents=True,exist_ok=True)
+            staged_hashes.pop("model",None)
             t=urlretrieve(url,model_path)
-        client.publish(topicCommande,construct_message("0","MODEL DOWNLOADED"))
+        client.publish(topicCommande,server_message("MODEL DOWNLOADED"))
         current_thread=None
 
 # ╔══════════════════════════════════════╗
@@ -353,7 +513,7 @@ def execution_model(payload_data):
 
 def execution_model_thread(payload_data):
     global weight_path, modeOfExecution, current_thread
-    modeOfExecution=payload_data[3].split("Mode:")[1]
+    modeOfExecution=payload_data.get("Mode")
     if modeOfExecution=="FL":
         p = subprocess.Popen(
             ["python3", "-u",str(model_path),
@@ -390,14 +550,14 @@ def execution_model_thread(payload_data):
     else:
         sending_log_to_server("Work finished. Waiting for another one.")
         if modeOfExecution=="FL":
-            client.publish(topicCommande,construct_message(0,"WAITING FOR WORK","name:"+("dataset"+str(part_number)+".pth")+"|inside:"+encode_file_to_base64(GLOBAL_PATH  / "Result" / ("dataset"+str(part_number)+".pth"))))
+            client.publish(topicCommande,server_message("WAITING FOR WORK",result_weight_message(GLOBAL_PATH  / "Result" / ("dataset"+str(part_number)+".pth"))))
         else:
-            client.publish(topicCommande,construct_message(0,"WAITING FOR WORK"))
+            client.publish(topicCommande,server_message("WAITING FOR WORK"))
     current_thread=None
 
 def sending_log_to_server(message):
     print("[Script:"+message+"]")
-    client.publish(topicLog,construct_message("0",message))
+    client.publish(topicLog,server_message(message))
     
 # ╔══════════════════════════════════════╗
 # ║         8. Receiving the weight      ║
@@ -405,19 +565,171 @@ def sending_log_to_server(message):
 
 
 def download_weight(payload_data):
-        global current_thread
+        global current_thread, current_job
         url=f"http://{API_HOST}:{API_PORT}/weight"
+        # Chaque job a sa propre weight
+        job=payload_data.get("job")
+        if job is not None:
+            url+="/"+str(job)
+            current_job=str(job)
         global weight_path
         weight_path=Path(str(GLOBAL_PATH) + "/Weight/client_weight.pth").expanduser()
         print(str(weight_path) + "ici")
         weight_path.parent.mkdir(parents=True,exist_ok=True)
+        staged_hashes.pop("weight",None)
         t=urlretrieve(url,weight_path)
-        client.publish(topicCommande,construct_message("0","WEIGHT DOWNLOADED"))
+        client.publish(topicCommande,server_message("WEIGHT DOWNLOADED"))
+
+# ╔══════════════════════════════════════╗
+# ║        8bis. Staging the turn        ║
+# ╚══════════════════════════════════════╝
+# ────────────────[Received the manifest of the turn]───────────────
+# [------------------------------------------------------]
+# 1. STAGE JOB gives everything the turn needs : the part of the dataset, the model & the weight (FL), each with its sha256
+# 2. They are fetched at the same time. A file we already have (same sha256 as the last one staged) isn't downloaded again,
+#    and a part downloaded in advance is used (see Prefetching the dataset)
+# 3. Each file is checked against its sha256, and downloaded again if it doesn't match
+# 4. A single READY is sent when everything is there
+# [------------------------------------------------------]
+def stage_job(payload_data):
+    global current_thread
+    current_thread=Thread(target=stage_job_thread,args=(payload_data,)).start()
+
+def stage_job_thread(payload_data):
+    global dataset_path, model_path, weight_path, part_number, current_job, model_already_downloaded, current_thread
+    job=str(payload_data.get("job"))
+    current_job=job
+    part_number=str(payload_data.get("part_number"))
+    dataset_path=Path(str(GLOBAL_PATH) + "/Dataset/"+payload_data.get("dataset_name")).expanduser()
+    model_path=Path(str(GLOBAL_PATH) + "/Model/"+payload_data.get("model_name")).expanduser()
+    weight_path=Path(str(GLOBAL_PATH) + "/Weight/client_weight.pth").expanduser()
+    fetches=[
+        ("dataset",f"http://{API_HOST}:{API_PORT}/dataset/{payload_data.get('dataset')}/{part_number}?job={job}",dataset_path,payload_data.get("dataset_sha256")),
+        ("model",f"http://{API_HOST}:{API_PORT}/model/{payload_data.get('model')}",model_path,payload_data.get("model_sha256")),
+    ]
+    if payload_data.get("weight_sha256") is not None:
+        fetches.append(("weight",f"http://{API_HOST}:{API_PORT}/weight/{job}",weight_path,payload_data.get("weight_sha256")))
+    prefetched={"job":job,"id":payload_data.get("dataset"),"part_number":part_number,"key":payload_data.get("key")}
+    with ThreadPoolExecutor(max_workers=len(fetches)) as executor:
+        results=list(executor.map(lambda fetch: timed_fetch(*fetch,prefetched if fetch[0]=="dataset" else None),fetches))
+    errors=[(fetch[0],result[0]) for fetch,result in zip(fetches,results) if result[0] is not None]
+    if errors:
+        # >>> No READY : the barrier of the server handles us at its deadline
+        for kind,error in errors:
+            sending_log_to_server("[ERROR] The "+kind+" of the turn couldn't be fetched : "+error)
+    else:
+        model_already_downloaded=True
+        # >>> The time & the bytes of each fetch are given to the server (see Phase timings & metrics of the server)
+        fields={}
+        for fetch,(_,seconds,size) in zip(fetches,results):
+            fields[fetch[0]+"_secs"]=round(seconds,3)
+            fields[fetch[0]+"_bytes"]=size
+        client.publish(topicCommande,server_message("READY",fields))
+    current_thread=None
+
+# ────────────────[Fetching a file of the turn]───────────────
+# Return (None, bytes downloaded) if the file is there with the right sha256, else (the error, bytes downloaded)
+def fetch_staged_file(kind,url,file_path,sha256,prefetched=None):
+    if sha256 is not None and staged_hashes.get(kind)==sha256 and file_path.exists():
+        if prefetched is not None:
+            discard_prefetched_part(prefetched)
+        return None,0
+    file_path.parent.mkdir(parents=True,exist_ok=True)
+    error=None
+    downloaded=0
+    for attempt in range(artifact_retries):
+        try:
+            if attempt>0 or prefetched is None or not take_prefetched_part(prefetched,file_path):
+                temporary_path=file_path.with_name(file_path.name+".tmp")
+                urlretrieve(url,temporary_path)
+                downloaded+=temporary_path.stat().st_size
+                os.replace(temporary_path,file_path)
+            if sha256 is None or file_sha256(file_path)==sha256:
+                staged_hashes[kind]=sha256
+                return None,downloaded
+            error="sha256 mismatch"
+        except Exception as e:
+            error=str(e)
+        staged_hashes.pop(kind,None)
+        time.sleep(min(2**attempt,30))
+    return error,downloaded
+
+# Return (error, seconds, bytes downloaded)
+def timed_fetch(kind,url,file_path,sha256,prefetched=None):
+    start=time.monotonic()
+    error,downloaded=fetch_staged_file(kind,url,file_path,sha256,prefetched)
+    return error,time.monotonic()-start,downloaded
 
 # ╔══════════════════════════════════════╗
 # ║     9. Sending the result weight     ║
 # ╚══════════════════════════════════════╝
 
+# ────────────────[Fields of the WAITING FOR WORK message]───────────────
+# [------------------------------------------------------]
+# 1. The weight is uploaded to the API (see Uploading the weight), the message only carries its name, sha256 & size
+# 2. If the upload isn't possible (no job, API unreachable), the weight is sent inside the message :
+#    in bytes if the server knows the binary protocol, else in base64, as before
+# [------------------------------------------------------]
+def result_weight_message(file_path):
+    name=Path(file_path).name
+    if current_job:
+        try:
+            start=time.monotonic()
+            sha256,size=upload_artifact(file_path,current_job,name)
+            return {"name":name,"sha256":sha256,"size":size,"upload_secs":round(time.monotonic()-start,3)}
+        except Exception as e:
+            sending_log_to_server("[WARNING] Upload of the weight failed, sending it in the message. Exception : "+str(e))
+    if server_proto>=protocol.VERSION:
+        with open(file_path,"rb") as f:
+            return {"name":name,"inside":f.read()}
+    return {"name":name,"inside":encode_file_to_base64(file_path)}
+
+def file_sha256(file_path):
+    digest=hashlib.sha256()
+    with open(file_path,"rb") as f:
+        for block in iter(lambda: f.read(1024*1024),b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# ────────────────[Uploading the weight]───────────────
+# [------------------------------------------------------]
+# 1. We ask the API how many bytes it already has for this file (same sha256 & size), to resume an interrupted upload
+# 2. The rest is sent by chunks (PUT with Content-Range). A 409 gives the offset expected by the API
+# 3. On a network error, we wait and start again from step 1, at most artifact_retries times
+# 4. Return the sha256 & the size once the API has the complete file (checked with the sha256)
+# [------------------------------------------------------]
+def upload_artifact(file_path,job,name):
+    size=os.path.getsize(file_path)
+    if size==0:
+        raise ValueError(f"{file_path} is empty")
+    sha256=file_sha256(file_path)
+    url=f"http://{API_HOST}:{API_PORT}/artifact/{job}/{name}"
+    attempt=0
+    while True:
+        try:
+            status=requests.get(url,params={"sha256":sha256,"size":size},timeout=10)
+            status.raise_for_status()
+            status=status.json()
+            offset=status["received"]
+            with open(file_path,"rb") as f:
+                while not status["complete"]:
+                    f.seek(offset)
+                    chunk=f.read(artifact_chunk_size)
+                    answer=requests.put(url,data=chunk,timeout=60,headers={
+                        "Content-Range":f"bytes {offset}-{offset+len(chunk)-1}/{size}",
+                        "X-Content-SHA256":sha256})
+                    if answer.status_code!=409:
+                        answer.raise_for_status()
+                    status=answer.json()
+                    offset=status["received"]
+            return sha256,size
+        except (requests.RequestException,ValueError,KeyError) as e:
+            attempt+=1
+            if attempt>artifact_retries:
+                raise
+            sending_log_to_server(f"[WARNING] Upload of {name} interrupted ({e}), retrying.")
+            time.sleep(min(2**attempt,30))
+
 def encode_file_to_base64(file_path):
     """
     Lit un fichier binaire et retourne son contenu encodé en Base64 (str).
@@ -1,6 +1,7 @@
 import csv
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Any, List, Optional
@@ -8,9 +9,13 @@ import psycopg2
 import os
 from datetime import datetime
 import json
+import hashlib
+import re
 from pathlib import Path
 import shutil
 import time 
+import select
+import threading
 import paho.mqtt.client as mqtt 
 
 #==============================================#
@@ -105,6 +110,46 @@ def list_hubs():
         print("Erreur list_hubs:", e)
         return []
 
+# Statuts des hubs, tels qu'envoyés par l'orchestrateur (NOTIFY hub_status), sans requête SQL
+@API_app.get("/hubs/status")
+def hubs_status():
+    return {"updated_at": hub_status_updated_at, "status": dict(hub_status_live)}
+
+# L'orchestrateur garde les statuts en mémoire et les écrit par lots : chaque lot est suivi d'un NOTIFY hub_status
+hub_status_live = {}
+hub_status_updated_at = None
+
+def listen_hub_status():
+    global hub_status_updated_at
+    while True:
+        try:
+            connexion = psycopg2.connect(database="FL", user="program", host="postgresql", password="program")
+            connexion.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connexion.cursor() as cursol_sql:
+                cursol_sql.execute("LISTEN hub_status;")
+            while True:
+                if select.select([connexion], [], [], 60) == ([], [], []):
+                    continue
+                connexion.poll()
+                while connexion.notifies:
+                    notify = connexion.notifies.pop(0)
+                    statuses = json.loads(notify.payload)
+                    # "*" : tous les hubs ont été remis OFFLINE (redémarrage de l'orchestrateur)
+                    if "*" in statuses:
+                        hub_status_live.clear()
+                    hub_status_live.update({name: status for name, status in statuses.items() if name != "*"})
+                    hub_status_updated_at = datetime.now().isoformat()
+        except Exception as e:
+            print("Erreur listen_hub_status:", e)
+            time.sleep(5)
+
+threading.Thread(target=listen_hub_status, daemon=True).start()
+
+# L'orchestrateur garde en cache les chemins des modèles & datasets : chaque modification lui est signalée (NOTIFY metadata_changed),
+# envoyée dans la transaction de la modification, donc reçue seulement après le commit
+def notify_metadata_changed(cursol_sql, table_name, id):
+    cursol_sql.execute("SELECT pg_notify('metadata_changed', %s)", (json.dumps({"type": table_name, "id": str(id)}),))
+
 @API_app.post("/upload")
 async def upload_model_dataset(
     type_of_upload: str = Form(...),
@@ -136,6 +181,7 @@ async def upload_model_dataset(
                 f"UPDATE {table_name} SET path=%s WHERE {id_column}=%s",
                 (str(upload_path), upload_id)
             )
+            notify_metadata_changed(cursol_sql, table_name, upload_id)
         connexion_sql.commit()
         return {"status": "uploaded", "id": upload_id, "filename": file.filename, "path": str(upload_path)}
     except Exception as e:
@@ -182,7 +228,9 @@ async def modify_model_dataset(
                     f"UPDATE {table_name} SET path=%s WHERE {id_column}=%s",
                     (str(update_path), id)
                 )
-        
+
+        with connexion_sql.cursor() as cursol_sql:
+            notify_metadata_changed(cursol_sql, table_name, id)
         connexion_sql.commit()
         print("Modification réussie")
 
@@ -216,6 +264,7 @@ async def delete_model_dataset(payload:deletePayload):
                 print(f"Dossier supprimé : {dir_to_delete}")
             
             cursol_sql.execute(f"DELETE FROM {table_name} WHERE {id_column}=%s", (payload.id,))
+            notify_metadata_changed(cursol_sql, table_name, payload.id)
             
         connexion_sql.commit()
         return {"status": "deleted", "id": payload.id}
@@ -275,6 +324,112 @@ def download_weight():
         print("Erreur download_weight:", e)
         raise HTTPException(status_code=500, detail="Erreur serveur lors du téléchargement de la weight")
 
+# Weight du serveur pour un job (plusieurs jobs peuvent tourner en même temps)
+@API_app.get("/weight/{job_id}")
+def download_job_weight(job_id: int):
+    weight_path = BASE_DIR / "Weights" / str(job_id) / "server_weight.pth"
+    if not weight_path.exists():
+        raise HTTPException(status_code=404, detail=f"Weight not found for job {job_id}")
+    return FileResponse(path=str(weight_path), filename="server_weight.pth", media_type="application/octet-stream")
+
+
+#==============================================#
+#============= API PATH : Artifacts (poids des hubs) ============#
+#==============================================#
+# Les hubs envoient leurs poids en binaire, par morceaux (PUT avec Content-Range), au lieu du base64 dans MQTT.
+# Le morceau en cours est écrit dans Uploads/<job>/<nom>.part ; un envoi interrompu reprend à la taille déjà reçue.
+# Une fois complet, le sha256 est vérifié et le fichier est déplacé dans Result/<job>/<nom>, où l'orchestrateur le lit.
+ARTIFACT_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+# Taille des écritures du morceau reçu (les lectures, écritures & le sha256 sont faits dans le threadpool, pas dans la boucle async)
+ARTIFACT_WRITE_SIZE = 1024 * 1024
+
+def artifact_paths(job_id: int, name: str):
+    if not ARTIFACT_NAME.match(name) or name.startswith("."):
+        raise HTTPException(status_code=400, detail=f"Invalid artifact name {name}")
+    upload_dir = BASE_DIR / "Uploads" / str(job_id)
+    return upload_dir / (name + ".part"), upload_dir / (name + ".json"), BASE_DIR / "Result" / str(job_id) / name
+
+def file_sha256(path: Path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Un envoi partiel n'est repris que pour le même fichier (même sha256 & même taille), sinon il est recommencé
+def artifact_received(part_path: Path, meta_path: Path, sha256: str, size: int):
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    if meta != {"sha256": sha256, "size": size}:
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path.unlink(missing_ok=True)
+        with open(meta_path, "w") as f:
+            json.dump({"sha256": sha256, "size": size}, f)
+        return 0
+    return part_path.stat().st_size if part_path.exists() else 0
+
+# Etat d'un envoi : nombre d'octets déjà reçus, et s'il est complet
+@API_app.get("/artifact/{job_id}/{name}")
+def artifact_status(job_id: int, name: str, sha256: str, size: int):
+    part_path, meta_path, final_path = artifact_paths(job_id, name)
+    if final_path.exists() and not part_path.exists() and final_path.stat().st_size == size and file_sha256(final_path) == sha256:
+        return {"received": size, "complete": True}
+    return {"received": artifact_received(part_path, meta_path, sha256, size), "complete": False}
+
+# Réception d'un morceau : Content-Range "bytes début-fin/total" et X-Content-SHA256 (sha256 du fichier entier)
+# Le corps ne peut être lu qu'en async : seul le flux est lu dans la boucle, le reste passe par run_in_threadpool
+@API_app.put("/artifact/{job_id}/{name}")
+async def upload_artifact(job_id: int, name: str, request: Request):
+    part_path, meta_path, final_path = artifact_paths(job_id, name)
+    sha256 = request.headers.get("X-Content-SHA256", "").lower()
+    content_range = CONTENT_RANGE.match(request.headers.get("Content-Range", ""))
+    if not sha256 or content_range is None:
+        raise HTTPException(status_code=400, detail="Content-Range and X-Content-SHA256 are required")
+    start, end, size = (int(v) for v in content_range.groups())
+    if end < start or end >= size:
+        raise HTTPException(status_code=416, detail="Invalid Content-Range")
+    received = await run_in_threadpool(artifact_received, part_path, meta_path, sha256, size)
+    # >>> Le morceau doit commencer là où le précédent s'est arrêté
+    if start != received:
+        return JSONResponse(status_code=409, content={"received": received, "complete": False})
+    f = await run_in_threadpool(open, part_path, "ab")
+    try:
+        buffer = bytearray()
+        async for chunk in request.stream():
+            buffer += chunk
+            if len(buffer) >= ARTIFACT_WRITE_SIZE:
+                await run_in_threadpool(f.write, buffer)
+                buffer = bytearray()
+        if buffer:
+            await run_in_threadpool(f.write, buffer)
+        written = f.tell() - start
+    finally:
+        await run_in_threadpool(f.close)
+    return await run_in_threadpool(store_artifact_chunk, part_path, meta_path, final_path, sha256, start, end, size, written)
+
+# Fin d'un morceau (dans le threadpool) : morceau incomplet, fichier pas encore complet, ou vérification du sha256 & déplacement
+def store_artifact_chunk(part_path: Path, meta_path: Path, final_path: Path, sha256: str, start: int, end: int, size: int, written: int):
+    if written != end - start + 1:
+        # >>> Morceau incomplet : on revient au début du morceau
+        with open(part_path, "r+b") as f:
+            f.truncate(start)
+        return JSONResponse(status_code=409, content={"received": start, "complete": False})
+    if end + 1 < size:
+        return {"received": end + 1, "complete": False}
+    # >>> Fichier complet : vérification du sha256, puis déplacement dans Result/<job>
+    if file_sha256(part_path) != sha256:
+        part_path.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=422, detail="sha256 mismatch, the upload must be restarted")
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(part_path, final_path)
+    meta_path.unlink(missing_ok=True)
+    return {"received": size, "complete": True}
+
 
 #==============================================#
 #============= API PATH : Datasets (Non Modifiés) ============#
@@ -318,7 +473,7 @@ def download_dataset(id: int):
 
 
 @API_app.get("/dataset/{id}/{part_number}")
-def get_dataset_part(id: int, part_number: int):
+def get_dataset_part(id: int, part_number: int, job: Optional[int] = None, key: Optional[str] = None):
     try:
         with connexion_sql.cursor() as cursol_sql:
             cursol_sql.execute("SELECT path FROM datasets WHERE dataset_id=%s", (id,))
@@ -329,6 +484,21 @@ def get_dataset_part(id: int, part_number: int):
 
         dataset_dir = Path(row[0]).parent
         part_filename = f"Dataset{part_number}.csv"
+        # Les parts d'un job sont dans son propre dossier
+        if job is not None:
+            dataset_dir = dataset_dir / f"job{job}"
+        elif not (dataset_dir / part_filename).exists():
+            # Hub sans ?job= (ancien hub) : on prend le dossier du job qui utilise ce dataset, s'il n'y en a qu'un
+            job_dirs = [path.parent for path in dataset_dir.glob(f"job*/{part_filename}")]
+            if len(job_dirs) > 1:
+                raise HTTPException(status_code=409, detail=f"Plusieurs jobs utilisent le dataset {id} : le hub doit donner ?job=")
+            if job_dirs:
+                dataset_dir = job_dirs[0]
+        # Parts du tour suivant, préparées à l'avance dans le cache des partitions de l'orchestrateur
+        if key is not None:
+            if not re.fullmatch(r"[0-9a-f]{64}", key):
+                raise HTTPException(status_code=400, detail="Clé de partition invalide")
+            dataset_dir = BASE_DIR / "PartitionCache" / key
         part_path = dataset_dir / part_filename
         print(part_path)
 
@@ -336,6 +506,8 @@ def get_dataset_part(id: int, part_number: int):
             raise HTTPException(status_code=404, detail=f"Part {part_number} not found for dataset {id}")
 
         return FileResponse(path=part_path, filename=part_filename, media_type="application/octet-stream")
+    except HTTPException as e:
+        raise e
     except Exception as e:
         print("Erreur get_dataset_part:", e)
         raise HTTPException(status_code=500, detail="Erreur lors de la récupération du sous-dataset")
@@ -0,0 +1,243 @@
+# ╔══════════════════════════════════════╗
+# ║          Aggregation worker          ║
+# ╚══════════════════════════════════════╝
+# Long-lived process running the initialisation & the aggregation of the model of a job.
+# The model program of the user is imported once (torch included), then its modes are called as functions
+# through a pipe, instead of starting a new python3 at each turn. The process stays separated from the server,
+# so a crash or a sys.exit of the model can't take the orchestrator down.
+#
+# The weights of the hubs can also be folded one by one in a running weighted mean (FedAvg), as they arrive :
+# the new global weight is then ready as soon as the last hub reported, and only one model is kept in memory.
+#
+# Messages of the pipe :
+# - server -> worker : (mode, arguments) with mode in "init", "aggregate", "reset", "fold", "finalize", "stop"
+# - worker -> server : ("ready", missing functions), ("log", line), ("done", output_path or number of weights folded), ("error", message)
+
+import importlib.util
+import multiprocessing
+import queue
+import sys
+import threading
+import traceback
+
+# Function of the model program called for each mode
+MODES = {
+    "init": "mode_initialization",
+    "aggregate": "mode_aggregation",
+}
+
+class AggregationWorkerError(Exception):
+    pass
+
+# The model program doesn't give the functions of the mode : the caller uses the python3 program instead
+class AggregationUnavailable(AggregationWorkerError):
+    pass
+
+# ────────────────[Running FedAvg]───────────────
+# [------------------------------------------------------]
+# 1. fold : the weight of a hub is added to the sum, multiplied by his weight (number of rows of his part)
+#    The sums are kept in float64, one tensor per key : the memory is the one of a model, whatever the number of hubs
+# 2. finalize : the sums are divided by the total weight, in the type of the first weight, and saved as the new global weight
+# 3. The keys that aren't floating point (counters of the layers) keep the value of the first weight
+# [------------------------------------------------------]
+class RunningAverage:
+    def __init__(self,torch):
+        self.torch=torch
+        self.reset()
+
+    def reset(self):
+        self.sums=None
+        self.dtypes={}
+        self.total=0.0
+        self.count=0
+
+    def fold(self,path,weight):
+        weight=float(weight)
+        if weight<=0:
+            raise ValueError(f"Weight {weight} of {path} must be positive")
+        state_dict=self.torch.load(path,map_location="cpu")
+        if self.sums is None:
+            self.sums={}
+            for key,tensor in state_dict.items():
+                self.dtypes[key]=tensor.dtype
+                self.sums[key]=tensor.double()*weight if tensor.is_floating_point() else tensor.clone()
+        else:
+            if state_dict.keys()!=self.sums.keys():
+                raise ValueError(f"The keys of {path} don't match the keys of the first weight")
+            for key,tensor in state_dict.items():
+                if tensor.is_floating_point():
+                    self.sums[key].add_(tensor.double(),alpha=weight)
+        self.total+=weight
+        self.count+=1
+
+    def finalize(self,output_path):
+        if self.sums is None:
+            raise ValueError("No weight has been folded")
+        state_dict={}
+        for key,tensor in self.sums.items():
+            state_dict[key]=(tensor/self.total).to(self.dtypes[key]) if self.dtypes[key].is_floating_point else tensor
+        self.torch.save(state_dict,output_path)
+        self.reset()
+
+# ────────────────[Output of the worker]───────────────
+# Every line printed by the model is sent to the server, to be written in the logs of the job
+class PipeWriter:
+    def __init__(self,conn):
+        self.conn=conn
+        self.buffer=""
+
+    def write(self,text):
+        self.buffer+=text
+        while "\n" in self.buffer:
+            line,self.buffer=self.buffer.split("\n",1)
+            self.conn.send(("log",line))
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.conn.send(("log",self.buffer))
+            self.buffer=""
+
+# ────────────────[Main of the worker process]───────────────
+# [------------------------------------------------------]
+# 1. The model program is imported once, and the server is told which modes it can run
+# 2. Each request calls the function of the mode, which writes the weight in output_path
+# 3. An exception, or a sys.exit of the model, is sent back as an error : the worker keeps running
+# [------------------------------------------------------]
+def worker_main(conn,model_path):
+    writer=PipeWriter(conn)
+    sys.stdout=writer
+    sys.stderr=writer
+    try:
+        spec=importlib.util.spec_from_file_location("fl_model",model_path)
+        module=importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except BaseException as e:
+        writer.flush()
+        conn.send(("error",f"Can't import {model_path} : {type(e).__name__}: {e}"))
+        return
+    conn.send(("ready",[mode for mode,function in MODES.items() if not callable(getattr(module,function,None))]))
+    average=None
+    while True:
+        try:
+            mode,arguments=conn.recv()
+        except (EOFError,OSError):
+            break
+        if mode=="stop":
+            break
+        try:
+            # >>> The model program already imported torch, so using it costs no import
+            torch=sys.modules.get("torch")
+            if mode in ("reset","fold","finalize"):
+                if torch is None:
+                    raise RuntimeError("The model program doesn't use torch")
+                if average is None:
+                    average=RunningAverage(torch)
+            if mode=="init":
+                module.mode_initialization(arguments["input_dim"],arguments["output_path"])
+            elif mode=="aggregate":
+                module.mode_aggregation(arguments["weights_dir"],arguments["output_path"])
+            elif mode=="reset":
+                average.reset()
+            elif mode=="fold":
+                average.fold(arguments["path"],arguments["weight"])
+                print(f"Info | {arguments['path']} folded (weight {arguments['weight']}, {average.count} so far)",flush=True)
+            elif mode=="finalize":
+                count=average.count
+                average.finalize(arguments["output_path"])
+                print(f"RESULTAT_AGGR | FedAvg of {count} weights saved here : {arguments['output_path']}",flush=True)
+            else:
+                raise ValueError(f"Unknown mode {mode}")
+            writer.flush()
+            conn.send(("done",count if mode=="finalize" else arguments.get("output_path")))
+        except SystemExit as e:
+            writer.flush()
+            conn.send(("error",f"The model program exited with the code {e.code}"))
+        except Exception as e:
+            traceback.print_exc()
+            writer.flush()
+            conn.send(("error",f"{type(e).__name__}: {e}"))
+    conn.close()
+
+# ────────────────[Worker of a job]───────────────
+# [------------------------------------------------------]
+# 1. The process is spawned (not forked) : it doesn't inherit the threads, sockets & connexions of the server
+# 2. call() sends a request and gives each line of log to on_log until the answer arrives
+# 3. The calls of a worker are serialized by a lock
+# 4. submit() queues a request without waiting : the requests submitted are sent in order by a dispatcher thread,
+#    and drain() waits for all of them. An argument can be a function, called by the dispatcher just before sending
+# [------------------------------------------------------]
+class AggregationWorker:
+    def __init__(self,model_path):
+        self.model_path=str(model_path)
+        context=multiprocessing.get_context("spawn")
+        self.conn,child_conn=context.Pipe()
+        self.process=context.Process(target=worker_main,args=(child_conn,self.model_path),daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock=threading.Lock()
+        self.missing=None
+        self.requests=queue.Queue()
+        self.failures=[]
+        threading.Thread(target=self.dispatch,daemon=True).start()
+
+    def receive(self,on_log):
+        while True:
+            try:
+                kind,value=self.conn.recv()
+            except (EOFError,OSError):
+                raise AggregationWorkerError(f"The aggregation worker of {self.model_path} stopped (exit code {self.process.exitcode})")
+            if kind=="log":
+                if on_log is not None:
+                    on_log(value)
+            elif kind=="error":
+                raise AggregationWorkerError(value)
+            else:
+                return value
+
+    def call(self,mode,on_log=None,**arguments):
+        with self.lock:
+            # >>> The first call waits for the import of the model program
+            if self.missing is None:
+                self.missing=self.receive(on_log)
+            if mode in self.missing:
+                raise AggregationUnavailable(f"{self.model_path} has no function {MODES[mode]}")
+            self.conn.send((mode,arguments))
+            return self.receive(on_log)
+
+    def submit(self,mode,on_log=None,**arguments):
+        self.requests.put((mode,on_log,arguments))
+
+    def dispatch(self):
+        while True:
+            mode,on_log,arguments=self.requests.get()
+            try:
+                if mode is None:
+                    return
+                self.call(mode,on_log,**{key:value() if callable(value) else value for key,value in arguments.items()})
+            except Exception as e:
+                self.failures.append(f"{mode} : {e}")
+            finally:
+                self.requests.task_done()
+
+    # ────────────────[Wait for the requests submitted]───────────────
+    # Return the errors of the requests since the last drain
+    def drain(self):
+        self.requests.join()
+        failures,self.failures=self.failures,[]
+        return failures
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self,timeout=5):
+        self.requests.put((None,None,None))
+        try:
+            self.conn.send(("stop",None))
+        except (OSError,ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
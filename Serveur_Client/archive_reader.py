@@ -0,0 +1,128 @@
+# ╔══════════════════════════════════════╗
+# ║            Archive reader            ║
+# ╚══════════════════════════════════════╝
+# Reads the Parquet segments of the sensor archive (ARCHIVE_FORMAT=parquet) for a range of time.
+# Layout of the archive : Data/<YYYY-MM-DD>/<host>/<sensor>/<HH>.parquet (or data.parquet for a segment of a day),
+# with <HH>.1.parquet, <HH>.2.parquet... when a segment has been written in several files.
+#
+# The range is pruned at each level, before reading anything :
+# - the folders of the days and the files of the hours out of the range are skipped
+# - inside a file, the row groups whose min/max timestamp is out of the range aren't read
+#
+# Usage : python3 archive_reader.py /app/FL/Data --start "2025-01-01 08:00" --end "2025-01-01 12:00" --host hub1 -o dataset.csv
+
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# ────────────────[Time range of a segment]───────────────
+# Return (start, end) of the segment of a file, from the folder of its day and its name
+def segment_range(path):
+    day=datetime.strptime(path.parent.parent.parent.name,"%Y-%m-%d")
+    stem=path.name.split(".",1)[0]
+    if stem.isdigit():
+        start=day+timedelta(hours=int(stem))
+        return start,start+timedelta(hours=1)
+    return day,day+timedelta(days=1)
+
+def overlaps(first,last,start,end):
+    return (end is None or first<end) and (start is None or last>=start)
+
+# ────────────────[Finding the segments]───────────────
+# [------------------------------------------------------]
+# 1. The folders of the days out of [start, end) are skipped
+# 2. Then the hosts and the sensors asked (all of them if None)
+# 3. Then the files whose hour is out of the range
+# [------------------------------------------------------]
+def find_segments(root,start=None,end=None,host=None,sensor=None):
+    segments=[]
+    for day_dir in sorted(Path(root).iterdir()):
+        try:
+            day=datetime.strptime(day_dir.name,"%Y-%m-%d")
+        except ValueError:
+            continue
+        if not overlaps(day,day+timedelta(days=1)-timedelta(microseconds=1),start,end):
+            continue
+        for host_dir in sorted(day_dir.iterdir()):
+            if not host_dir.is_dir() or (host is not None and host_dir.name!=host):
+                continue
+            for sensor_dir in sorted(host_dir.iterdir()):
+                if not sensor_dir.is_dir() or (sensor is not None and sensor_dir.name!=sensor):
+                    continue
+                for path in sorted(sensor_dir.glob("*.parquet")):
+                    first,after=segment_range(path)
+                    if overlaps(first,after-timedelta(microseconds=1),start,end):
+                        segments.append(path)
+    return segments
+
+# ────────────────[Reading a segment]───────────────
+# [------------------------------------------------------]
+# 1. The statistics of the timestamp column of each row group are read from the footer
+# 2. Only the row groups in the range are read, then the rows are filtered
+# 3. The host & the sensor (kept once in the metadata of the file) are added as columns
+# [------------------------------------------------------]
+def read_segment(path,start=None,end=None):
+    parquet_file=pq.ParquetFile(str(path))
+    metadata=parquet_file.metadata
+    column=parquet_file.schema_arrow.get_field_index("timestamp")
+    row_groups=[]
+    for i in range(metadata.num_row_groups):
+        statistics=metadata.row_group(i).column(column).statistics
+        if statistics is None or not statistics.has_min_max or overlaps(statistics.min,statistics.max,start,end):
+            row_groups.append(i)
+    if not row_groups:
+        return None
+    table=parquet_file.read_row_groups(row_groups)
+    if start is not None:
+        table=table.filter(pc.greater_equal(table["timestamp"],pa.scalar(start,pa.timestamp("ms"))))
+    if end is not None:
+        table=table.filter(pc.less(table["timestamp"],pa.scalar(end,pa.timestamp("ms"))))
+    file_metadata=parquet_file.schema_arrow.metadata or {}
+    host=file_metadata.get(b"host",b"").decode()
+    sensor=file_metadata.get(b"sensor",b"").decode()
+    table=table.add_column(0,"sensor",pa.array([sensor]*table.num_rows,pa.string()).dictionary_encode())
+    table=table.add_column(0,"host",pa.array([host]*table.num_rows,pa.string()).dictionary_encode())
+    return table
+
+# ────────────────[Reading the archive]───────────────
+# Return a table (host, sensor, timestamp, value, value_text, place, person) of the rows in [start, end), sorted by time
+def read_archive(root,start=None,end=None,host=None,sensor=None):
+    tables=[]
+    for path in find_segments(root,start,end,host,sensor):
+        table=read_segment(path,start,end)
+        if table is not None and table.num_rows:
+            tables.append(table)
+    if not tables:
+        return None
+    table=pa.concat_tables(tables,promote_options="permissive")
+    return table.sort_by("timestamp")
+
+def parse_time(text):
+    return datetime.fromisoformat(text) if text else None
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Read the Parquet segments of the sensor archive for a range of time")
+    parser.add_argument("root",help="Data folder of the archive")
+    parser.add_argument("--start",help="First time (included), ISO format")
+    parser.add_argument("--end",help="Last time (excluded), ISO format")
+    parser.add_argument("--host")
+    parser.add_argument("--sensor")
+    parser.add_argument("-o","--output",help="File written (.csv or .parquet). Without it, the rows are printed")
+    args=parser.parse_args()
+
+    table=read_archive(args.root,parse_time(args.start),parse_time(args.end),args.host,args.sensor)
+    if table is None:
+        print("No row in the range.")
+    elif args.output is None:
+        print(table.to_string(preview_cols=10))
+    elif args.output.endswith(".parquet"):
+        pq.write_table(table,args.output)
+        print(f"{table.num_rows} rows written in {args.output}")
+    else:
+        import pyarrow.csv as pacsv
+        pacsv.write_csv(table.cast(pa.schema([(field.name,pa.string() if pa.types.is_dictionary(field.type) else field.type) for field in table.schema])),args.output)
+        print(f"{table.num_rows} rows written in {args.output}")
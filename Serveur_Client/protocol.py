@@ -0,0 +1,479 @@
+# ╔══════════════════════════════════════╗
+# ║          Codec of the messages       ║
+# ╚══════════════════════════════════════╝
+# Shared by the server (Serveur_Client/protocol.py) and the hubs (Hub_Client/Hub_Client/protocol.py) : keep both copies identical.
+#
+# A message is : sender, receiver, instruction, and typed fields (name -> value).
+# Two encodings :
+# - binary (version 2) : decoded once, without regex, the fields keep their type
+#     header : MAGIC, VERSION, number of text fields (1 byte), number of the other fields (1 byte), then the type of each other field (1 byte each)
+#     text (utf-8) : sender, receiver, instruction, then the name & the value of each text field, then of each other field, each ended by \0
+#     so the whole text is decoded & cut by a single decode().split("\0"), and the text fields need no conversion.
+#     Integers, floats, booleans & None are written in the text too. The other values (bytes, lists, texts containing \0) come after the text,
+#     whose size is then given after the types (4 bytes) : type (1 byte), then texts & bytes prefixed by their size (4 bytes),
+#     lists by their number of items (4 bytes), integers & floats on 8 bytes
+# - legacy : the text "[sender] [receiver] [INSTRUCTION] [name:value|name:value]", still used with the sensors,
+#   the API and the hubs that didn't advertise this version of the protocol (proto:2 in their connexion message)
+#
+# Run this file to compare the throughput of both encodings with the old regex decoding.
+
+import struct
+
+MAGIC = b"\xb7"
+VERSION = 2
+
+TYPE_NONE = 0
+TYPE_STR = 1
+TYPE_INT = 2
+TYPE_FLOAT = 3
+TYPE_BYTES = 4
+TYPE_BOOL = 5
+TYPE_LIST = 6
+# The value is after the text
+TYPE_TAIL = 7
+
+HEADER = struct.Struct("!cBBB")
+SIZE = struct.Struct("!I")
+INT = struct.Struct("!q")
+DOUBLE = struct.Struct("!d")
+
+class ProtocolError(ValueError):
+    pass
+
+# ────────────────[Decoded message]───────────────
+# [------------------------------------------------------]
+# 1. message[0..3] gives sender, receiver, instruction & details, like the list of re.findall used before
+#    (for a binary message, the details are rebuilt in the legacy form name:value|name:value)
+# 2. message.get(name) gives the value of a field, message.groups the {...} blocks of the legacy details
+# 3. The fields of a legacy message are only parsed when they are used
+# [------------------------------------------------------]
+class Message:
+    __slots__=("sender","receiver","instruction","_fields","_details","_groups","binary","raw")
+
+    def __init__(self,sender,receiver,instruction,fields=None,details=None,binary=False,raw=None):
+        self.sender=sender
+        self.receiver=receiver
+        self.instruction=instruction
+        self._fields=fields
+        self._details=details
+        self._groups=None
+        self.binary=binary
+        self.raw=raw
+
+    @property
+    def details(self):
+        if self._details is None:
+            self._details=format_details(self._fields)
+        return self._details
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields,self._groups=parse_details(self._details)
+        return self._fields
+
+    @property
+    def groups(self):
+        if self._groups is None:
+            if self._details is None:
+                self._groups=[]
+            else:
+                self._fields,self._groups=parse_details(self._details)
+        return self._groups
+
+    def get(self,name,default=None):
+        fields=self._fields
+        if fields is None:
+            fields=self.fields
+        return fields.get(name,default)
+
+    def __getitem__(self,index):
+        return (self.sender,self.receiver,self.instruction,self.details)[index]
+
+    def __len__(self):
+        return 4
+
+    def __str__(self):
+        return "["+self.sender+"] ["+self.receiver+"] ["+self.instruction+"] ["+self.details+"]"
+
+# ────────────────[Encoding a message]───────────────
+# binary=False gives the legacy text, for the receivers that don't know the protocol
+def encode(sender,receiver,instruction,fields=None,binary=True):
+    fields=fields or {}
+    if not binary:
+        return "["+str(sender)+"] ["+str(receiver)+"] ["+instruction+"] ["+format_details(fields)+"]"
+    texts=[str(sender),str(receiver),instruction]
+    typed=[]
+    kinds=bytearray()
+    tail=[]
+    for name,value in fields.items():
+        if isinstance(value,str) and "\0" not in value:
+            texts.append(name)
+            texts.append(value)
+            continue
+        typed.append(name)
+        if value is None:
+            kinds.append(TYPE_NONE)
+            typed.append("")
+        elif isinstance(value,bool):
+            kinds.append(TYPE_BOOL)
+            typed.append("1" if value else "0")
+        elif isinstance(value,int):
+            kinds.append(TYPE_INT)
+            typed.append(str(value))
+        elif isinstance(value,float):
+            kinds.append(TYPE_FLOAT)
+            typed.append(repr(value))
+        else:
+            kinds.append(TYPE_TAIL)
+            typed.append("")
+            write_value(tail,value)
+    text_count=(len(texts)-3)//2
+    if text_count>255 or len(kinds)>255:
+        raise ProtocolError("A message is limited to 255 text fields & 255 other fields")
+    texts+=typed
+    texts.append("")
+    text="\0".join(texts)
+    # >>> Only the values can contain \0 (they are then after the text)
+    if text.count("\0")!=len(texts)-1:
+        raise ProtocolError("The sender, the receiver, the instruction & the names of the fields can't contain \\0")
+    text=text.encode("utf-8")
+    header=HEADER.pack(MAGIC,VERSION,text_count,len(kinds))
+    if tail:
+        return b"".join([header,kinds,SIZE.pack(len(text)),text]+tail)
+    return b"".join((header,kinds,text))
+
+# ────────────────[Decoding a message]───────────────
+# [------------------------------------------------------]
+# 1. A payload starting with MAGIC is a binary message
+# 2. Else, it is a legacy message (see decode_legacy)
+# 3. Return None if the payload isn't a message
+# [------------------------------------------------------]
+def decode(payload):
+    if isinstance(payload,str):
+        return decode_legacy(payload)
+    if payload[:1]==MAGIC:
+        return decode_binary(payload)
+    try:
+        return decode_legacy(payload.decode("utf-8"))
+    except UnicodeDecodeError:
+        return None
+
+# [------------------------------------------------------]
+# 1. The text is decoded & cut once : the text fields are then ready, without any conversion
+# 2. Only the other fields are converted, the values after the text being read in their order
+# [------------------------------------------------------]
+def decode_binary(payload):
+    try:
+        _,version,text_count,typed_count=HEADER.unpack_from(payload,0)
+    except struct.error:
+        raise ProtocolError("Truncated message")
+    if version!=VERSION:
+        raise ProtocolError(f"Unknown version {version} of the protocol")
+    start=HEADER.size+typed_count
+    kinds=payload[HEADER.size:start]
+    end=len(payload)
+    if typed_count and TYPE_TAIL in kinds:
+        try:
+            end=start+4+SIZE.unpack_from(payload,start)[0]
+        except struct.error:
+            raise ProtocolError("Truncated message")
+        start+=4
+    try:
+        texts=payload[start:end].decode("utf-8").split("\0")
+    except UnicodeDecodeError:
+        raise ProtocolError("Invalid text in the message")
+    # >>> The text ends with \0 : a truncated text (or types) has one piece less, or a last piece that isn't empty
+    if len(texts)!=4+2*(text_count+typed_count) or texts[-1]:
+        raise ProtocolError("Truncated message")
+    values=iter(texts)
+    sender,receiver,instruction=next(values),next(values),next(values)
+    fields=dict(zip(values,values))
+    if typed_count:
+        # >>> The integers (job, part_number...) are converted here, the other types by read_typed_fields
+        index=3+2*text_count
+        try:
+            for kind in kinds:
+                if kind==TYPE_INT:
+                    fields[texts[index]]=int(texts[index+1])
+                    index+=2
+                else:
+                    end=read_typed_fields(payload,kinds,texts,3+2*text_count,fields,end)
+                    break
+        except ProtocolError:
+            raise
+        except ValueError:
+            raise ProtocolError("Invalid integer in the message")
+        if end!=len(payload):
+            raise ProtocolError("Truncated message")
+    return Message(sender,receiver,instruction,fields,None,True)
+
+# texts[index] is the name of the first other field. Return the position after the values read after the text
+def read_typed_fields(payload,kinds,texts,index,fields,position):
+    try:
+        for kind in kinds:
+            if kind==TYPE_INT:
+                fields[texts[index]]=int(texts[index+1])
+            elif kind==TYPE_FLOAT:
+                fields[texts[index]]=float(texts[index+1])
+            elif kind==TYPE_NONE:
+                fields[texts[index]]=None
+            elif kind==TYPE_BOOL:
+                fields[texts[index]]=texts[index+1]=="1"
+            elif kind==TYPE_TAIL:
+                fields[texts[index]],position=read_value(payload,payload[position],position+1)
+            else:
+                raise ProtocolError(f"Unknown type {kind}")
+            index+=2
+    except ProtocolError:
+        raise
+    except (struct.error,IndexError,ValueError):
+        raise ProtocolError("Truncated message")
+    return position
+
+# ────────────────[Decoding a legacy message]───────────────
+# [------------------------------------------------------]
+# 1. Without braces, the text is cut on "]" : a block is what follows the first "[" of a piece, like with the old regex
+# 2. With braces, the blocks are found with str.find, and a "]" inside {...} doesn't end the block (the start message has hubs & rules in braces)
+# 3. Only the four first blocks are used. An unclosed block is ignored
+# 4. Return None if there are less than three blocks (a message without details gets empty details)
+# [------------------------------------------------------]
+def decode_legacy(text):
+    blocks=[]
+    if "{" not in text:
+        for piece in text.split("]")[:-1]:
+            start=piece.find("[")
+            if start>=0:
+                blocks.append(piece[start+1:])
+                if len(blocks)==4:
+                    break
+    else:
+        position=0
+        while len(blocks)<4:
+            start=text.find("[",position)
+            if start<0:
+                break
+            end=text.find("]",start+1)
+            while end>=0 and text.count("{",start,end)>text.count("}",start,end):
+                end=text.find("]",end+1)
+            if end<0:
+                break
+            blocks.append(text[start+1:end])
+            position=end+1
+    if len(blocks)<3:
+        return None
+    if len(blocks)==3:
+        blocks.append("")
+    return Message(blocks[0],blocks[1],blocks[2],details=blocks[3],raw=text)
+
+# ────────────────[Details of a legacy message]───────────────
+# [------------------------------------------------------]
+# 1. The details are cut on the "|" that aren't inside {...}
+# 2. name:value gives a field (the name is stripped), {...} gives a group
+# 3. A name given twice keeps its first value, like split(name+":")[1]
+# [------------------------------------------------------]
+def parse_details(details):
+    fields={}
+    groups=[]
+    if not details:
+        return fields,groups
+    items=details.split("|")
+    if "{" in details:
+        items=join_braces(items)
+    for item in items:
+        if item.startswith("{") and item.endswith("}"):
+            groups.append(item[1:-1])
+            continue
+        name,separator,value=item.partition(":")
+        if separator:
+            fields.setdefault(name.strip(),value)
+    return fields,groups
+
+def join_braces(items):
+    joined=[]
+    depth=0
+    for item in items:
+        if depth>0:
+            joined[-1]+="|"+item
+        else:
+            joined.append(item)
+        depth+=item.count("{")-item.count("}")
+    return joined
+
+def format_details(fields):
+    if not fields:
+        return ""
+    return "|".join(name+":"+format_value(value) for name,value in fields.items())
+
+def format_value(value):
+    if value is None:
+        return "None"
+    if isinstance(value,(list,tuple)):
+        return ",".join(format_value(v) for v in value)
+    if isinstance(value,(bytes,bytearray)):
+        return value.hex()
+    return str(value)
+
+# ────────────────[Values after the text]───────────────
+# The type is written before each value (a value after the text, or an item of a list)
+def write_value(out,value):
+    if value is None:
+        kind,data=TYPE_NONE,b""
+    elif isinstance(value,bool):
+        kind,data=TYPE_BOOL,(b"\x01" if value else b"\x00")
+    elif isinstance(value,int):
+        kind,data=TYPE_INT,INT.pack(value)
+    elif isinstance(value,float):
+        kind,data=TYPE_FLOAT,DOUBLE.pack(value)
+    elif isinstance(value,str):
+        data=value.encode("utf-8")
+        kind,data=TYPE_STR,SIZE.pack(len(data))+data
+    elif isinstance(value,(bytes,bytearray,memoryview)):
+        kind,data=TYPE_BYTES,SIZE.pack(len(value))+bytes(value)
+    elif isinstance(value,(list,tuple)):
+        kind,data=TYPE_LIST,SIZE.pack(len(value))
+    else:
+        raise ProtocolError(f"Can't encode a value of type {type(value).__name__}")
+    out.append(bytes((kind,)))
+    out.append(data)
+    if kind==TYPE_LIST:
+        for item in value:
+            write_value(out,item)
+
+def read_value(payload,kind,position):
+    if kind==TYPE_STR or kind==TYPE_BYTES:
+        size=SIZE.unpack_from(payload,position)[0]
+        position+=4
+        if position+size>len(payload):
+            raise ProtocolError("Truncated message")
+        data=payload[position:position+size]
+        return (data.decode("utf-8") if kind==TYPE_STR else bytes(data)),position+size
+    if kind==TYPE_INT:
+        return INT.unpack_from(payload,position)[0],position+8
+    if kind==TYPE_FLOAT:
+        return DOUBLE.unpack_from(payload,position)[0],position+8
+    if kind==TYPE_NONE:
+        return None,position
+    if kind==TYPE_BOOL:
+        return payload[position]==1,position+1
+    if kind==TYPE_LIST:
+        count=SIZE.unpack_from(payload,position)[0]
+        position+=4
+        items=[]
+        for _ in range(count):
+            item,position=read_value(payload,payload[position],position+1)
+            items.append(item)
+        return items,position
+    raise ProtocolError(f"Unknown type {kind}")
+
+# ────────────────[Benchmark]───────────────
+# [------------------------------------------------------]
+# 1. regex : the old way, the text is built by concatenation, and the payload received is decoded like the old on_message :
+#    re.findall on str(payload.decode("utf-8")), then each field is read with split
+# 2. legacy : the same text, decoded with decode_legacy, and the fields are read once
+# 3. binary : the binary encoding
+# 4. A small command (DOWNLOAD DATASETS, 4 fields), a command of the staged turns (STAGE JOB, 12 fields) and a result weight of 1 MB
+# 5. Each throughput is the best of 5 runs, the runs of the encodings being interleaved
+# [------------------------------------------------------]
+if __name__=="__main__":
+    import base64
+    import re
+    import timeit
+
+    fields={"id":"3","part_number":12,"name":"Dataset.csv","job":42}
+    text="[0] [hub01] [DOWNLOAD DATASETS] [id:3| part_number:12|name:Dataset.csv|job:42]"
+    binary=encode("0","hub01","DOWNLOAD DATASETS",fields)
+    text_payload=text.encode("utf-8")
+
+    def regex_round():
+        message="["+"0"+"] ["+"hub01"+"] ["+"DOWNLOAD DATASETS"+"] ["+"id:3| part_number:12|name:Dataset.csv|job:42"+"]"
+        payload_data=re.findall(r"\[(.*?)\]",str(message.encode("utf-8").decode("utf-8")))
+        payload_data[3].split("|")[1].split("part_number:")[1]
+        payload_data[3].split("|")[0].split("id:")[1]
+        payload_data[3].split("name:")[1].split("|")[0]
+        payload_data[3].split("job:")[1].split("|")[0]
+
+    def legacy_round():
+        message=decode(encode("0","hub01","DOWNLOAD DATASETS",fields,binary=False).encode("utf-8"))
+        message.get("part_number"),message.get("id"),message.get("name"),message.get("job")
+
+    def binary_round():
+        message=decode(encode("0","hub01","DOWNLOAD DATASETS",fields))
+        message.get("part_number"),message.get("id"),message.get("name"),message.get("job")
+
+    def encode_only():
+        encode("0","hub01","DOWNLOAD DATASETS",fields)
+
+    def decode_only():
+        message=decode(binary)
+        message.get("part_number"),message.get("id"),message.get("name"),message.get("job")
+
+    def legacy_decode_only():
+        message=decode(text_payload)
+        message.get("part_number"),message.get("id"),message.get("name"),message.get("job")
+
+    def regex_decode_only():
+        payload_data=re.findall(r"\[(.*?)\]",str(text_payload.decode("utf-8")))
+        payload_data[3].split("|")[1].split("part_number:")[1]
+        payload_data[3].split("|")[0].split("id:")[1]
+        payload_data[3].split("name:")[1].split("|")[0]
+        payload_data[3].split("job:")[1].split("|")[0]
+
+    # STAGE JOB : every field is read by the hub
+    stage_fields={"job":42,"turn":3,"Mode":"FL","dataset":"7","part_number":12,"dataset_name":"Dataset.csv","dataset_sha256":"ab"*32,
+                  "model":"5","model_name":"Model.py","model_sha256":"cd"*32,"key":"ef"*32,"weight_sha256":"01"*32}
+    stage_payload=encode("0","hub01","STAGE JOB",stage_fields,binary=False).encode("utf-8")
+    stage_binary=encode("0","hub01","STAGE JOB",stage_fields)
+
+    def regex_stage():
+        payload_data=re.findall(r"\[(.*?)\]",str(stage_payload.decode("utf-8")))
+        for name in stage_fields:
+            payload_data[3].split(name+":")[1].split("|")[0]
+
+    def legacy_stage():
+        message=decode(stage_payload)
+        for name in stage_fields:
+            message.get(name)
+
+    def binary_stage():
+        message=decode(stage_binary)
+        for name in stage_fields:
+            message.get(name)
+
+    # A result weight of 1 MB : base64 inside the text, against bytes in a binary field
+    weight=bytes(range(256))*4096
+    weight_text="[hub01] [0] [WAITING FOR WORK] [name:dataset1.pth|inside:"+base64.b64encode(weight).decode("utf-8")+"]"
+    weight_payload=weight_text.encode("utf-8")
+    weight_binary=encode("hub01","0","WAITING FOR WORK",{"name":"dataset1.pth","inside":weight})
+
+    def regex_weight():
+        payload_data=re.findall(r"\[(.*?)\]",str(weight_payload.decode("utf-8")))
+        base64.b64decode(payload_data[3].split("inside:")[1].encode("utf-8"))
+
+    def binary_weight():
+        decode(weight_binary).get("inside")
+
+    number=50000
+    tests=(("regex (encode + decode)",regex_round,number),
+           ("legacy (encode + decode)",legacy_round,number),
+           ("binary (encode + decode)",binary_round,number),
+           ("binary encode",encode_only,number),
+           ("regex decode",regex_decode_only,number),
+           ("legacy decode",legacy_decode_only,number),
+           ("binary decode",decode_only,number),
+           ("regex STAGE JOB",regex_stage,number),
+           ("legacy STAGE JOB",legacy_stage,number),
+           ("binary STAGE JOB",binary_stage,number),
+           ("regex weight 1 MB",regex_weight,20),
+           ("binary weight 1 MB",binary_weight,20))
+    best={}
+    for _ in range(5):
+        for name,function,count in tests:
+            seconds=timeit.timeit(function,number=count)
+            best[name]=min(best.get(name,seconds),seconds)
+    print(f"{'':28}{'messages/s':>12}")
+    for name,function,count in tests:
+        print(f"{name:28}{count/best[name]:>12.0f}")
+    print(f"Size of the message : {len(text_payload)} bytes (legacy), {len(binary)} bytes (binary)")
+    print(f"Size of the STAGE JOB message : {len(stage_payload)} bytes (legacy), {len(stage_binary)} bytes (binary)")
+    print(f"Size of the weight message : {len(weight_text)} bytes (legacy), {len(weight_binary)} bytes (binary)")
@@ -2,9 +2,23 @@
 # ║                Modules               ║
 # ╚══════════════════════════════════════╝
 import base64
+import bisect
+import copy
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 import csv
+import hashlib
+import heapq
+import io
+import multiprocessing
+import json
 import os
+import queue
+import select
 from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import shutil
 import subprocess
 import traceback
@@ -12,10 +26,14 @@ from paho.mqtt import client as mqtt_client
 import re, uuid, time, random, threading
 from datetime import datetime
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import argparse
 import re
 from threading import Thread
 import numpy as np # type: ignore
+from aggregation_worker import AggregationWorker, AggregationWorkerError, AggregationUnavailable
+import protocol
 # ╔══════════════════════════════════════╗
 # ║             Présentation             ║
 # ╚══════════════════════════════════════╝
@@ -36,9 +54,6 @@ import numpy as np # type: ignore
 # We'll import a Verbose parameter that we're gonna be able to activate via -v
 verbose = True
 
-# connexion_sql represent the connexion to the database, cursor_sql allow Python to execute sql querys
-global connexion_sql
-
 # IP Address & Port for the MQTT Broker
 broker = os.getenv('MQTT_BROKER_HOST', '172.18.0.1')
 port = 1883
@@ -46,19 +61,21 @@ port = 1883
 client_id = str(0)
 global client
 
-#We then create an array that contains multiple users
-user_array = []
-
-#List of user updated to the user currently here
-last_hb_user=[]
+# Keepalive of the MQTT connexion (in seconds) : the broker publishes the Last Will of a hub that stayed silent 1.5 times longer
+mqtt_keepalive = int(os.getenv("MQTT_KEEPALIVE", "15"))
+# The liveness of the hubs is handled by the broker (Last Will & keepalive), the heartbeats of the application are optional
+# The hubs that didn't advertise the protocol have no Last Will and wait for our heartbeats : they always get them (see 5. Heartbeats)
+app_heartbeats = os.getenv("APP_HEARTBEATS", "0") == "1"
+# Retained topic telling the hubs if the server is online
+topic_server_presence = "presence/server"
 
-global model_id, dataset_id, hubs, typeOfSelection, rulesList, numberOfParts, parameter, dataset_id_array, typeOfSelection_array, rulesList_array,numberOfParts_array
+#The connected users are kept in a registry indexed by their name (see 4. Handling the users)
+global registry
 
-global work_id 
-global list_dataset
+#The state of each job (hubs, turns, parts...) is kept in a Job, the jobs in progress being in jobs (see 6bis. Jobs)
+global jobs
 
-global number_of_turn, number_of_turn_total
-global mode_of_execution, is_initialized_model_given, input_dim
+global is_initialized_model_given, input_dim
 
 global default_path
 default_path = Path("/") / "app" / "FL"
@@ -75,60 +92,271 @@ default_path = Path("/") / "app" / "FL"
 def construct_message(receiver_id,instructions,details=""):
     return "["+client_id+"] ["+receiver_id+"] ["+instructions+"] ["+details+"]"
 
-def insert_logs(message,user="Server"):
+# Fields read by the hubs that didn't advertise the protocol, in their order : they cut the details by position ("|")
+# and take everything after "name:" or "Mode:", so a field added after them would end in their value
+legacy_hub_fields = {
+    "DOWNLOAD DATASETS": ("id","part_number","name"),
+    "DOWNLOAD MODELS": ("id","name"),
+    "LAUNCH THE MODEL": ("Mode",),
+    "DOWNLOAD WEIGHT": (),
+    "END OF THE START PROGRAM": (),
+}
+
+# Message for a hub, with typed fields : binary if the hub advertised the protocol (see protocol.py), else legacy text
+# with only the fields the old hubs know
+def hub_message(name,instructions,fields=None):
+    record=registry.get(name)
+    if record is not None and record.proto>=protocol.VERSION:
+        return protocol.encode(client_id,name,instructions,fields)
+    if fields and instructions in legacy_hub_fields:
+        fields={field:fields[field] for field in legacy_hub_fields[instructions] if field in fields}
+    return protocol.encode(client_id,name,instructions,fields,binary=False)
+
+# The log is given to the log pipeline (see 14. Files of the logs), which writes it in the database and in the file
+# The file depends on the job : the one given, or the one of the hub
+def insert_logs(message,user="Server",job=None):
     if verbose:
         print("Logs received from name:"+user+ ":"+message)
-    sql_execute(f"INSERT INTO logs(hub_name, logs, type, timestamp) VALUES ('{user}', '{message}', 'type', '{datetime.now()}')")
-    logs_to_file(message,user)
+    log_pipeline.put(message,user,logs_file_path(user,job))
 
 # ╔══════════════════════════════════════╗
 # ║    1. Handling the SQL Connection    ║
 # ╚══════════════════════════════════════╝
+# The threads of the server (MQTT callbacks, check threads, preparation & aggregation of the jobs...) borrow a connexion
+# of the pool for each transaction : a slow query or a failed transaction only concerns its own connexion.
+# The log pipeline, the status writer and the listeners keep their own connexion.
+
+# Number of connexions of the pool
+sql_pool_min = int(os.getenv("SQL_POOL_MIN", "1"))
+sql_pool_max = int(os.getenv("SQL_POOL_MAX", "8"))
+# A query longer than this (in seconds) is printed
+sql_slow_query_secs = float(os.getenv("SQL_SLOW_QUERY_SECS", "0.5"))
+
+# ────────────────[Timing of the queries]───────────────
+# [------------------------------------------------------]
+# 1. Every query executed on a connexion of the server is timed, whatever the thread
+# 2. The timings are kept per query text (the values are parameters, so the number of texts stays small) : count, total & max
+#    execute_values sends the rows in the text itself : its literals & its list of VALUES are replaced, so a batch has one text
+# 3. They are exported on /metrics (see Phase timings & metrics)
+# [------------------------------------------------------]
+sql_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+sql_values = re.compile(r"VALUES\s*\([^()]*\)(?:\s*,\s*\([^()]*\))*")
+
+class SqlTimings:
+    def __init__(self):
+        self.queries={}
+        self.lock=threading.Lock()
+
+    def record(self,query,duration):
+        if isinstance(query,bytes):
+            query=query.decode("utf-8","replace")
+        query=sql_values.sub("VALUES (...)",sql_literal.sub("?"," ".join(str(query).split())))
+        with self.lock:
+            timing=self.queries.get(query)
+            if timing is None:
+                timing=self.queries[query]=[0,0.0,0.0]
+            timing[0]+=1
+            timing[1]+=duration
+            timing[2]=max(timing[2],duration)
+        if duration>=sql_slow_query_secs:
+            print(f"[WARNING] Slow query ({duration:.3f}s) : {query[:200]}")
+
+    # Return (query, count, total, max) sorted by total time
+    def summary(self):
+        with self.lock:
+            return sorted(((query,*timing) for query,timing in self.queries.items()),key=lambda item:item[2],reverse=True)
+
+sql_timings=SqlTimings()
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self,query,vars=None):
+        start=time.perf_counter()
+        try:
+            return super().execute(query,vars)
+        finally:
+            sql_timings.record(query,time.perf_counter()-start)
 
 # ────────────────[Connecting to the database]───────────────
 # [------------------------------------------------------]
-# 1. Connect to the database, and put the connexion index in the variable connexion_sql
-# 2. Create a cursor, used to manipulate the database, in the variable cursor_sql
-# 3. Launch the function launch_mqtt_server
+# 1. Create the pool of connexions, in the variable sql_pool
+# 2. Start the log pipeline and the status writer, and launch the function launch_mqtt_server
 # [------------------------------------------------------]
+sql_parameters = {"database":"FL", "user":"program", "host":"postgresql", "password":"program", "cursor_factory":TimedCursor}
+sql_pool = None
+# The pool raises an error when it is empty : the threads wait for a free connexion instead
+sql_pool_slots = threading.BoundedSemaphore(sql_pool_max)
+
+def open_sql_connexion():
+    return psycopg2.connect(**sql_parameters)
 
 def connect_sql():
     try:
-        global connexion_sql
-        connexion_sql = psycopg2.connect(database="FL",user="program", host="postgresql",password="program")
+        global sql_pool
+        sql_pool = ThreadedConnectionPool(sql_pool_min,sql_pool_max,**sql_parameters)
+        log_pipeline.start()
+        status_writer.start()
+        metadata_cache.start()
+        phase_recorder.start()
+        start_metrics_server()
+        sensor_archive.start()
+        data_consumer.start()
         launch_mqtt_server()
     except Exception as e:
         print("[CRITICAL ERROR] An error has been caught in the function connect_sql ("+e.__class__.__name__+") : ")
         traceback.print_exc()
         return
 
+# ────────────────[Transaction on a connexion of the pool]───────────────
+# [------------------------------------------------------]
+# 1. A connexion is borrowed from the pool (waiting if they're all used), and a cursor is given
+# 2. The transaction is committed at the end of the block, or rolled back if an exception happened
+# 3. A connexion that has been closed (database restarted) is thrown away, the pool opens a new one
+# [------------------------------------------------------]
+@contextmanager
+def sql_cursor():
+    with sql_pool_slots:
+        connexion=sql_pool.getconn()
+        try:
+            with connexion.cursor() as cursor_sql:
+                yield cursor_sql
+            connexion.commit()
+        except Exception:
+            if not connexion.closed:
+                connexion.rollback()
+            raise
+        finally:
+            sql_pool.putconn(connexion,close=bool(connexion.closed))
+
 # ────────────────[Executing a sql query]───────────────
 # [------------------------------------------------------]
-# 1. With the cursor_sql, execute the query and commit it into the database
+# 1. Execute the query with its parameters and commit it into the database
 # [------------------------------------------------------]
 def sql_execute(query, parameter=()):
     try:
-        with connexion_sql.cursor() as cursor_sql:
+        with sql_cursor() as cursor_sql:
             cursor_sql.execute(query, parameter)
-            connexion_sql.commit()
     except Exception as e:
-        connexion_sql.rollback()
+        print("[ERROR] Query failed ("+e.__class__.__name__+") : "+str(e))
 
 # ────────────────[Getting a sql result]───────────────
 # [------------------------------------------------------]
-# 1. Execute the query and get the result
+# 1. Execute the query with its parameters and get the result
 # 2. Return the result if there is only 1 result, or raise an exception
 # [------------------------------------------------------]
-def sql_get_single(query):
-    with connexion_sql.cursor() as cursor_sql:
-        cursor_sql.execute(query)
+def sql_get_single(query, parameter=()):
+    with sql_cursor() as cursor_sql:
+        cursor_sql.execute(query, parameter)
         variable=cursor_sql.fetchall() or []
-        if variable==[]:
-            return "NOT FOUND"
-        if len(variable)==1:
-            return variable[0][0]
-        elif len(variable)>1:
-            raise Exception("Multiples possibilities for query : " + str(query))
+    if variable==[]:
+        return "NOT FOUND"
+    if len(variable)==1:
+        return variable[0][0]
+    elif len(variable)>1:
+        raise Exception("Multiples possibilities for query : " + str(query))
+
+# ╔══════════════════════════════════════╗
+# ║        1bis. Metadata cache          ║
+# ╚══════════════════════════════════════╝
+# The records of the models & datasets used by the jobs, kept in memory : a turn doesn't query the database for a path.
+# The API sends a NOTIFY metadata_changed ({"type":"models"|"datasets","id":...}) when it updates or deletes a record,
+# and the record is then removed from the cache (read again at its next use).
+
+# Column of the id of each table
+metadata_id_columns = {"models": "model_id", "datasets": "dataset_id"}
+
+class MetadataRecord:
+    __slots__=("kind","id","name","path")
+
+    def __init__(self,kind,id,name,path):
+        self.kind=kind
+        self.id=id
+        self.name=name
+        self.path=path
+
+# ────────────────[Metadata cache]───────────────
+# [------------------------------------------------------]
+# 1. get : the record from the cache, or read from the database (parameterized query) and kept. None if it doesn't exist
+# 2. load_job : the model & all the datasets of a job are read at once, when the job starts
+# 3. A thread listens to metadata_changed on its own connexion. When the connexion is lost, the whole cache is cleared
+#    (a notification may have been missed)
+# [------------------------------------------------------]
+class MetadataCache:
+    def __init__(self):
+        self.records={}
+        self.lock=threading.Lock()
+        self.thread=None
+        self.hits=0
+        self.misses=0
+
+    def get(self,kind,id):
+        key=(kind,str(id))
+        with self.lock:
+            record=self.records.get(key)
+        if record is not None:
+            self.hits+=1
+            return record
+        self.misses+=1
+        records=self.load(kind,[id])
+        return records.get(str(id))
+
+    def load(self,kind,ids):
+        ids=[int(id) for id in ids]
+        column=metadata_id_columns[kind]
+        with sql_cursor() as cursor_sql:
+            cursor_sql.execute(f"SELECT {column}, name, path FROM {kind} WHERE {column} = ANY(%s);",(ids,))
+            rows=cursor_sql.fetchall()
+        records={str(row[0]):MetadataRecord(kind,str(row[0]),row[1],row[2]) for row in rows}
+        with self.lock:
+            for id,record in records.items():
+                self.records[(kind,id)]=record
+        return records
+
+    def load_job(self,job):
+        self.load("models",[job.model_id])
+        self.load("datasets",set(job.dataset_id_array))
+
+    def invalidate(self,kind,id):
+        with self.lock:
+            self.records.pop((kind,str(id)),None)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.thread=Thread(target=self.listen,daemon=True)
+            self.thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                connexion=open_sql_connexion()
+                connexion.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with connexion.cursor() as cursor_sql:
+                    cursor_sql.execute("LISTEN metadata_changed;")
+                while True:
+                    if select.select([connexion],[],[],60)==([],[],[]):
+                        continue
+                    connexion.poll()
+                    while connexion.notifies:
+                        change=json.loads(connexion.notifies.pop(0).payload)
+                        self.invalidate(change["type"],change["id"])
+            except Exception as e:
+                print("[ERROR] Metadata listener ("+e.__class__.__name__+") : "+str(e))
+                self.clear()
+                time.sleep(5)
+
+metadata_cache=MetadataCache()
+
+# ────────────────[Path of the model & of the dataset of a job]───────────────
+def job_model_path(job):
+    record=metadata_cache.get("models",job.model_id)
+    return record.path if record is not None else "NOT FOUND"
+
+def job_dataset_path(job):
+    record=metadata_cache.get("datasets",job.dataset_id)
+    return record.path if record is not None else "NOT FOUND"
 
 # ╔══════════════════════════════════════╗
 # ║    2. Handling the MQTT Connection   ║
@@ -146,6 +374,8 @@ def connect_mqtt():
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
+    # If the server dies, the broker tells the hubs through his presence topic
+    client.will_set(topic_server_presence,construct_message("ALL","OFFLINE"),qos=1,retain=True)
     return client
 
 # ────────────────[Connect to the mqtt client]───────────────
@@ -153,25 +383,22 @@ def connect_mqtt():
 # 1. Initialize the mqtt connection  : 
 # - Connect to the broker
 # - Disconnect all the user 
-# - Start the heartbeat threads
+# - Start the heartbeat threads (for every hub if the heartbeats of the application are activated, else for the old hubs only)
 # - Put itself in an infinite loop, to listen
 # - reconnect itself when there is a problem
 # [------------------------------------------------------]
 def launch_mqtt_server():
-    global client, is_initialized_model_given, input_dim, number_of_turn, mode_of_execution
+    global client, is_initialized_model_given, input_dim
     client = connect_mqtt()
     is_initialized_model_given=False
     input_dim=200
-    number_of_turn=-1
-    mode_of_execution="None"
     if os.path.exists(default_path / "logs" / "Server" / "Server.txt"):
         os.remove(default_path / "logs" / "Server" / "Server.txt")
     while True:
         try:
             if not client.is_connected():
-                client.connect(broker, port)
-                sql_execute("UPDATE hubs SET status='OFFLINE';")
-                connexion_sql.commit()
+                client.connect(broker, port, keepalive=mqtt_keepalive)
+                status_writer.reset()
                 sending_heartbeat()
                 check_heartbeat()
                 insert_logs("Connection succeeded")
@@ -192,7 +419,9 @@ def launch_mqtt_server():
 def on_connect(client, userdata, flags, rc):
     """Callback exécuté lors de la connexion au broker MQTT"""
     if rc == 0:
-        client.subscribe("#")
+        # Only the topics of the routing table (see Topic router), the sensors being read by the data consumer
+        client.subscribe([(pattern,0) for pattern in router.patterns])
+        client.publish(topic_server_presence,construct_message("ALL","ONLINE"),qos=1,retain=True)
         print(f"[INFO] Connected to MQTT Broker with client ID {client_id}!")
     else:
         print(f"[ERROR] Failed to connect, return code {rc}")
@@ -221,87 +450,295 @@ def handler_connect_user(payload_data,topic):
 def handler_connect_user_thread(payload_data,topic):
     time.sleep(1)
     #We then check for his presence in the database to see if he is registered
-    name=sql_get_single("SELECT name FROM hubs WHERE hubs.mac_address='"+payload_data[0]+"';")
+    name=sql_get_single("SELECT name FROM hubs WHERE hubs.mac_address=%s;",(payload_data[0],))
         # If he is registered, we send his name, else we send him that he isn't registered.
     if name!="NOT FOUND":
-        message= construct_message(payload_data[0],"NAME:"+name)
-        add_user(name)
+        # The answer tells the hub which version of the protocol we use, the old hubs ignore it
+        message= construct_message(payload_data[0],"NAME:"+name,"proto:"+str(protocol.VERSION))
+        add_user(name,payload_data[0],int(payload_data.get("proto") or 0),str(payload_data.get("stage"))=="1")
         result=client.publish(topic,message)
         if result[0]==0:
             insert_logs(f"[INFO] {payload_data[0]} has been recognized : {name} successfully connected")
-        if "CAPACITY" in payload_data[3]:
-            sql_execute("UPDATE hubs SET stockage='"+payload_data[3].split(":")[1].split(".")[0]+"' WHERE name='"+name[0][0]+"';")
+        if payload_data.get("CAPACITY") is not None:
+            sql_execute("UPDATE hubs SET stockage=%s WHERE name=%s;",(payload_data.get("CAPACITY").split(".")[0],name))
     else:
         message=construct_message(payload_data[0],"NOT REGISTERED IN THE DATABASE")
         result=client.publish(topic,message)
         insert_logs(f"[WARNING] {payload_data[0]} not recognized : make sure to insert it into the database.")
 
+# ────────────────[Handle the Last Will of a hub]───────────────
+# [------------------------------------------------------]
+# 1. The broker publishes the Last Will of a hub on connexion/<mac> when his connexion is lost (keepalive expired, crash...)
+# 2. If the hub is connected, his death is sent as a liveness event, like an expired heartbeat
+# 3. His retained presence is set to OFFLINE, so a server restarting doesn't see him online
+# [------------------------------------------------------]
+def handler_hub_offline(payload_data):
+    mac=payload_data[0]
+    record=registry.get_by_mac(mac)
+    client.publish("presence/"+mac,construct_message(mac,"OFFLINE"),qos=1,retain=True)
+    if record is not None:
+        heartbeat_monitor.expire(record.name)
+
 
 # ╔══════════════════════════════════════╗
 # ║         4. Handling the users        ║
 # ╚══════════════════════════════════════╝
 
-#We create a user class that contains the name and the status
-class User:
-    def __init__(self,name):
+# ────────────────[Record of a connected hub]───────────────
+# [------------------------------------------------------]
+# 1. A record contains the name, the status, the last heartbeat, the job and the part the hub is working on
+# 2. It also keeps the throughput of the hub : number of parts treated and time spent working on them
+# 3. proto is the version of the protocol given by the hub (0 : legacy text only)
+# [------------------------------------------------------]
+class HubRecord:
+    __slots__=("name","mac","status","last_heartbeat","job","part","tasks_done","busy_time","task_start","proto","stage")
+
+    def __init__(self,name,mac=None):
         self.name=name
+        self.mac=mac
         self.status="ONLINE"
+        self.last_heartbeat=time.time()
+        self.job=None
+        self.part=None
+        self.tasks_done=0
+        self.busy_time=0.0
+        self.task_start=None
+        self.proto=0
+        # The hub handles STAGE JOB (see Staging the turn)
+        self.stage=False
+
+    def start_task(self):
+        self.task_start=time.time()
+
+    def finish_task(self):
+        if self.task_start is not None:
+            self.busy_time+=time.time()-self.task_start
+            self.tasks_done+=1
+            self.task_start=None
+
+    # Average time spent on a part (None if the hub never finished one)
+    def seconds_per_task(self):
+        if self.tasks_done==0:
+            return None
+        return self.busy_time/self.tasks_done
+
+# ────────────────[Registry of the connected hubs]───────────────
+# [------------------------------------------------------]
+# 1. The records are kept in a dictionary indexed by the name of the hub, so every lookup is O(1)
+# 2. A second index on the MAC address is used for the messages of the broker (Last Will)
+# 3. The lock only protects the insertion and the removal, a record being modified in place
+# [------------------------------------------------------]
+class HubRegistry:
+    def __init__(self):
+        self.records={}
+        self.by_mac={}
+        self.lock=threading.Lock()
+
+    def __contains__(self,name):
+        return name in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self,name):
+        return self.records.get(name)
+
+    def get_by_mac(self,mac):
+        return self.by_mac.get(mac)
+
+    def names(self):
+        return list(self.records)
+
+    def all(self):
+        return list(self.records.values())
+
+    # Return the record of the hub, and True if he has just been added
+    def add(self,name,mac=None):
+        with self.lock:
+            record=self.records.get(name)
+            if record is None:
+                record=HubRecord(name,mac)
+                self.records[name]=record
+                is_new=True
+            else:
+                is_new=False
+            if mac is not None:
+                if record.mac is not None:
+                    self.by_mac.pop(record.mac,None)
+                record.mac=mac
+                self.by_mac[mac]=record
+            return record,is_new
+
+    def remove(self,name):
+        with self.lock:
+            record=self.records.pop(name,None)
+            if record is not None and record.mac is not None:
+                self.by_mac.pop(record.mac,None)
+            return record
+
+registry=HubRegistry()
 
 # ────────────────[Check if the user is connected]───────────────
 def is_user_connected(name):
-    for user in user_array:
-        if user.name==name:
-            return True
-    return False
+    return name in registry
 
 # ────────────────[Check if the user status]───────────────
 def get_user_status(name):
-    for user in user_array:
-        if user.name==name:
-            return user.status
+    record=registry.get(name)
+    if record is not None:
+        return record.status
 
 # ────────────────[Update the status of someone]───────────────
 def update_user_status(name,status):
-    for user in user_array:
-        if user.name==name:
-            user.status=status
-            sql_execute("UPDATE hubs SET status='"+status+"' WHERE name='"+name+"';")
-            break
+    record=registry.get(name)
+    if record is not None:
+        record.status=status
+        status_writer.set(name,status)
+
+# ────────────────[Remember the part given to a user]───────────────
+def set_user_part(name,part):
+    record=registry.get(name)
+    if record is not None:
+        record.part=part
 
 # ────────────────[Disconnect a user]───────────────
 def user_disconnected(name):
-    i=0
-    for user in user_array:    
-        if user.name==name:
-            user_array.remove(user)
-            sql_execute("UPDATE hubs SET status='OFFLINE' WHERE name='"+name+"';")
-            del last_hb_user[i]
-            break
-        else:
-            i+=1
+    heartbeat_monitor.forget(name)
+    record=registry.remove(name)
+    if record is not None:
+        status_writer.set(name,"OFFLINE")
+        if record.job is not None:
+            phase_barrier_hub_lost(record.job,name)
+
+# ────────────────[Job of a hub]───────────────
+# Return the job in progress the hub belongs to (None if he isn't in any)
+def job_of_hub(name):
+    with jobs_lock:
+        for job in jobs.values():
+            if any(hub[0]==name for hub in job.hubs):
+                return job
+    return None
 
 # ────────────────[Add an user]───────────────
 # [------------------------------------------------------]
-# 1. We create an user, and try to see if name is already connected
-# 2.If he is already connected, we just update him
-# 3. Else, we add him in the user list and update it
-# [------------------------------------------------------]
-def add_user(name):
-    user = User(name)
-    k=True
-    for i in range(0,len(user_array)):
-        if user_array[i].name==name:
-            last_hb_user[i]=1
-            update_user_status(name,"ONLINE")
-            k=False
-    if k:
-        user_array.append(user)
-        last_hb_user.append(1)
-        sql_execute("UPDATE hubs SET status='ONLINE' WHERE name='"+name+"';")
+# 1. We add the user in the registry, or get his record if he is already connected
+# 2. If he is already connected, we just refresh his heartbeat and update him
+# 3. Else, his status is written in the database by the status writer
+#    A hub reconnecting during a job he still belongs to gets back his job (and the part he was given)
+# [------------------------------------------------------]
+def add_user(name,mac=None,proto=0,stage=False):
+    record,is_new=registry.add(name,mac)
+    record.proto=proto
+    record.stage=stage
+    if uses_app_heartbeats(record):
+        heartbeat_monitor.beat(name)
+    if is_new:
+        record.job=job_of_hub(name)
+        if record.job is not None:
+            record.part=next((dataset[0] for dataset in record.job.list_dataset if dataset[1]==name),None)
+        status_writer.set(name,"ONLINE")
+    else:
+        record.last_heartbeat=time.time()
+        update_user_status(name,"ONLINE")
+
+# ╔══════════════════════════════════════╗
+# ║      4bis. Persisting the status     ║
+# ╚══════════════════════════════════════╝
+# The status in the registry is the authoritative one : the database is only a copy, written behind.
+# Time between two writes of the statuses (in seconds)
+status_flush_secs = float(os.getenv("STATUS_FLUSH_SECS", "1"))
+# Maximum number of statuses in a single notification (the payload of a NOTIFY is limited to 8000 bytes)
+status_notify_chunk = 100
+
+# ────────────────[Status writer]───────────────
+# [------------------------------------------------------]
+# 1. A change of status only replaces the pending status of the hub : only the last one of an interval is written
+# 2. Every status_flush_secs, the pending statuses are written with a single UPDATE, on a connexion used only by the writer
+# 3. In the same transaction, a NOTIFY hub_status is sent with the new statuses ({"name":"status",...}),
+#    so the API (or anything listening) sees them as soon as they are committed
+# 4. If the write fails, the statuses are put back in pending (unless a newer one arrived meanwhile)
+# [------------------------------------------------------]
+class StatusWriter:
+    def __init__(self,interval):
+        self.interval=interval
+        self.pending={}
+        self.lock=threading.Lock()
+        self.connexion=None
+        self.thread=None
+        self.stopping=threading.Event()
+        self.flushes=0
+        self.written=0
+
+    def set(self,name,status):
+        with self.lock:
+            self.pending[name]=status
+
+    # Put every hub OFFLINE in the database (notified as {"*":"OFFLINE"}), then write again the status of the connected hubs
+    def reset(self):
+        with self.lock:
+            self.pending={}
+            try:
+                with sql_cursor() as cursor_sql:
+                    cursor_sql.execute("UPDATE hubs SET status='OFFLINE';")
+                    cursor_sql.execute("SELECT pg_notify('hub_status',%s);",(json.dumps({"*":"OFFLINE"}),))
+            except Exception as e:
+                print("[ERROR] The statuses couldn't be reset ("+e.__class__.__name__+") : "+str(e))
+            for record in registry.all():
+                self.pending[record.name]=record.status
+
+    def start(self):
+        if self.thread is None:
+            self.thread=Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            statuses,self.pending=self.pending,{}
+        try:
+            if self.connexion is None or self.connexion.closed:
+                self.connexion=open_sql_connexion()
+            rows=list(statuses.items())
+            with self.connexion.cursor() as cursor_sql:
+                execute_values(cursor_sql,"UPDATE hubs SET status=v.status FROM (VALUES %s) AS v(name,status) WHERE hubs.name=v.name",rows)
+                for i in range(0,len(rows),status_notify_chunk):
+                    cursor_sql.execute("SELECT pg_notify('hub_status',%s);",(json.dumps(dict(rows[i:i+status_notify_chunk])),))
+            self.connexion.commit()
+            self.flushes+=1
+            self.written+=len(rows)
+        except Exception as e:
+            print("[ERROR] "+str(len(statuses))+" statuses couldn't be written in the database ("+e.__class__.__name__+") : "+str(e))
+            try:
+                self.connexion.rollback()
+            except Exception:
+                self.connexion=None
+            with self.lock:
+                for name,status in statuses.items():
+                    self.pending.setdefault(name,status)
+
+status_writer=StatusWriter(status_flush_secs)
 
 # ╔══════════════════════════════════════╗
 # ║             5. Heartbeats            ║
 # ╚══════════════════════════════════════╝
+# Time between two heartbeats of a hub, and the grace window before a late hub is considered dead (in seconds)
+heartbeat_interval = float(os.getenv("HEARTBEAT_INTERVAL_SECS", "15"))
+heartbeat_grace = float(os.getenv("HEARTBEAT_GRACE_SECS", "6"))
+
+# A hub that didn't advertise the protocol has no Last Will, and thinks the server is dead without heartbeats
+def uses_app_heartbeats(record):
+    return app_heartbeats or record.proto<protocol.VERSION
 
 # ────────────────[Start the sending HB thread]───────────────
 def sending_heartbeat():
@@ -311,9 +748,11 @@ def sending_heartbeat():
 # ────────────────[Sending HB thread]───────────────
 def sending_heartbeat_thread():
     while True:
-        time.sleep(15)
-        for user in user_array:
-            heartbeat_request(user.name)
+        time.sleep(heartbeat_interval)
+        for name in registry.names():
+            record=registry.get(name)
+            if record is not None and uses_app_heartbeats(record):
+                heartbeat_request(name)
 
 # ────────────────[Send the heartbeat message]───────────────
 def heartbeat_request(user):
@@ -321,158 +760,697 @@ def heartbeat_request(user):
     topic = "hubs/"+user+"/logs"
     client.publish(topic,message)
 
-# ────────────────[Update Heartbeat array]───────────────
+# ────────────────[Heartbeat monitor]───────────────
+# [------------------------------------------------------]
+# 1. Each hub has a deadline : the time of his last heartbeat + the interval + the grace window
+# 2. The deadlines are kept in a min-heap, so a single thread only sleeps until the closest one
+# 3. When a deadline is passed, exactly the hubs concerned are expired, and a liveness event is sent to the listeners
+# 4. A new heartbeat pushes a new deadline, the old one staying in the heap until it is popped and ignored
+# [------------------------------------------------------]
+class HeartbeatMonitor:
+    def __init__(self,timeout):
+        self.timeout=timeout
+        self.heap=[]
+        self.deadlines={}
+        self.listeners=[]
+        self.condition=threading.Condition()
+        self.thread=None
+
+    # The listeners are called with (name, alive) whenever a hub appears or expires
+    def add_listener(self,listener):
+        self.listeners.append(listener)
+
+    def beat(self,name):
+        with self.condition:
+            is_new=name not in self.deadlines
+            deadline=time.monotonic()+self.timeout
+            self.deadlines[name]=deadline
+            heapq.heappush(self.heap,(deadline,name))
+            if self.heap[0][1]==name:
+                self.condition.notify()
+        if is_new:
+            self.publish(name,True)
+
+    def forget(self,name):
+        with self.condition:
+            self.deadlines.pop(name,None)
+
+    # The hub is known to be dead without waiting for his deadline (Last Will received)
+    def expire(self,name):
+        self.forget(name)
+        self.publish(name,False)
+
+    def publish(self,name,alive):
+        for listener in self.listeners:
+            try:
+                listener(name,alive)
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        if self.thread is None:
+            self.thread=Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            expired=[]
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                now=time.monotonic()
+                while self.heap and self.heap[0][0]<=now:
+                    deadline,name=heapq.heappop(self.heap)
+                    # >>> An older deadline of a hub that sent a heartbeat since, we ignore it
+                    if self.deadlines.get(name)!=deadline:
+                        continue
+                    del self.deadlines[name]
+                    expired.append(name)
+                if not expired and self.heap:
+                    self.condition.wait(self.heap[0][0]-now)
+            for name in expired:
+                self.publish(name,False)
+
+heartbeat_monitor=HeartbeatMonitor(heartbeat_interval+heartbeat_grace)
+
+# ────────────────[Update the heartbeat of a hub]───────────────
 def update_heartbeat(name):
-    i=0
-    for user in user_array:
-        if user.name==name:
-            last_hb_user[i]=1
-        else:
-            i+=1
+    record=registry.get(name)
+    if record is not None:
+        record.last_heartbeat=time.time()
+        if uses_app_heartbeats(record):
+            heartbeat_monitor.beat(name)
 
-# ────────────────[Start the receiving HB thread]───────────────
+# ────────────────[Liveness event of a hub]───────────────
+def hub_liveness_changed(name,alive):
+    if not alive and is_user_connected(name):
+        insert_logs(f"[WARNING] Death of client {name}")
+        user_disconnected(name)
+
+heartbeat_monitor.add_listener(hub_liveness_changed)
+
+# ────────────────[Start the heartbeat monitor]───────────────
 def check_heartbeat():
-    t=Thread(target=check_heartbeat_thread)
-    t.start()
+    heartbeat_monitor.start()
 
-# ────────────────[Receiving HB thread]───────────────
+# ╔══════════════════════════════════════╗
+# ║          5bis. Phase barrier         ║
+# ╚══════════════════════════════════════╝
+# Each phase of a turn (datasets, models, weight, execution) waits for all the active hubs of the job.
+# The barrier is signaled directly by on_message_commands, so the next phase starts as soon as the last hub reported.
+
+# Deadline (in seconds) of a download phase, and of the execution phase (0 = no deadline)
+phase_deadline = float(os.getenv("PHASE_DEADLINE_SECS", "300"))
+execution_deadline = float(os.getenv("EXECUTION_DEADLINE_SECS", "0"))
+
+# Lock protecting the barriers of the jobs (each job keeps the barrier of its phase in progress in job.barrier)
+barrier_lock = threading.RLock()
+
+class PhaseBarrier:
+    def __init__(self,job,name,done_status,on_complete,on_arrival=None):
+        self.job=job
+        self.name=name
+        self.done_status=done_status
+        self.on_complete=on_complete
+        self.on_arrival=on_arrival
+        self.pending=set()
+        self.closed=False
+        self.timer=None
+        # Status of the job if it must be ended : end_job is called once barrier_lock is released
+        self.end_status=None
+        # Time of the opening, and of each hub reporting (see Phase timings & metrics)
+        self.opened=time.time()
+        self.arrivals=[]
+
+    # ────────────────[Close the barrier if no hub is pending]───────────────
+    def try_close(self):
+        if self.closed or self.pending:
+            return False
+        self.close()
+        phase_barrier_closed(self)
+        return True
+
+    def close(self):
+        self.closed=True
+        if self.timer is not None:
+            self.timer.cancel()
+
+# ────────────────[Open the barrier of a phase]───────────────
 # [------------------------------------------------------]
-# 1. At the start, we empty the late_connexion array (user who are late to connect) and last_hb_user, the array of the heartbeat signal
-# 2. After 15 seconds, we check the heartbeat signal and, for each 0, we add the user in the late_connexion array
-# 3. If atleast one user is late, we recheck if he is connecting 3 times, every 2 seconds
-# 4. If the late_connexion has still user after that, we consider the client dead and remove it from the user list
+# 1. Every hub of the job that hasn't already reported is pending
+# 2. A hub that isn't connected anymore is handled as a lost hub
+# 3. A timer is started for the deadline, and the barrier is checked in case every hub already reported
 # [------------------------------------------------------]
-def check_heartbeat_thread():
-    global last_hb_user
-    while True:
-        late_connexion=[]
-        for i in range(len(last_hb_user)):
-            last_hb_user[i]=0
-        time.sleep(15)
-        for i in range(len(last_hb_user)):
-            if last_hb_user[i]==0:
-                late_connexion.append(user_array[i].name)
-        if late_connexion!=[]:
-            for _ in range(3):
-                time.sleep(2)
-                for k in range(len(last_hb_user)):
-                    if user_array[k].name in late_connexion and last_hb_user[k]==1:
-                        for i in range(len(late_connexion)):
-                            if late_connexion[i]==user_array[k].name:
-                                del late_connexion[i]
-                                break
-            if late_connexion!=[]:
-                for username in late_connexion:
-                    for user in user_array:
-                        if user.name==username:
-                            insert_logs(f"[WARNING] Death of client {user.name}")
-                            user_disconnected(user.name)
+def open_phase_barrier(job,name,done_status,on_complete,deadline=0,on_arrival=None):
+    barrier=PhaseBarrier(job,name,done_status,on_complete,on_arrival)
+    with barrier_lock:
+        if job.barrier is not None:
+            job.barrier.close()
+        job.barrier=barrier
+        lost=[]
+        for hub in job.hubs:
+            if not is_user_connected(hub[0]):
+                lost.append(hub[0])
+            elif get_user_status(hub[0]) not in done_status:
+                barrier.pending.add(hub[0])
+        for hub_name in lost:
+            if not hub_lost_during_phase(barrier,hub_name):
+                break
+        if barrier.end_status is None and deadline>0:
+            barrier.timer=threading.Timer(deadline,phase_deadline_reached,args=(barrier,))
+            barrier.timer.daemon=True
+            barrier.timer.start()
+        complete=barrier.try_close()
+    after_phase_barrier(barrier,complete)
+
+# ────────────────[A hub reported to the barrier]───────────────
+def signal_phase_barrier(job,name):
+    with barrier_lock:
+        barrier=job.barrier
+        if barrier is None or barrier.closed or name not in barrier.pending:
+            return
+        if get_user_status(name) not in barrier.done_status:
+            return
+        barrier.pending.discard(name)
+        phase_barrier_arrival(barrier,name)
+        if barrier.on_arrival is not None:
+            barrier.on_arrival(job,name)
+        complete=barrier.try_close()
+    after_phase_barrier(barrier,complete)
+
+# ────────────────[A hub disconnected during the phase]───────────────
+def phase_barrier_hub_lost(job,name):
+    with barrier_lock:
+        barrier=job.barrier
+        if barrier is None or barrier.closed or name not in barrier.pending:
+            return
+        hub_lost_during_phase(barrier,name)
+        complete=barrier.try_close()
+    after_phase_barrier(barrier,complete)
+
+# ────────────────[The deadline of the phase is reached]───────────────
+def phase_deadline_reached(barrier):
+    with barrier_lock:
+        if barrier is not barrier.job.barrier or barrier.closed:
+            return
+        for name in list(barrier.pending):
+            insert_logs(f"[WARNING] {name} didn't report before the deadline of the phase {barrier.name}.",job=barrier.job)
+            if not hub_lost_during_phase(barrier,name):
+                break
+        complete=barrier.try_close()
+    after_phase_barrier(barrier,complete)
+
+# ────────────────[After barrier_lock is released]───────────────
+# The job is ended (SQL, files...) or the next phase is started outside of the lock
+def after_phase_barrier(barrier,complete):
+    if barrier.end_status is not None:
+        end_job(barrier.job,barrier.end_status)
+    elif complete:
+        barrier.on_complete(barrier.job)
+
+# ────────────────[Handling a lost hub]───────────────
+# [------------------------------------------------------]
+# 1. Classic mode : we remove the hub from the active hub list and free his dataset (another hub can steal it). If he was the last one, the job is over
+# 2. Class mode : since one user is down, we totally stop the job
+# 3. Return False if the job is over : the barrier is then closed, and the job is ended by after_phase_barrier
+# [------------------------------------------------------]
+def hub_lost_during_phase(barrier,name):
+    job=barrier.job
+    barrier.pending.discard(name)
+    job.stealing_hubs.discard(name)
+    if not job.typeOfSelection:
+        for dataset in job.list_dataset:
+            if dataset[1]==name:
+                dataset[1]="None"
+                break
+        for hub in job.hubs:
+            if hub[0]==name:
+                job.hubs.remove(hub)
+                break
+        insert_logs(f"[INFO] {name} removed due to inactivity. Continuing without it.",job=job)
+        if len(job.hubs)==0:
+            # >>> No more active hub, so we stop the job
+            insert_logs("[ERROR] No more users active left. End of the start program.",job=job)
+            barrier.close()
+            barrier.end_status="ERROR"
+            return False
+        return True
+    else:
+        insert_logs("[ERROR] One user disconnected. End of the start program.",job=job)
+        barrier.close()
+        barrier.end_status="ERROR"
+        return False
 
 # ╔══════════════════════════════════════╗
 # ║         6. Handling messages         ║
 # ╚══════════════════════════════════════╝
 
-# ────────────────[Check the topic]───────────────
+# ────────────────[Topic router]───────────────
 # [------------------------------------------------------]
-# 1. Check if the topic correspond to the goodTopic
-# 2. The "*" can be used to be a wildcard (design everything)
-# [------------------------------------------------------]   
-def check_if_right_topic(topic, goodTopic):
-    topic_split=topic.split("/")
-    goodTopic_split=goodTopic.split("/")
-    if len(topic_split)==len(goodTopic_split):
-        for i in range(len(topic_split)):
-            if topic_split[i]==goodTopic_split[i] or goodTopic_split[i]=="*":
-                if i==len(topic_split)-1:
-                    return True
-                else:
-                    continue
-            else:
-                break
-    return False
+# 1. The routing table is compiled once in a trie : one level per part of the topic, "+" matching any part and "#" the rest
+# 2. A topic is split once, then the trie is walked (an exact part is tried before "+", then "#")
+# 3. The patterns of the table are the subscriptions of the server : he doesn't receive the topics he doesn't handle
+# [------------------------------------------------------]
+class TopicRouter:
+    def __init__(self):
+        self.root={}
+        self.patterns=[]
+
+    def add(self,pattern,handler):
+        node=self.root
+        for part in pattern.split("/"):
+            node=node.setdefault(part,{})
+        node[None]=handler
+        self.patterns.append(pattern)
+
+    def match(self,topic):
+        return self.walk(self.root,topic.split("/"),0)
+
+    def walk(self,node,parts,index):
+        if index==len(parts):
+            handler=node.get(None)
+            if handler is None and "#" in node:
+                handler=node["#"].get(None)
+            return handler
+        for key in (parts[index],"+"):
+            child=node.get(key)
+            if child is not None:
+                handler=self.walk(child,parts,index+1)
+                if handler is not None:
+                    return handler
+        child=node.get("#")
+        return child.get(None) if child is not None else None
+
+# ────────────────[Handlers of the topics]───────────────
+# >>> Connexion of a hub, or his Last Will
+def route_connexion(payload_data,topic):
+    if payload_data[2]=="Asking for connexion":
+        handler_connect_user(payload_data,topic)
+    elif payload_data[2]=="OFFLINE":
+        handler_hub_offline(payload_data)
+
+# >>> Intern message : the start message of the API, or the next step of a job
+def route_internal(payload_data,topic):
+    if payload_data[0]=="1" and payload_data[2]=="START":
+        received_start_message_server(payload_data)
+    elif payload_data[0]=="0":
+        received_instruction_message_from_server(payload_data)
+
+# >>> Messages of a hub : only from a connected hub
+def route_hub_commands(payload_data,topic):
+    if is_user_connected(payload_data[0]) or payload_data[0]=="1":
+        on_message_commands(payload_data)
+
+def route_hub_metrics(payload_data,topic):
+    if is_user_connected(payload_data[0]) or payload_data[0]=="1":
+        on_message_metrics(payload_data)
+
+def route_hub_logs(payload_data,topic):
+    if is_user_connected(payload_data[0]) or payload_data[0]=="1":
+        if payload_data[2]=="HEARTBEAT":
+            update_heartbeat(payload_data[0])
+        else:
+            on_message_logs(payload_data)
+
+router=TopicRouter()
+router.add("connexion/+",route_connexion)
+router.add("Data/Server",route_internal)
+router.add("hubs/+/commands",route_hub_commands)
+router.add("hubs/+/metrics",route_hub_metrics)
+router.add("hubs/+/logs",route_hub_logs)
 
 # ────────────────[Redefining on_message]───────────────
 # [------------------------------------------------------]
 # 1. Redefining on_message to handle the protocol of communication
-# 2. Handle the differents topics via message made with construct_message
+# 2. The message is given to the handler of his topic (see Topic router)
 # [------------------------------------------------------]           
 def on_message(client,userdata,message):
-    # >>> Extracting the data and the topic
-    payload_data,topic = re.findall(r"\[(.*?)\]",str(message.payload.decode("utf-8"))), str(message.topic)
-    # >>> Checking if the message is for us
-    print(str(len(payload_data)) + " avec "+ payload_data[1] + " qui doit correspondre à 0")
-    if len(payload_data)>0 and payload_data[1]==client_id:
-        # >>> Connexion part
-        if check_if_right_topic(topic,"connexion/*") and payload_data[2]=="Asking for connexion":
-            handler_connect_user(payload_data,topic)
-        # >>> Intern message
-        elif check_if_right_topic(topic,"Data/Server"):
-            if payload_data[0]=="1" and payload_data[2]=="START":
-                # >>> Start message : getting all the instructions
-                received_start_message_server(payload_data)
-            elif payload_data[0]=="0":
-                # >>> Going to another step
-                received_instruction_message_from_server(payload_data)
-        elif is_user_connected(payload_data[0]) or payload_data[0]=="1":
-                # >>> Got an update on a command
-                if check_if_right_topic(topic,"*/*/commands"):
-                    on_message_commands(payload_data)
-                # >>> Got a metric
-                elif check_if_right_topic(topic,"*/*/metrics"):
-                    on_message_metrics(payload_data)
-                # >>> Got a log
-                elif check_if_right_topic(topic,"*/*/logs"):
-                    # >>> Heartbeat log
-                    if payload_data[2]=="HEARTBEAT":
-                        update_heartbeat(payload_data[0])
-                    # >>> Normal log
-                    else:
-                        on_message_logs(str(message.payload.decode("utf-8")))
-        elif payload_data[2]=="Sending Data" and check_if_right_topic(topic,"Data"):
-            # We want to save the data that is sent on that link
-            save_data_locally(payload_data)
+    # >>> Extracting the data (decoded once, binary or legacy text, see protocol.py) and the topic
+    try:
+        payload_data,topic = protocol.decode(message.payload), str(message.topic)
+    except protocol.ProtocolError as e:
+        print("Message not recognized ("+str(e)+") on "+str(message.topic))
+        return
+    # >>> Checking if the message is for us (we also receive our own messages to the hubs)
+    if payload_data is None or payload_data[1]!=client_id:
+        return
+    handler=router.match(topic)
+    if handler is not None:
+        handler(payload_data,topic)
     else:
-        print("Message not recognized :"+str(message.payload.decode("utf-8")))
+        print("Message not recognized :"+str(payload_data))
 
-def extract_field(s, name):
-    try:
-        return s.split(f"{name}:")[1].split("|")[0]
-    except:
-        return None
+# ────────────────[Data consumer]───────────────
+# [------------------------------------------------------]
+# 1. The messages of the sensors (topic Data) are read by a second mqtt client, with his own network thread
+# 2. The orchestrator doesn't receive them anymore : a busy site doesn't slow down the jobs
+# 3. DATA_CONSUMER=0 doesn't start it (the sensors are still stored in the database by the Sensor Ingestor)
+# [------------------------------------------------------]
+data_consumer_enabled = os.getenv("DATA_CONSUMER", "1")=="1"
+data_topic = "Data"
+
+class DataConsumer:
+    def __init__(self):
+        self.client=None
+
+    def start(self):
+        if not data_consumer_enabled or self.client is not None:
+            return
+        self.client=mqtt_client.Client(client_id="server-data-"+uuid.uuid4().hex[:8])
+        self.client.on_connect=self.on_connect
+        self.client.on_message=self.on_message
+        self.client.connect_async(broker, port, keepalive=mqtt_keepalive)
+        # The network thread of paho reconnects the client by himself
+        self.client.loop_start()
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.client=None
+
+    def on_connect(self,client,userdata,flags,rc):
+        if rc==0:
+            client.subscribe(data_topic)
+        else:
+            print(f"[ERROR] Data consumer failed to connect, return code {rc}")
+
+    def on_message(self,client,userdata,message):
+        try:
+            payload_data=protocol.decode(message.payload)
+        except protocol.ProtocolError:
+            return
+        if payload_data is not None and payload_data[1]==client_id and payload_data[2]=="Sending Data":
+            # We want to save the data that is sent on that link
+            save_data_locally(payload_data)
 
+data_consumer=DataConsumer()
 
 def save_data_locally(payload_data):
-    sensor = extract_field(payload_data[3], "sensor")
-    value = extract_field(payload_data[3], "value")
+    sensor = payload_data.get("sensor")
+    value = payload_data.get("value")
 
-    place = extract_field(payload_data[3], "place")
-    person = extract_field(payload_data[3], "person")
-    path = extract_field(payload_data[3], "path")
+    place = payload_data.get("place")
+    person = payload_data.get("person")
+    path = payload_data.get("path")
 
     ts = datetime.now()
     date = ts.strftime("%Y-%m-%d")
-    ts_str = ts.strftime("%d/%m/%Y %H:%M:%S")
 
+    # The row is written by the archive writer, not by the thread of the messages (see Sensor archive)
     if path:
-        csv_path = default_path / "Data" / path
+        # >>> The sensor chose its file : always a CSV file
+        sensor_archive.put(default_path / "Data" / path, [payload_data[0], sensor, value, ts.strftime("%d/%m/%Y %H:%M:%S"), place, person], end_of_segment(ts,"day"))
+    elif archive_format=="parquet":
+        segment_name = ts.strftime("%H")+".parquet" if archive_segment=="hour" else "data.parquet"
+        sensor_archive.put(default_path / "Data" / date / payload_data[0] / str(sensor) / segment_name, [payload_data[0], sensor, value, ts, place, person], end_of_segment(ts,archive_segment))
     else:
-        csv_path = default_path / "Data" / date / payload_data[0] / sensor / "data.csv"
-
-    csv_path.parent.mkdir(parents=True, exist_ok=True)
+        sensor_archive.put(default_path / "Data" / date / payload_data[0] / str(sensor) / "data.csv", [payload_data[0], sensor, value, ts.strftime("%d/%m/%Y %H:%M:%S"), place, person], end_of_segment(ts,"day"))
 
-    new_file = not csv_path.exists()
-
-    with open(csv_path, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        if new_file:
-            w.writerow(["host", "sensor", "value", "timestamp", "place", "person"])
-        w.writerow([payload_data[0], sensor, value, ts_str, place, person])
+# ────────────────[Sensor archive]───────────────
+# [------------------------------------------------------]
+# 1. The rows are put in a bounded queue (a row is dropped if the queue is full) and written by a background thread
+# 2. The writer keeps the files opened (LRU of archive_max_open_files handles), and writes the rows by batches
+#    The header is written when a file is created (empty when opened)
+# 3. When its segment (day or hour) is over, a file is closed. A CSV file unused for archive_idle_secs is closed too
+# 4. ARCHIVE_FORMAT=parquet : each segment is a compressed Parquet file, with the timestamp & the value typed,
+#    and the host & sensor kept once in the metadata of the file (see archive_reader.py to read them)
+#    A Parquet segment stays opened until its end (neither idle nor LRU close), else it would be cut in small files
+# [------------------------------------------------------]
+archive_queue_size = int(os.getenv("ARCHIVE_QUEUE_SIZE", "10000"))
+archive_batch_size = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+archive_flush_secs = float(os.getenv("ARCHIVE_FLUSH_SECS", "1"))
+archive_max_open_files = int(os.getenv("ARCHIVE_MAX_OPEN_FILES", "64"))
+archive_idle_secs = float(os.getenv("ARCHIVE_IDLE_SECS", "60"))
+archive_header = ["host", "sensor", "value", "timestamp", "place", "person"]
+
+# Format of the archive (csv or parquet), segment of a Parquet file (hour or day)
+archive_format = os.getenv("ARCHIVE_FORMAT", "csv").lower()
+archive_segment = os.getenv("ARCHIVE_SEGMENT", "hour").lower()
+archive_compression = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+archive_row_group = int(os.getenv("ARCHIVE_ROW_GROUP", "10000"))
+
+if archive_format=="parquet":
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        parquet_schema=pa.schema([
+            ("timestamp",pa.timestamp("ms")),
+            ("value",pa.float64()),
+            ("value_text",pa.string()),
+            ("place",pa.string()),
+            ("person",pa.string()),
+        ])
+    except ImportError:
+        print("[WARNING] ARCHIVE_FORMAT=parquet needs pyarrow (pip install pyarrow). The sensor archive stays in CSV.")
+        archive_format="csv"
+
+# End (epoch) of the day or of the hour of a timestamp
+def end_of_segment(ts,segment):
+    start=ts.replace(minute=0,second=0,microsecond=0)
+    if segment=="day":
+        start=start.replace(hour=0)
+        return start.timestamp()+86400
+    return start.timestamp()+3600
+
+class ArchiveFile:
+    __slots__=("file","writer","until","last_used")
+    # Closed by the LRU or when idle
+    pinned=False
+
+    def __init__(self,csv_path,until):
+        csv_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file=open(csv_path, "a", newline="", encoding="utf-8")
+        self.writer=csv.writer(self.file)
+        if self.file.tell()==0:
+            self.writer.writerow(archive_header)
+        self.until=until
+        self.last_used=time.monotonic()
+
+    def write(self,row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# ────────────────[Parquet segment]───────────────
+# [------------------------------------------------------]
+# 1. The rows are kept in columns, and written as a row group of archive_row_group rows (with its min/max statistics)
+# 2. A Parquet file can't be appended : if the file of the segment already exists (restart, rows arriving after its end),
+#    the rows go in the next file <segment>.1.parquet, <segment>.2.parquet...
+# 3. The file is only readable once closed, so at the end of its segment. Until then, every row is also appended
+#    to <file>.parquet.journal (CSV), flushed like the CSV archive : after a crash, it is turned into the Parquet file
+#    at the next start (see recover_parquet_journals). The journal is deleted once the Parquet file is closed
+# [------------------------------------------------------]
+class ParquetSegment:
+    __slots__=("path","writer","columns","host","sensor","until","last_used","journal","journal_writer")
+    # Only closed at the end of its segment
+    pinned=True
+
+    def __init__(self,path,until,journal=True):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        stem=path.name[:-len(".parquet")]
+        number=0
+        while path.exists() or (journal and journal_path(path).exists()):
+            number+=1
+            path=path.with_name(f"{stem}.{number}.parquet")
+        self.path=path
+        self.writer=None
+        self.columns={"timestamp":[],"value":[],"value_text":[],"place":[],"person":[]}
+        self.host=None
+        self.sensor=None
+        self.until=until
+        self.last_used=time.monotonic()
+        self.journal=open(journal_path(path), "w", newline="", encoding="utf-8") if journal else None
+        self.journal_writer=csv.writer(self.journal) if journal else None
+
+    def write(self,row):
+        host,sensor,value,ts,place,person=row
+        if self.host is None:
+            self.host,self.sensor=str(host),str(sensor)
+        if self.journal_writer is not None:
+            self.journal_writer.writerow([host,sensor,value,ts.isoformat(),place,person])
+        # >>> The value is a number most of the time, the text is only kept when it isn't
+        try:
+            number=float(value)
+            text=None
+        except (TypeError,ValueError):
+            number=None
+            text=None if value is None else str(value)
+        self.columns["timestamp"].append(ts)
+        self.columns["value"].append(number)
+        self.columns["value_text"].append(text)
+        self.columns["place"].append(place)
+        self.columns["person"].append(person)
+        if len(self.columns["timestamp"])>=archive_row_group:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.columns["timestamp"]:
+            return
+        table=pa.Table.from_pydict(self.columns,schema=parquet_schema)
+        if self.writer is None:
+            schema=parquet_schema.with_metadata({"host":self.host,"sensor":self.sensor})
+            self.writer=pq.ParquetWriter(str(self.path),schema,compression=archive_compression,use_dictionary=["place","person","value_text"])
+        self.writer.write_table(table)
+        for column in self.columns.values():
+            column.clear()
+
+    # The rows stay in memory until the row group is full (a row group per flush would make the statistics useless) :
+    # the journal keeps them on disk meanwhile
+    def flush(self):
+        if self.journal is not None:
+            self.journal.flush()
+
+    def close(self):
+        self.write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+        if self.journal is not None:
+            self.journal.close()
+            journal_path(self.path).unlink(missing_ok=True)
+
+def journal_path(path):
+    return path.with_name(path.name+".journal")
+
+# ────────────────[Recovery of the Parquet segments]───────────────
+# [------------------------------------------------------]
+# 1. A journal left means the server stopped before the end of its segment : its Parquet file has no footer
+# 2. The incomplete file is removed, and the rows of the journal are written again in a Parquet file of the same name
+# 3. If the Parquet file is complete (stop between its closing & the removal of the journal), only the journal is removed
+# [------------------------------------------------------]
+def recover_parquet_journals(root):
+    for journal in sorted(root.rglob("*.parquet.journal")):
+        path=journal.with_name(journal.name[:-len(".journal")])
+        try:
+            if path.exists():
+                try:
+                    pq.read_metadata(str(path))
+                    journal.unlink()
+                    continue
+                except Exception:
+                    path.unlink()
+            segment=ParquetSegment(path,0,journal=False)
+            rows=0
+            with open(journal, newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    # >>> The last row may have been cut by the stop
+                    try:
+                        host,sensor,value,ts,place,person=row
+                        ts=datetime.fromisoformat(ts)
+                    except ValueError:
+                        continue
+                    segment.write([host,sensor,value or None,ts,place or None,person or None])
+                    rows+=1
+            segment.close()
+            journal.unlink()
+            print(f"[INFO] Sensor archive : {rows} rows of {path} recovered from its journal.")
+        except Exception as e:
+            print("[ERROR] Sensor archive, recovering "+str(journal)+" : "+str(e))
+
+class SensorArchive:
+    def __init__(self):
+        self.queue=queue.Queue(maxsize=archive_queue_size)
+        self.files=OrderedDict()
+        self.thread=None
+        self.stopping=False
+        self.dropped=0
+        self.written=0
+
+    def start(self):
+        if self.thread is None:
+            self.stopping=False
+            self.thread=Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    # Write every row still in the queue, and close the files
+    def stop(self):
+        self.stopping=True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread=None
+        self.close_files(lambda entry: True)
+
+    def put(self,path,row,until):
+        try:
+            self.queue.put_nowait((path,row,until))
+        except queue.Full:
+            self.dropped+=1
+            if self.dropped%1000==1:
+                print(f"[WARNING] Sensor archive queue full, {self.dropped} rows dropped.")
+
+    def run(self):
+        if archive_format=="parquet":
+            recover_parquet_journals(default_path / "Data")
+        batch=[]
+        deadline=time.monotonic()+archive_flush_secs
+        while not (self.stopping and self.queue.empty() and not batch):
+            try:
+                batch.append(self.queue.get(timeout=max(0.0,deadline-time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch)>=archive_batch_size or time.monotonic()>=deadline:
+                if batch:
+                    try:
+                        self.write(batch)
+                    except Exception as e:
+                        print("[ERROR] Sensor archive : "+str(e))
+                    batch=[]
+                now=time.time()
+                self.close_files(lambda entry: entry.until<=now or (not entry.pinned and time.monotonic()-entry.last_used>archive_idle_secs))
+                deadline=time.monotonic()+archive_flush_secs
+
+    # ────────────────[Writing a batch]───────────────
+    def write(self,batch):
+        # >>> The files of the segments over (previous day or hour) won't be used anymore
+        now=time.time()
+        self.close_files(lambda entry: entry.until<=now)
+        touched=set()
+        for path,row,until in batch:
+            entry=self.open_file(path,until)
+            entry.write(row)
+            touched.add(path)
+        now=time.monotonic()
+        for path in touched:
+            entry=self.files.get(path)
+            if entry is not None:
+                entry.flush()
+                entry.last_used=now
+        self.written+=len(batch)
+
+    def open_file(self,path,until):
+        entry=self.files.get(path)
+        if entry is not None:
+            self.files.move_to_end(path)
+            return entry
+        entry=ParquetSegment(path,until) if path.suffix==".parquet" else ArchiveFile(path,until)
+        self.files[path]=entry
+        if len(self.files)>archive_max_open_files:
+            # >>> The least recently used file that isn't a Parquet segment (those are closed at the end of their segment)
+            oldest=next((key for key,value in self.files.items() if not value.pinned),None)
+            if oldest is not None:
+                self.files.pop(oldest).close()
+        return entry
+
+    def close_files(self,condition):
+        for path in [path for path,entry in self.files.items() if condition(entry)]:
+            try:
+                self.files.pop(path).close()
+            except Exception as e:
+                print("[ERROR] Sensor archive, closing "+str(path)+" : "+str(e))
+
+sensor_archive=SensorArchive()
 
 # ────────────────[Received a log message]───────────────
-def on_message_logs(message):
-    log_recu=message.split(f"[{client_id}]")[1]
-    nom=re.findall(r"\[(.*?)\]",message)[0]
-    insert_logs(log_recu,nom)
+# A binary log is in the instruction, a legacy one is all the text after the receiver
+def on_message_logs(payload_data):
+    if payload_data.binary:
+        insert_logs(payload_data.instruction,payload_data.sender)
+    else:
+        insert_logs(payload_data.raw.split(f"[{client_id}]",1)[1],payload_data.sender)
 
 # ────────────────[Received a metric message]───────────────
 def on_message_metrics(payload_data):
@@ -484,59 +1462,186 @@ def on_message_metrics(payload_data):
 # 2. For each task, we check the message and update the user accordingly
 # [------------------------------------------------------]   
 def on_message_commands(payload_data):
-    # >>> The user has finished downloading the dataset
+    record=registry.get(payload_data[0])
+    if record is None or record.job is None:
+        return
+    job=record.job
+    # >>> The user has finished downloading the dataset (a stolen part is launched directly)
     if payload_data[2]=="DATASET DOWNLOADED":
-        for user in user_array:
-            if user.name==payload_data[0]:
-                update_user_status(user.name,"MODELS")
-                break
+        if not launch_stolen_part(job,record):
+            update_user_status(record.name,"MODELS")
     # >>> The user has finished downloading the model
     elif payload_data[2]=="MODEL DOWNLOADED":
-        for user in user_array:
-            if user.name==payload_data[0]:
-                if mode_of_execution=="FL":
-                    update_user_status(user.name,"WEIGHT")
-                else:
-                    update_user_status(user.name,"READY")
-                break
+        if job.mode_of_execution=="FL":
+            update_user_status(record.name,"WEIGHT")
+        else:
+            update_user_status(record.name,"READY")
     # >>> The user has finished downloading the weight
     elif payload_data[2]=="WEIGHT DOWNLOADED":
-        for user in user_array:
-            if user.name==payload_data[0]:
-                update_user_status(user.name,"READY")
-                break
+        update_user_status(record.name,"READY")
+    # >>> The user has everything the turn needs (see Staging the turn)
+    elif payload_data[2]=="READY":
+        record_staged_fetches(job,record.name,payload_data)
+        update_user_status(record.name,"READY")
     # >>> The user has finished his work 
     elif payload_data[2]=="WAITING FOR WORK":
-        if mode_of_execution=="FL":
-            decrypt_message(payload_data)
-        for user in user_array:
-            if user.name==payload_data[0]:
-                update_user_status(user.name,"FINISHED")
-                break
+        if job.mode_of_execution=="FL":
+            received_hub_weight(job,payload_data)
+        record_execution(job,record,payload_data)
+        record.finish_task()
+        # >>> If a part is still free, he takes it at once (work stealing)
+        if not steal_next_part(job,record):
+            update_user_status(record.name,"FINISHED")
+    # >>> The barrier of the current phase of his job is told that the hub reported
+    signal_phase_barrier(job,payload_data[0])
 
 # ────────────────[Received an update message from server]───────────────
+# The message carries the id of the job it is about (job:<id>)
 def received_instruction_message_from_server(payload_data):
-    # >>> We need to adapt the datasets 
+    job=get_job(payload_data)
+    if job is None:
+        return
+    # >>> We need to adapt the datasets 
     if payload_data[2]=="ADAPT DATASETS":
-        adapt_dataset()
+        adapt_dataset(job)
     # >>> We can download the models
     elif payload_data[2]=="MODEL READY":
-        download_models()
+        download_models(job)
     # >>> We can download the weights
     elif payload_data[2]=="DOWNLOAD THE WEIGHT":
-        download_weight()
+        download_weight(job)
     # We can start the execution
     elif payload_data[2]=="START THE EXECUTION":
-        launch_execution()
+        launch_execution(job)
     # We can relaunch a turn or start a turn
     elif payload_data[2]=="RELAUNCH THE EXECUTION" or payload_data[2]=="DOWNLOAD DATASET":
-        if mode_of_execution=="MA":
-            download_models()
+        if job.mode_of_execution=="MA":
+            download_models(job)
         else:
-            download_datasets()
+            download_datasets(job)
     elif payload_data[2]=="END OF THE TURN":
-        end_turn_n()
+        end_turn_n(job)
         
+# ╔══════════════════════════════════════╗
+# ║               6bis. Jobs             ║
+# ╚══════════════════════════════════════╝
+# Several jobs can run at the same time, on disjoint pools of hubs. Each job keeps its own state,
+# the hubs know the job they work for (record.job), and the messages of the server carry the id of the job (job:<id>).
+
+# The jobs in progress, indexed by their id
+jobs = {}
+jobs_lock = threading.Lock()
+
+# ────────────────[State of a job]───────────────
+# [------------------------------------------------------]
+# 1. What the start message gave : mode, model, hubs, and for each turn the dataset, the cut mode, the number of parts & the rules
+# 2. The turn in progress : number of the turn, its dataset & cut, the parts (list_dataset) and the barrier of the phase
+# 3. The files of the job : results of the hubs, weight of the server, and parts of the datasets
+# [------------------------------------------------------]
+class Job:
+    def __init__(self):
+        self.work_id=None
+        self.mode_of_execution="None"
+        self.model_id=None
+        self.hubs=[]
+        self.parameter=None
+        self.dataset_id_array=[]
+        self.typeOfSelection_array=[]
+        self.numberOfParts_array=[]
+        self.rulesList_array=[]
+        self.number_of_turn=-1
+        self.number_of_turn_total=0
+        self.dataset_id=None
+        self.typeOfSelection=False
+        self.rulesList=[]
+        self.numberOfParts=0
+        self.list_dataset=[]
+        self.dataset_extension=None
+        self.barrier=None
+        # Hubs downloading a stolen part (see Work stealing)
+        self.stealing_hubs=set()
+        # Worker running the initialisation & the aggregation of the model (see Aggregation worker)
+        self.aggregator=None
+        # Weights of the hubs folded by the worker during the turn (see Streaming aggregation), None if not streaming
+        self.folded=None
+        # Key of the partition of the turn in the partition cache (None if it can't be cached)
+        self.partition_key=None
+        # sha256 of the parts of the turn (path -> sha256), of the model & of the weight of the server, sent in STAGE JOB
+        # They are computed when the files are written, never by the thread of the messages (see Staging the turn)
+        self.part_hashes={}
+        self.model_sha256=None
+        self.weight_sha256=None
+        # Start of the turn in progress (see Phase timings & metrics)
+        self.turn_start=None
+        # Timeline of the job, written in trace.json (see Job trace), None if JOB_TRACE isn't enabled
+        self.trace=JobTrace() if job_trace else None
+
+    # Folder receiving the weights of the hubs
+    @property
+    def result_dir(self):
+        return default_path / "Result" / str(self.work_id)
+
+    # Folder of the uploads of the hubs still in progress (written by the API)
+    @property
+    def upload_dir(self):
+        return default_path / "Uploads" / str(self.work_id)
+
+    # Weight of the server, sent to the hubs at each turn
+    @property
+    def weight_path(self):
+        return default_path / "Weights" / str(self.work_id) / "server_weight.pth"
+
+    # Folder of the parts of the dataset of the turn
+    @property
+    def dataset_dir(self):
+        return default_path / "Datasets" / str(self.dataset_id) / ("job"+str(self.work_id))
+
+    # Folder of the logs & results of the turn
+    @property
+    def turn_dir(self):
+        return default_path / "logs" / str(self.work_id) / str(self.number_of_turn)
+
+    # Timeline of the job (see Job trace)
+    @property
+    def trace_path(self):
+        return default_path / "logs" / str(self.work_id) / "trace.json"
+
+# ────────────────[Getting the job of a message]───────────────
+def get_job(payload_data):
+    job_id=payload_data.get("job")
+    with jobs_lock:
+        return jobs.get(str(job_id))
+
+# ────────────────[Sending an instruction of a job to the server]───────────────
+def publish_job_instruction(job,instructions):
+    client.publish("Data/Server",protocol.encode(client_id,"0",instructions,{"job":job.work_id}))
+
+# ────────────────[End of a job]───────────────
+# [------------------------------------------------------]
+# 1. The hubs still connected are ONLINE again, told that the job is over, and free for another job
+# 2. The job is removed from the jobs in progress, and its status is written in the database
+# 3. The parts of the datasets made for the job are deleted (they stay in the partition cache)
+# [------------------------------------------------------]
+def end_job(job,status="FINISHED"):
+    for hub in job.hubs:
+        record=registry.get(hub[0])
+        if record is not None and record.job is job:
+            record.job=None
+            update_user_status(hub[0],"ONLINE")
+            client.publish(f"hubs/{hub[0]}/commands",hub_message(hub[0],"END OF THE START PROGRAM"))
+    with jobs_lock:
+        jobs.pop(str(job.work_id),None)
+    sql_execute("UPDATE jobs SET status=%s, end_time=CURRENT_TIMESTAMP WHERE jobs_id=%s;",(status,job.work_id))
+    if job.dataset_id is not None:
+        shutil.rmtree(job.dataset_dir,ignore_errors=True)
+    stop_aggregator(job)
+    # >>> The weights of the job are kept in the logs of each turn
+    for folder in (job.upload_dir,job.weight_path.parent,job.result_dir):
+        shutil.rmtree(folder,ignore_errors=True)
+    write_job_trace(job)
+    job.number_of_turn=-1
+    job.mode_of_execution="None"
+
 # ╔══════════════════════════════════════╗
 # ║    7. Handling the start message     ║
 # ╚══════════════════════════════════════╝
@@ -544,248 +1649,704 @@ def received_instruction_message_from_server(payload_data):
 # ────────────────[Received the start message]───────────────
 # [------------------------------------------------------]
 # 1. We received a start message from the server containing all the data required
-# 2. We are gonna extract : 
+# 2. We are gonna extract, in a new job :
 # - number_of_turn_total
 # - model_id
-# - hubs, the list of hubs used
+# - hubs, the list of hubs used
 # - dataset_id_array, containing the id of the dataset for each turn
 # - typeOfSelection_array, containing the way to treat the dataset for each turn
 # - numberOfParts_array, containing the number of parts to cut the dataset for each turn
 # - rulesList_array, containing the rules for each turn if the cut mode is class
 # - parameter
-# - mode_of_execution, which define the mode we are currently in
-# [------------------------------------------------------]   
+# - mode_of_execution, which define the mode of the job
+# 3. The job is refused if one of his hubs already works for another job
+# [------------------------------------------------------]
 def received_start_message_server(payload_data):
-    global number_of_turn, number_of_turn_total, model_id, dataset_id_array, hubs, typeOfSelection_array, rulesList_array, parameter, numberOfParts_array, mode_of_execution
+    job=Job()
     try:
         # >>> Number of turn & Number of turn total
-        number_of_turn=0
-        number_of_turn_total=int(payload_data[3].split("numberOfTurn:")[1].split("|")[0])
+        job.number_of_turn=0
+        job.number_of_turn_total=int(payload_data.get("numberOfTurn"))
         conditionDataset=True
         # >>> is federated Learning ?
-        mode_of_execution = payload_data[3].split("Mode:")[1].split("|")[0]
+        job.mode_of_execution = payload_data.get("Mode")
         # >>> model_id & dataset_id_array
-        model_id = payload_data[3].split("model:",1)[1].split("|")[0]
-        dataset_id_array = payload_data[3].split("dataset:", 1)[1].split("|")[0].split(",")
+        job.model_id = payload_data.get("model")
+        job.dataset_id_array = payload_data.get("dataset").split(",")
         # >>> parameter
-        parameter=payload_data[3].split("parameter:", 1)[1].split("|")[0] 
+        job.parameter=payload_data.get("parameter")
         # >>> typeOfSelection_array & number_of_parts_array
-        typeOfSelection_array=[]
-        numberOfParts_array=[]
-        for i in range(number_of_turn_total):
-            if payload_data[3].split("selectionByClass:",1)[1].split("|")[0].split(",")[i]=="True":
-                typeOfSelection_array.append(True)
-                numberOfParts_array.append(0)
+        selection_by_class=payload_data.get("selectionByClass").split(",")
+        number_of_parts=payload_data.get("numberOfParts").split(",")
+        for i in range(job.number_of_turn_total):
+            if selection_by_class[i]=="True":
+                job.typeOfSelection_array.append(True)
+                job.numberOfParts_array.append(0)
             else:
-                typeOfSelection_array.append(False)
-                numberOfParts_array.append(int(payload_data[3].split("numberOfParts:",1)[1].split("|")[0].split(",")[i]))
-        # >>> hubs
-        temporary_hub = re.findall(r"\{(.*?)\}",payload_data[3])[0].split('|')
-        hubs = [h.split(",") for h in temporary_hub]
-        # >>> rulesList
-        rulesList_array = [[] for _ in range(number_of_turn_total)]
-        temporary_rules_array = re.findall(r"\{(.*?)\}",payload_data[3])[1].split('$')
+                job.typeOfSelection_array.append(False)
+                job.numberOfParts_array.append(int(number_of_parts[i]))
+        # >>> hubs (first {...} of the details)
+        temporary_hub = payload_data.groups[0].split('|')
+        job.hubs = [h.split(",") for h in temporary_hub]
+        # >>> rulesList (second {...} of the details)
+        job.rulesList_array = [[] for _ in range(job.number_of_turn_total)]
+        temporary_rules_array = payload_data.groups[1].split('$')
         # >>> if temporary_rules_array is empty then we redefine it
         if temporary_rules_array!=['']:
-            for i in range(number_of_turn_total):
-                    if typeOfSelection_array[i] and temporary_rules_array[i]!=[]:
+            for i in range(job.number_of_turn_total):
+                    if job.typeOfSelection_array[i] and temporary_rules_array[i]!=[]:
                         temporary_rules=temporary_rules_array[i].split("|")
-                        rulesList_array[i]=([r.split(",") for r in temporary_rules])
+                        job.rulesList_array[i]=([r.split(",") for r in temporary_rules])
     except Exception as e:
-        number_of_turn=-1
-        insert_logs("An error has happened during the start program. Exception : "+e)
-        conditionDataset=False 
+        insert_logs("An error has happened during the start program. Exception : "+str(e))
+        conditionDataset=False
     if conditionDataset:
-        for hub in hubs:
-            if mode_of_execution!="MA":
+        # >>> The hubs of the job must be free : a hub of a running job is busy, even while he is disconnected
+        #     (he gets back his job when he reconnects, see Add an user)
+        with jobs_lock:
+            working={hub[0] for running in jobs.values() for hub in running.hubs}
+            busy=[hub[0] for hub in job.hubs if hub[0] in working]
+            if busy:
+                insert_logs("[ERROR] Start refused : "+", ".join(busy)+" already working for another job.")
+                return
+            create_work_into_database(job)
+            jobs[str(job.work_id)]=job
+            for hub in job.hubs:
+                record=registry.get(hub[0])
+                if record is not None:
+                    record.job=job
+        # >>> The model & the datasets of every turn are read once
+        try:
+            metadata_cache.load_job(job)
+        except Exception as e:
+            insert_logs("[WARNING] The metadata of the job couldn't be loaded. Exception : "+str(e),job=job)
+        for hub in job.hubs:
+            if job.mode_of_execution!="MA":
                 update_user_status(hub[0],"DATASETS")
             else:
                 update_user_status(hub[0],"MODELS")
-        create_work_into_database()
-        insert_logs("[START] Start message received")
-        start_turn_n()
-
-def create_work_into_database():
-    global work_id
-    sql_execute("INSERT INTO jobs (hubs, datasets, model_id, status) VALUES (%s, %s, %s, %s);", ([hub[0] for hub in hubs], dataset_id_array, model_id, "WORKING") )
-    work_id=sql_get_single("SELECT * FROM jobs ORDER BY start_time DESC LIMIT 1;")
-    if work_id=="NOT FOUND" or work_id==None:
+        insert_logs("[START] Start message received",job=job)
+        start_turn_n(job)
+
+def create_work_into_database(job):
+    with sql_cursor() as cursor_sql:
+        cursor_sql.execute("INSERT INTO jobs (hubs, datasets, model_id, status) VALUES (%s, %s, %s, %s) RETURNING jobs_id;", ([hub[0] for hub in job.hubs], job.dataset_id_array, job.model_id, "WORKING") )
+        job.work_id=cursor_sql.fetchone()[0]
+    if job.work_id==None:
         raise Exception ("Problem with the work_id")
 # ────────────────[Start a new turn]───────────────
 # [------------------------------------------------------]
-# 1. We're gonna define, for each turn : 
-# - dataset_id, the dataset for this turn
-# - typeOfSelection, if we are doing a class, or a classic mode
+# 1. We're gonna define, for each turn :
+# - dataset_id, the dataset for this turn
+# - typeOfSelection, if we are doing a class, or a classic mode
 # - rulesList, the list of rules for this turn
 # - numberOfParts, the number of parts to cut the dataset into for this turn
-# [------------------------------------------------------]   
-def start_turn_n():
-    global dataset_id, typeOfSelection, rulesList, numberOfParts, number_of_turn
-    os.makedirs(default_path / "Result", exist_ok=True)
-    for file in (default_path / "Result").iterdir():
+# [------------------------------------------------------]
+def start_turn_n(job):
+    os.makedirs(job.result_dir, exist_ok=True)
+    for file in job.result_dir.iterdir():
         os.remove(file)
-    os.makedirs(default_path / "logs" / str(work_id) / str(number_of_turn) / "result",exist_ok=True)
-    os.makedirs(default_path / "logs" / str(work_id) / str(number_of_turn) / "logs",exist_ok=True)
-    if len(dataset_id_array)>number_of_turn:
-        dataset_id=dataset_id_array[number_of_turn]
-    if len(typeOfSelection_array)>number_of_turn:
-        typeOfSelection=typeOfSelection_array[number_of_turn]
-    if len(rulesList_array)>number_of_turn:
-        rulesList=rulesList_array[number_of_turn]
-    if len(numberOfParts_array)>number_of_turn:
-        numberOfParts=numberOfParts_array[number_of_turn]
-    insert_logs("======== Tour "+str(number_of_turn+1)+" ========")
-    if number_of_turn==0 and mode_of_execution=="FL":
-        federated_learning_preparation()
-    elif mode_of_execution!="MA":
-        adapt_dataset()
+    os.makedirs(job.turn_dir / "result",exist_ok=True)
+    os.makedirs(job.turn_dir / "logs",exist_ok=True)
+    job.turn_start=time.time()
+    apply_turn(job,job.number_of_turn)
+    insert_logs("======== Tour "+str(job.number_of_turn+1)+" ========",job=job)
+    if job.mode_of_execution=="FL":
+        start_streaming_aggregation(job)
+    if job.number_of_turn==0 and job.mode_of_execution=="FL":
+        federated_learning_preparation(job)
+    elif job.mode_of_execution!="MA":
+        adapt_dataset(job)
     else:
-        download_models()
-
-def end_turn_n():
-    global list_dataset, hubs, number_of_turn, mode_of_execution
-    number_of_turn+=1
-    if number_of_turn==number_of_turn_total:
+        download_models(job)
+
+# ────────────────[Spec of a turn]───────────────
+# The dataset, the cut mode, the rules & the number of parts of the turn are put in the job
+def apply_turn(job,turn):
+    if len(job.dataset_id_array)>turn:
+        job.dataset_id=job.dataset_id_array[turn]
+    if len(job.typeOfSelection_array)>turn:
+        job.typeOfSelection=job.typeOfSelection_array[turn]
+    if len(job.rulesList_array)>turn:
+        job.rulesList=job.rulesList_array[turn]
+    if len(job.numberOfParts_array)>turn:
+        job.numberOfParts=job.numberOfParts_array[turn]
+
+def end_turn_n(job):
+    if job.turn_start is not None:
+        metrics.observe("fl_turn_seconds",time.time()-job.turn_start,mode=job.mode_of_execution)
+        phase_recorder.record(job,"turn",job.turn_start,time.time())
+    job.number_of_turn+=1
+    # >>> The timeline is written at each turn, so a job in progress can be looked at
+    if job.number_of_turn<job.number_of_turn_total:
+        write_job_trace(job)
+    if job.number_of_turn==job.number_of_turn_total:
     # >>> We finished the last turn
-        number_of_turn=-1
-        insert_logs("Cycle finished. End of the start program.")
-        for hub in hubs:
-            update_user_status(hub[0],"ONLINE")
-            client.publish(f"hubs/{hub[0]}/commands",construct_message(hub[0],"END OF THE START PROGRAM"))
-        mode_of_execution="None"
+        insert_logs("Cycle finished. End of the start program.",job=job)
+        end_job(job)
     else:
 
-        # >>> We haven't done the last turn yet
-        if mode_of_execution!="MA":
-            for dataset in list_dataset:
+        # >>> We haven't done the last turn yet
+        if job.mode_of_execution!="MA":
+            for dataset in job.list_dataset:
                 dataset[1]="None"
-            for hub in hubs:
-                    update_user_status(hub[0],"DATASETS")
-            else:
-                for hub in hubs:
-                    update_user_status(hub[0],"MODELS") 
-        start_turn_n()
+            for hub in job.hubs:
+                update_user_status(hub[0],"DATASETS")
+        else:
+            for hub in job.hubs:
+                update_user_status(hub[0],"MODELS")
+        start_turn_n(job)
 
 
 # ────────────────[Start the initialisation thread]───────────────
-def federated_learning_preparation():
-    t=Thread(target=federated_learning_preparation_thread).start()
+def federated_learning_preparation(job):
+    t=Thread(target=federated_learning_preparation_thread,args=(job,)).start()
 
 # ────────────────[Initialisation Thread]───────────────
 # [------------------------------------------------------]
 # 1. We're gonna :
-# - If a initial model is given, we use it
+# - If a initial model is given, we use it
 # - else, if the program is given on the side, use it
-# - else, use the model with the correct parameter required
-# [------------------------------------------------------]   
-def federated_learning_preparation_thread():
+# - else, use the model with the correct parameter required
+# [------------------------------------------------------]
+def federated_learning_preparation_thread(job):
     if is_initialized_model_given:
         print("ici on doit faire")
     else:
-        insert_logs("Initializing the weight : ")
-        model_path=  sql_get_single("SELECT path FROM models WHERE model_id="+model_id+";")
-        weight_path= str(default_path / "Weights" / "server_weight.pth")
+        insert_logs("Initializing the weight : ",job=job)
+        weight_path= str(job.weight_path)
+        os.makedirs(job.weight_path.parent, exist_ok=True)
         try:
-            p=subprocess.Popen(["python3", model_path,
-                           "--mode","init",
-                           "--input-dim",str(input_dim),
-                           "--output-path",weight_path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            text=True
-                            )
-            for line in p.stdout:
-                insert_logs(line.rstrip(),"Initialisation")
-            insert_logs("Finished treating the weight.")
-            shutil.copyfile(weight_path,default_path / "logs" / str(work_id) / str(number_of_turn) / "result" / "weight_server.pth")
-            client.publish("Data/Server",construct_message("0","ADAPT DATASETS"))
+            run_model_mode(job,job_model_path(job),"init","Initialisation",input_dim=input_dim,output_path=weight_path)
+            job.weight_sha256=file_sha256(weight_path)
+            insert_logs("Finished treating the weight.",job=job)
+            shutil.copyfile(weight_path,job.turn_dir / "result" / "weight_server.pth")
+            publish_job_instruction(job,"ADAPT DATASETS")
         except Exception as e:
-            insert_logs("Erreur dans l'initialisation. Fin du programme. Vérifiez le -in. Stacktrace : "+str(e))
+            insert_logs("Erreur dans l'initialisation. Fin du programme. Vérifiez le -in. Stacktrace : "+str(e),job=job)
+            end_job(job,"ERROR")
 
 # ╔══════════════════════════════════════╗
 # ║         8. Dataset preparation       ║
 # ╚══════════════════════════════════════╝
 
 # ────────────────[Start the adapting dataset thread]───────────────
-def adapt_dataset():
-    t=Thread(target=adapt_dataset_thread).start()
+def adapt_dataset(job):
+    t=Thread(target=adapt_dataset_thread,args=(job,)).start()
 
 # ────────────────[Adapting dataset thread]───────────────
 # [------------------------------------------------------]
-# 1. We first prepare the variable (list_dataset, dataset_path, dataset_dir ...)
-# 2. We then clean the old folder, and open the csv obtained, get the header (name of column) and the rows (all the lines)
-# 3. Then, we check the mode (classic or class), and we cut the dataset corresponding to that
+# 1. We first prepare the variable (list_dataset, dataset_path, dataset_dir ...). The parts are made in the folder of the job
+# 2. If the parts of the folder have been made with the same spec (dataset, mode, parts, rules, seed), nothing is done
+# 3. Else, we clean the old folder, and take the parts from the partition cache (see Partition cache)
+# 4. If they aren't in the cache, we check the mode (classic or class), and we cut the dataset corresponding to that
+#    The classic mode streams the file (see Streaming partitioner), the memory used doesn't depend on the size of the dataset
+# 5. The sha256 of the parts (kept in the manifest of the partition) and of the model are given to the job (see Staging the turn)
 # [------------------------------------------------------] 
-def adapt_dataset_thread():
-    insert_logs("[INFO] Preparing the datasets.")
+def adapt_dataset_thread(job):
+    start=time.time()
+    insert_logs("[INFO] Preparing the datasets.",job=job)
     # >>> Preparing the variable
-    global list_dataset
-    list_dataset=[]
+    job.list_dataset=[]
+    job.part_hashes={}
+    list_dataset=job.list_dataset
+    if job.model_sha256 is None:
+        job.model_sha256=file_sha256(job_model_path(job))
     # >>> Path variable
-    dataset_dir = default_path / "Datasets" / str(dataset_id)
-    dataset_string_path= sql_get_single("SELECT path FROM datasets WHERE dataset_id="+dataset_id+";")
-    dataset_path=Path(dataset_string_path)
+    dataset_dir = job.dataset_dir
+    os.makedirs(dataset_dir, exist_ok=True)
+    dataset_path=Path(job_dataset_path(job))
     if not dataset_path.exists():
         raise FileNotFoundError(f"Fichier non trouvé : {dataset_path}")
+    key=partition_cache_key(job,dataset_path)
+    job.partition_key=key
+    if key is not None and read_partition_marker(dataset_dir)==key:
+        # >>> The parts are already there
+        manifest=load_partition_manifest(partition_cache_dir / key)
+        if manifest is not None and all((dataset_dir / part["file"]).exists() for part in manifest["parts"]):
+            insert_logs("[INFO] Same partition spec as before, the datasets are reused.",job=job)
+            for part in manifest["parts"]:
+                list_dataset.append([str(dataset_dir / part["file"]),part["hub"]])
+                job.part_hashes[str(dataset_dir / part["file"])]=part.get("sha256") or file_sha256(dataset_dir / part["file"])
+            phase_recorder.record(job,"partition",start,time.time())
+            publish_job_instruction(job,"DOWNLOAD DATASET")
+            prepare_next_turn(job)
+            return
     # >>> Deleting all the old files
     for file in dataset_dir.iterdir():
-        if file.is_file() and file.name != dataset_string_path.split("/")[-1]:
+        if file.is_file() and file.name != dataset_path.name:
             os.remove(file)
-    # >>> Opening the file an getting the headers and rows of the file
-    with open(dataset_path, newline='', encoding="utf-8") as f:
-        csv_reader = list(csv.reader(f))
-        header, rows = csv_reader[0], csv_reader[1:]
-    # >>> Classic mode : n files of equal size
-    if not typeOfSelection:
-        # >>> Variable number_lines_per_file & number_lines_total
-        number_lines_total = len(rows)
-        number_lines_per_file = number_lines_total / numberOfParts
-        # >>> For each file : 
-        # >>> - We compute the start & end
-        # >>> - Get the corresponding lines
-        # >>> - Put them in a file Dataset{i}.csv
-        # >>> - Insert it into list_dataset to know who's gonna treat it
-        for i in range(numberOfParts):
-            start=int(i * number_lines_per_file) 
-            end = int((i+1)* number_lines_per_file)
-            temp_file_line = rows[start:end]
-            if not temp_file_line:
+    if key is None:
+        parts=[(output_file,hub_name,file_sha256(output_file)) for output_file,hub_name in cut_dataset(job,dataset_path,dataset_dir)]
+    else:
+        parts=cached_partition(job,key,dataset_path,dataset_dir)
+    for output_file,hub_name,sha256 in parts:
+        list_dataset.append([str(output_file),hub_name])
+        job.part_hashes[str(output_file)]=sha256
+    phase_recorder.record(job,"partition",start,time.time())
+    publish_job_instruction(job,"DOWNLOAD DATASET")
+    prepare_next_turn(job)
+
+# ────────────────[Cutting the dataset]───────────────
+# [------------------------------------------------------]
+# 1. Classic mode : n files of equal size, given to any hub ("None")
+# 2. Class mode : one file per hub, with the rows matching his rules (see Rule partitioner)
+# 3. Return the paths of the parts, with the hub for each one
+# [------------------------------------------------------]
+def cut_dataset(job,dataset_path,output_dir):
+    if not job.typeOfSelection:
+        return [(temp_path,"None") for temp_path in partition_dataset(job,dataset_path,output_dir,job.numberOfParts)]
+    return partition_dataset_by_rules(job,dataset_path,output_dir,job.hubs,job.rulesList)
+
+# ────────────────[Partition cache]───────────────
+# The parts already made are kept in PartitionCache/<key>, the key depending on the content of the dataset and on the spec
+partition_cache_dir = default_path / "PartitionCache"
+# Maximum size of the cache (in bytes), the least recently used partitions being deleted first
+partition_cache_max_bytes = int(os.getenv("PARTITION_CACHE_MAX_BYTES", str(20 * 1024**3)))
+# File of the dataset folder, containing the key of the parts it contains
+partition_marker = ".partition"
+# Hash of the datasets already read : (path, size, mtime) -> sha256, the least recently used ones being forgotten
+dataset_hash_cache = OrderedDict()
+dataset_hash_cache_size = int(os.getenv("DATASET_HASH_CACHE_SIZE", "64"))
+dataset_hash_lock = threading.Lock()
+
+def file_sha256(file_path):
+    digest=hashlib.sha256()
+    with open(file_path,"rb") as f:
+        while True:
+            chunk=f.read(partition_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def dataset_content_hash(dataset_path):
+    stat=os.stat(dataset_path)
+    key=(str(dataset_path),stat.st_size,stat.st_mtime_ns)
+    with dataset_hash_lock:
+        if key in dataset_hash_cache:
+            dataset_hash_cache.move_to_end(key)
+            return dataset_hash_cache[key]
+    sha256=file_sha256(dataset_path)
+    with dataset_hash_lock:
+        dataset_hash_cache[key]=sha256
+        while len(dataset_hash_cache)>dataset_hash_cache_size:
+            dataset_hash_cache.popitem(last=False)
+    return sha256
+
+# ────────────────[Key of a partition]───────────────
+# [------------------------------------------------------]
+# 1. The spec contains the hash of the dataset, the mode, the number of parts (classic) or the hubs & rules (class), and the seed
+# 2. The rules are normalized like they are compared (strip().lower(), freq as a float)
+# 3. A subsampling without seed is random at every turn : it can't be cached, we return None
+# 4. The key is the sha256 of the spec
+# [------------------------------------------------------]
+def partition_cache_key(job,dataset_path):
+    if not job.typeOfSelection:
+        spec={"mode":"classic","parts":int(job.numberOfParts)}
+    else:
+        rules=[[hub_name,column,value.strip().lower(),float(freq)] for hub_name,column,value,freq in job.rulesList]
+        if partition_seed is None and any(rule[3]<1.0 for rule in rules):
+            return None
+        spec={"mode":"class","hubs":[hub[0] for hub in job.hubs],"rules":rules,"seed":partition_seed}
+    spec["dataset"]=dataset_content_hash(dataset_path)
+    return hashlib.sha256(json.dumps(spec,sort_keys=True).encode()).hexdigest()
+
+def read_partition_marker(dataset_dir):
+    try:
+        return (dataset_dir / partition_marker).read_text().strip()
+    except OSError:
+        return None
+
+def load_partition_manifest(entry_dir):
+    try:
+        with open(entry_dir / "manifest.json") as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+# ────────────────[Getting a partition from the cache]───────────────
+# [------------------------------------------------------]
+# 1. The partition is taken from the cache, or made (see Building a partition)
+# 2. The parts are hard linked in the dataset folder (copied if the link isn't possible), and the marker is written
+# 3. The cache is reduced to its budget
+# 4. Return the paths of the parts, with the hub & the sha256 of each one
+# [------------------------------------------------------]
+def cached_partition(job,key,dataset_path,dataset_dir):
+    entry_dir=partition_cache_dir / key
+    manifest=build_partition(job,key,dataset_path)
+    parts=[]
+    for part in manifest["parts"]:
+        try:
+            os.link(entry_dir / part["file"],dataset_dir / part["file"])
+        except OSError:
+            shutil.copyfile(entry_dir / part["file"],dataset_dir / part["file"])
+        # >>> A manifest written before the sha256 were kept : the part is hashed once
+        parts.append((dataset_dir / part["file"],part["hub"],part.get("sha256") or file_sha256(dataset_dir / part["file"])))
+    (dataset_dir / partition_marker).write_text(key)
+    evict_partition_cache(key)
+    return parts
+
+# ────────────────[Building a partition]───────────────
+# [------------------------------------------------------]
+# 1. If the partition isn't in the cache, the dataset is cut in a temporary folder, with a manifest (parts, hubs, sizes, sha256),
+#    and the folder is renamed PartitionCache/<key> when it is complete
+# 2. Else, the use of the partition is remembered (modification time of the manifest)
+# 3. A partition is built by one thread at a time : a turn starting while its partition is prepared (see Next turn) waits for it
+# 4. Return the manifest
+# [------------------------------------------------------]
+partition_locks = {}
+partition_locks_lock = threading.Lock()
+
+def build_partition(job,key,dataset_path):
+    with partition_locks_lock:
+        lock=partition_locks.setdefault(key,threading.Lock())
+    with lock:
+        entry_dir=partition_cache_dir / key
+        manifest=load_partition_manifest(entry_dir)
+        if manifest is None:
+            temporary_dir=partition_cache_dir / (key+".tmp")
+            shutil.rmtree(temporary_dir,ignore_errors=True)
+            shutil.rmtree(entry_dir,ignore_errors=True)
+            os.makedirs(temporary_dir)
+            parts=cut_dataset(job,dataset_path,temporary_dir)
+            manifest={"key":key,"dataset":str(dataset_path),"created":datetime.now().isoformat(),
+                      "parts":[{"file":Path(path).name,"hub":hub_name,"size":os.path.getsize(path),"sha256":file_sha256(path)} for path,hub_name in parts]}
+            with open(temporary_dir / "manifest.json","w") as f:
+                json.dump(manifest,f)
+            os.rename(temporary_dir,entry_dir)
+        else:
+            insert_logs("[INFO] Datasets found in the partition cache.",job=job)
+            os.utime(entry_dir / "manifest.json")
+        return manifest
+
+# ────────────────[Next turn]───────────────
+# [------------------------------------------------------]
+# 1. The spec of every turn is known from the start message : while the hubs work on the turn n, the partition of the turn n+1
+#    is built in the partition cache, by a background thread
+# 2. The hubs are then told which part they should get (PREFETCH DATASETS, with the key of the partition) : they download it
+#    in advance, and use it as soon as the turn n+1 sends it (DOWNLOAD DATASETS with the same key)
+# 3. Classic mode : the free parts are given in the order of the hubs, so the hub i should get the part i
+#    Class mode : each part belongs to a hub
+# 4. A partition that can't be cached (subsampling without seed) isn't prepared
+# 5. A partition that is the one of the turn in progress (same dataset, spec & seed, as in most FL jobs) isn't announced :
+#    the hubs already have their part
+# [------------------------------------------------------]
+prefetch_next_turn = os.getenv("PREFETCH_NEXT_TURN", "1")=="1"
+
+def prepare_next_turn(job):
+    if not prefetch_next_turn or job.mode_of_execution=="MA" or job.number_of_turn+1>=job.number_of_turn_total:
+        return
+    Thread(target=prepare_next_turn_thread,args=(job,job.number_of_turn+1),daemon=True).start()
+
+def prepare_next_turn_thread(job,turn):
+    try:
+        # >>> A copy of the job, with the spec of the next turn
+        view=copy.copy(job)
+        apply_turn(view,turn)
+        dataset_path=Path(job_dataset_path(view))
+        if not dataset_path.exists():
+            return
+        key=partition_cache_key(view,dataset_path)
+        if key is None or key==job.partition_key:
+            return
+        start=time.time()
+        manifest=build_partition(view,key,dataset_path)
+        phase_recorder.record(job,"prepare_next",start,time.time())
+        insert_logs(f"[INFO] Datasets of the turn {turn+1} prepared.",job=job)
+    except Exception as e:
+        insert_logs("[WARNING] The datasets of the next turn couldn't be prepared. Exception : "+str(e),job=job)
+        return
+    extension=dataset_path.name.split(".")[1]
+    if view.typeOfSelection:
+        assignments=[(part["hub"],part["file"]) for part in manifest["parts"]]
+    else:
+        assignments=[(hub[0],part["file"]) for hub,part in zip(job.hubs,manifest["parts"])]
+    for name,file in assignments:
+        if job.number_of_turn>=turn or not is_user_connected(name):
+            continue
+        client.publish("hubs/"+name+"/commands",hub_message(name,"PREFETCH DATASETS",{"id":view.dataset_id,"part_number":int(Path(file).stem.split("Dataset")[1]),"name":"Dataset."+extension,"job":job.work_id,"key":key}))
+
+# ────────────────[Reducing the cache]───────────────
+# The least recently used partitions are deleted until the cache fits in its budget (the one in use is kept)
+def evict_partition_cache(keep):
+    entries=[]
+    total=0
+    for entry_dir in partition_cache_dir.iterdir():
+        manifest=load_partition_manifest(entry_dir)
+        if manifest is None:
+            continue
+        size=sum(part["size"] for part in manifest["parts"])
+        entries.append((os.path.getmtime(entry_dir / "manifest.json"),size,entry_dir))
+        total+=size
+    for _,size,entry_dir in sorted(entries):
+        if total<=partition_cache_max_bytes:
+            break
+        if entry_dir.name==keep:
+            continue
+        shutil.rmtree(entry_dir,ignore_errors=True)
+        total-=size
+
+# ────────────────[Streaming partitioner]───────────────
+# Size of the blocks read from the dataset, and of the buffers of the parts (in bytes)
+partition_chunk_size = int(os.getenv("PARTITION_CHUNK_SIZE", str(1 << 20)))
+# Number of rows of the datasets already counted : (path, size, mtime) -> (number of rows, quoted)
+row_count_cache = {}
+
+# ────────────────[Counting the rows of a dataset]───────────────
+# [------------------------------------------------------]
+# 1. If the dataset hasn't changed since the last count (same size & modification time), the cached count is used
+# 2. Else, the newlines are counted by blocks, without decoding the file, and we remember if there is a quote in it
+# 3. If there is a quote, a field can contain a newline : the rows are counted again with the csv reader
+# [------------------------------------------------------]
+def count_dataset_rows(dataset_path):
+    stat=os.stat(dataset_path)
+    key=(str(dataset_path),stat.st_size,stat.st_mtime_ns)
+    if key in row_count_cache:
+        return row_count_cache[key]
+    newlines=0
+    quoted=False
+    last=b"\n"
+    with open(dataset_path,"rb") as f:
+        while True:
+            chunk=f.read(partition_chunk_size)
+            if not chunk:
                 break
-            temp_filename = f"Dataset{i+1}.csv"
-            temp_path = dataset_dir / temp_filename
-            # >>> Writing part
-            with open(temp_path, "w", newline='', encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(header)
-                writer.writerows(temp_file_line)
-            list_dataset.append([str(temp_path),str("None")])
+            newlines+=chunk.count(b"\n")
+            quoted=quoted or b'"' in chunk
+            last=chunk[-1:]
+    if quoted:
+        with open(dataset_path,newline='',encoding="utf-8") as f:
+            rows=sum(1 for _ in csv.reader(f))-1
     else:
-        i=1
-        # >>> For each hub : 
-        # >>> - We check, for each rule, if it is for this hub
-        # >>> - If it is, we add the line corresponding to the parameter to the hub list of lines
-        # >>> - After all the rules have been checked, we add the lines to the file
-        for hub in hubs:
-            hub_rows = []
-            for rule in rulesList:
-                hub_name, headerRule, value, freq = rule
-                if hub_name != hub[0]:
+        # The last row may not end with a newline
+        rows=newlines+(last!=b"\n")-1
+    row_count_cache[key]=(max(rows,0),quoted)
+    return row_count_cache[key]
+
+# ────────────────[Cutting a dataset in parts]───────────────
+# [------------------------------------------------------]
+# 1. We count the rows, and compute the number of rows of each part (the same cut as before : int(i*rows/parts)). We stop at the first empty part
+# 2. We find where (in bytes) each part ends in the file (see Locating the parts)
+# 3. The parts are written in Dataset{i}.csv, with the header, by the process pool (see Writing the parts)
+# 4. Return the paths of the parts
+# [------------------------------------------------------]
+def partition_dataset(job,dataset_path,dataset_dir,parts):
+    rows,quoted=count_dataset_rows(dataset_path)
+    sizes=[]
+    for i in range(parts):
+        size=int((i+1)*rows/parts)-int(i*rows/parts)
+        if size==0:
+            break
+        sizes.append(size)
+    header_bytes,bounds=locate_parts(dataset_path,sizes,quoted)
+    tasks=[]
+    for i in range(len(sizes)):
+        tasks.append((str(dataset_path),str(dataset_dir / f"Dataset{i+1}.csv"),header_bytes,[(bounds[i],bounds[i+1])]))
+    return write_parts(job,tasks)
+
+# ────────────────[Locating the parts]───────────────
+# [------------------------------------------------------]
+# 1. Without quote, the newlines are counted by blocks : a block is only searched at the newline ending a part
+# 2. With quotes, a field can contain a newline : the rows are read with the csv reader, keeping their offset (see OffsetLines)
+# 3. Return the header (in bytes), and the offsets of the start of the parts, followed by the end of the last one
+# [------------------------------------------------------]
+def locate_parts(dataset_path,sizes,quoted):
+    with open(dataset_path,"rb") as f:
+        if quoted:
+            lines=OffsetLines(f)
+            reader=csv.reader(lines)
+            next(reader)
+            header_end=lines.offset
+            bounds=[header_end]
+            for size in sizes:
+                for _ in zip(range(size),reader):
+                    pass
+                bounds.append(lines.offset)
+        else:
+            f.readline()
+            header_end=f.tell()
+            bounds=[header_end]
+            position=header_end
+            remaining=list(sizes)
+            while len(bounds)<=len(sizes):
+                chunk=f.read(partition_chunk_size)
+                if not chunk:
+                    bounds.append(position)
+                    continue
+                end=-1
+                newlines=chunk.count(b"\n")
+                # >>> One or more parts end in this block
+                while len(bounds)<=len(sizes) and newlines>=remaining[len(bounds)-1]:
+                    for _ in range(remaining[len(bounds)-1]):
+                        end=chunk.index(b"\n",end+1)
+                    newlines-=remaining[len(bounds)-1]
+                    bounds.append(position+end+1)
+                if len(bounds)<=len(sizes):
+                    remaining[len(bounds)-1]-=newlines
+                position+=len(chunk)
+            # >>> The last part takes the end of the file (its last row may not end with a newline)
+            if sizes:
+                bounds[-1]=os.path.getsize(dataset_path)
+        f.seek(0)
+        header_bytes=f.read(header_end)
+    if not header_bytes.endswith(b"\n"):
+        header_bytes+=b"\n"
+    return header_bytes,bounds
+
+# ────────────────[Rule partitioner]───────────────
+# Seed of the subsampling of the rules (freq < 1). If it isn't set, the subsampling changes at every turn
+partition_seed = os.getenv("PARTITION_SEED")
+
+# Lines of a binary file, decoded for the csv reader, keeping the offset (in bytes) of the end of the last line given
+class OffsetLines:
+    def __init__(self,f):
+        self.f=f
+        self.offset=f.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line=self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset+=len(line)
+        return line.decode("utf-8")
+
+# ────────────────[Indexing the values of the rules]───────────────
+# [------------------------------------------------------]
+# 1. We only index the (column, value) used by a rule, the values being compared with strip().lower()
+# 2. The file is read once : each row matching at least one rule gets an id, and we keep its start & end (in bytes)
+# 3. For each (column, value), the index contains the ids of the matching rows
+# 4. Return the header (in bytes), the index, and the starts & ends of the matching rows
+# [------------------------------------------------------]
+def index_rule_values(dataset_path,rules):
+    with open(dataset_path,"rb") as f:
+        lines=OffsetLines(f)
+        reader=csv.reader(lines)
+        header=next(reader)
+        header_end=lines.offset
+        f.seek(0)
+        header_bytes=f.read(header_end)
+        wanted={}
+        for _,column,value,_ in rules:
+            wanted.setdefault(header.index(column),set()).add(value.strip().lower())
+        index={(column,value):array("l") for column,values in wanted.items() for value in values}
+        starts,ends=array("q"),array("q")
+        start=lines.offset
+        for row in reader:
+            row_id=None
+            for column,values in wanted.items():
+                if column>=len(row):
                     continue
-                # >>> Here, the rules is for the hub, so we choose the lines
-                matching = [r for r in rows if r[header.index(headerRule)].strip().lower() == value.strip().lower()]
-                if float(freq) < 1.0 and len(matching) > 0:
-                    nb_to_keep = int(len(matching) * float(freq))
-                    matching = random.sample(matching, nb_to_keep)
-                hub_rows.extend(matching)
-            hub_rows = [list(x) for x in {tuple(r) for r in hub_rows}]
-            output_file = dataset_dir / ("Dataset"+str(i)+".csv") 
-            i+=1
-            with open(output_file, "w", newline='', encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(header)
-                writer.writerows(hub_rows)
-            list_dataset.append([str(output_file),hub[0]])
-    client.publish("Data/Server",construct_message("0","DOWNLOAD DATASET"))
+                value=row[column].strip().lower()
+                if value in values:
+                    if row_id is None:
+                        row_id=len(starts)
+                        starts.append(start)
+                        ends.append(lines.offset)
+                    index[(column,value)].append(row_id)
+            start=lines.offset
+    return header,header_bytes,index,starts,ends
+
+# ────────────────[Seeded reservoir]───────────────
+# Choose k ids among the ids, with one pass (reservoir sampling)
+def reservoir_sample(ids,k,rng):
+    reservoir=list(ids[:k])
+    for i in range(k,len(ids)):
+        j=rng.randrange(i+1)
+        if j<k:
+            reservoir[j]=ids[i]
+    return reservoir
+
+# ────────────────[Cutting a dataset with rules]───────────────
+# [------------------------------------------------------]
+# 1. The values used by the rules are indexed with a single pass on the file
+# 2. For each hub, each of his rules gives the ids of its rows in the index, subsampled if freq < 1 (seeded reservoir)
+# 3. The rows are deduplicated by id, and sorted : the following ones are copied as a single byte range
+# 4. Each hub gets a file Dataset{i}.csv, with the header, written by the process pool. Return the paths and the name of the hubs
+# [------------------------------------------------------]
+def partition_dataset_by_rules(job,dataset_path,dataset_dir,hubs,rules):
+    header,header_bytes,index,starts,ends=index_rule_values(dataset_path,rules)
+    if not header_bytes.endswith(b"\n"):
+        header_bytes+=b"\n"
+    tasks=[]
+    for i,hub in enumerate(hubs):
+        row_ids=set()
+        for rule_number,(hub_name,column,value,freq) in enumerate(rules):
+            if hub_name!=hub[0]:
+                continue
+            ids=index[(header.index(column),value.strip().lower())]
+            if float(freq)<1.0 and len(ids)>0:
+                rng=random.Random(f"{partition_seed}:{hub_name}:{rule_number}") if partition_seed is not None else random.Random()
+                ids=reservoir_sample(ids,int(len(ids)*float(freq)),rng)
+            row_ids.update(ids)
+        output_file=dataset_dir / ("Dataset"+str(i+1)+".csv")
+        tasks.append((str(dataset_path),str(output_file),header_bytes,list(coalesce_rows(sorted(row_ids),starts,ends))))
+    return [(output_file,hub[0]) for output_file,hub in zip(write_parts(job,tasks),hubs)]
+
+# Byte ranges of sorted rows, the rows following each other being put in the same range
+def coalesce_rows(row_ids,starts,ends):
+    start=end=None
+    for row_id in row_ids:
+        if start is not None and starts[row_id]==end:
+            end=ends[row_id]
+            continue
+        if start is not None:
+            yield start,end
+        start,end=starts[row_id],ends[row_id]
+    if start is not None:
+        yield start,end
+
+def copy_byte_range(f,out,start,end):
+    f.seek(start)
+    last=b""
+    while start<end:
+        chunk=f.read(min(partition_chunk_size,end-start))
+        if not chunk:
+            break
+        out.write(chunk)
+        start+=len(chunk)
+        last=chunk[-1:]
+    # The last row of the dataset may not end with a newline
+    if last not in (b"\n",b""):
+        out.write(b"\n")
+
+# ────────────────[Writing the parts]───────────────
+# Number of processes writing the parts (all the cores by default)
+partition_workers = int(os.getenv("PARTITION_WORKERS", str(os.cpu_count() or 1)))
+partition_pool = None
+
+# [------------------------------------------------------]
+# 1. Each part is a task (dataset, file of the part, header, byte ranges), given to a process of the pool :
+#    the copies use all the cores, and don't hold the GIL of the MQTT thread
+# 2. The pool is created at the first partition and kept for the next ones
+# 3. The size of each part and the time taken to write it are written in the logs of the turn
+# 4. Return the paths of the parts, in the order of the tasks
+# [------------------------------------------------------]
+def write_parts(job,tasks):
+    global partition_pool
+    if partition_pool is None:
+        partition_pool=ProcessPoolExecutor(max_workers=partition_workers,mp_context=multiprocessing.get_context("forkserver"))
+    start=time.monotonic()
+    paths=[]
+    for output_path,size,seconds in partition_pool.map(write_part,tasks):
+        insert_logs("[INFO] "+Path(output_path).name+" : "+str(size)+" bytes written in "+f"{seconds:.3f}"+"s.",job=job)
+        paths.append(Path(output_path))
+    insert_logs("[INFO] "+str(len(tasks))+" parts written in "+f"{time.monotonic()-start:.3f}"+"s by "+str(partition_workers)+" processes.",job=job)
+    return paths
+
+# Done in a process of the pool : copy the byte ranges of the dataset in the file of the part, after the header
+def write_part(task):
+    dataset_path,output_path,header_bytes,ranges=task
+    start=time.monotonic()
+    with open(dataset_path,"rb") as f, open(output_path,"wb",buffering=partition_chunk_size) as out:
+        out.write(header_bytes)
+        for range_start,range_end in ranges:
+            copy_byte_range(f,out,range_start,range_end)
+        size=out.tell()
+    return output_path,size,time.monotonic()-start
 
 # ╔══════════════════════════════════════╗
 # ║          9. Sending datasets         ║
@@ -798,12 +2359,13 @@ def adapt_dataset_thread():
 # - We then check if we are at the last turn. If yes, we disconnect everyone, else we relaunch a turn
 # 2. If the last dataset hasn't been treated : 
 # - For each hub in hubs, we check if a dataset is available (classic mode) or linked to him (class mode)
-# - If we can send him a dataset, we send him one, else we tell him to wait for the next turn
+# - If we can send him a dataset, we send him one, else we tell him to wait for the next turn
+# - In classic mode, the parts left are then taken by the hubs finishing first (see Work stealing)
 # [------------------------------------------------------] 
-def download_datasets():
+def download_datasets(job):
     # >>> Variables used
-    global list_dataset, number_of_turn, number_of_turn_total
-    dataset_extension=  sql_get_single("SELECT path FROM datasets WHERE dataset_id="+dataset_id+";").split(".")[1]
+    list_dataset=job.list_dataset
+    job.dataset_extension=  job_dataset_path(job).split(".")[1]
     # >>> Case 1 : All the dataset has been treated
     all_dataset_treated=True
     for i in range(len(list_dataset)):
@@ -811,387 +2373,633 @@ def download_datasets():
                 all_dataset_treated=False
                 break
     if all_dataset_treated:
-        insert_logs("A turn has been finished. Gonna see if another turn is planned")
-        if mode_of_execution=="FL":
-            launch_aggregation_federated_learning()
+        insert_logs("A turn has been finished. Gonna see if another turn is planned",job=job)
+        if job.mode_of_execution=="FL":
+            launch_aggregation_federated_learning(job)
         else:
-            client.publish("Data/Server",construct_message("0","END OF THE TURN"))
+            publish_job_instruction(job,"END OF THE TURN")
     # >>> Case 2 : Some dataset hasn't been treated
-    elif number_of_turn<number_of_turn_total:
-        # >>> Classic Mode
-        if not typeOfSelection:
+    elif job.number_of_turn<job.number_of_turn_total:
+        staged=stage_turn_enabled(job)
+        # >>> Classic Mode
+        if not job.typeOfSelection:
 
-            for hub in hubs:
+            for hub in job.hubs:
                 for i in range(0,len(list_dataset)+1):
                     # >>> No dataset available, putting the client on hold
                     if i==len(list_dataset):
-                        insert_logs(f"{hub[0]} waiting for the next turn.")
+                        insert_logs(f"{hub[0]} waiting for the next turn.",job=job)
                         update_user_status(hub[0],"WAITING")
+                        set_user_part(hub[0],None)
                     # >>> At least one dataset available, we give it to the first client
                     elif list_dataset[i][1]=="None":
                         list_dataset[i][1]=hub[0]
-                        client.publish("hubs/"+hub[0]+"/commands",construct_message(hub[0],"DOWNLOAD DATASETS","id:"+dataset_id+"| part_number:"+list_dataset[i][0].split("/")[-1].split(".csv")[0].split("Dataset")[1]+"|name:Dataset."+dataset_extension))
+                        give_dataset_part(job,hub[0],list_dataset[i][0],staged)
                         break
         # >>> Class mode
         else:
-            for hub in hubs:
+            for hub in job.hubs:
                 for i in range (0,len(list_dataset)+1):
                     # >>> The client already treated his dataset for his turn (Normally we never come here, it is mostly a security)
                     if i==len(list_dataset):
                         update_user_status(hub[0],"WAITING")
                     # >>> The client didn't treated his dataset yet
                     elif list_dataset[i][1]==hub[0]:
-                        client.publish("hubs/"+hub[0]+"/commands",construct_message(hub[0],"DOWNLOAD DATASETS","id:"+dataset_id+"| part_number:"+list_dataset[i][0].split("/")[-1].split(".csv")[0].split("Dataset")[1]+"|name:Dataset."+dataset_extension))
+                        give_dataset_part(job,hub[0],list_dataset[i][0],staged)
                         break 
-        # >>> We then start the dataset reception thread to check the download state
-        t=Thread(target=(download_dataset_check_thread)).start()
-
-# ────────────────[Dataset reception Thread]───────────────
+        # >>> We then open the barrier of the dataset phase (or of the whole staging)
+        if staged:
+            insert_logs("[INFO] Staging the turn",job=job)
+            open_phase_barrier(job,"STAGE",("READY","WAITING"),turn_staged,phase_deadline)
+        else:
+            insert_logs("[INFO] Sending the datasets",job=job)
+            open_phase_barrier(job,"DATASETS",("MODELS","WAITING"),datasets_downloaded,phase_deadline)
+
+# ────────────────[Send a part to a hub]───────────────
+def send_dataset_part(job,name,part):
+    set_user_part(name,part)
+    fields={"id":job.dataset_id,"part_number":int(Path(part).stem.split("Dataset")[1]),"name":"Dataset."+job.dataset_extension,"job":job.work_id}
+    # >>> The key lets the hub use the part he prefetched (see Next turn)
+    if job.partition_key is not None:
+        fields["key"]=job.partition_key
+    client.publish("hubs/"+name+"/commands",hub_message(name,"DOWNLOAD DATASETS",fields))
+
+# ────────────────[All the datasets have been downloaded]───────────────
+def datasets_downloaded(job):
+    publish_job_instruction(job,"MODEL READY")
+
+# ────────────────[Staging the turn]───────────────
 # [------------------------------------------------------]
-# 1. We wait 5 Seconds
-# 2. We check the state of each hubs. If the user is found and the state show that it downloaded the dataset, skip it
-# 3. If the user isn't recognized (=disconnected), we :
-# - Classic mode : remove it from the active hub list and remove his dataset. If he was the last one, the start program is over
-# - Class Mode : Since one user is down, we totally stop the start program
-# 4. If all the user are ready to move on, we continue. Else, we restart from #1
-# [------------------------------------------------------] 
-def download_dataset_check_thread():
-        insert_logs("[INFO] Sending the datasets")
-        while(True):
-            time.sleep(5)
-            i=0
-            for hub in hubs:
-                print(user_array[0].status + "ici a la fin de dataset_adapt ("+str(len(user_array))+")")
-                j=0
-                # >>> Checking for each hub if he is still registered and his status is correct
-                for k in range(len(user_array)):
-                    if user_array[k].name==hub[0] and (user_array[k].status=="WAITING" or user_array[k].status=="DATASETS" or user_array[k].status=="MODELS"):
-                        if user_array[k].status=="MODELS" or user_array[k].status=="WAITING":
-                            i+=1
-                        break
-                    else:
-                        j+=1
-                if j==len(user_array):
-                    # >>> The user is not found, or the status is incorrect, so we're gonna remove him from the hub active list
-                    # >>> Classic mode : we remove the user
-                    if not typeOfSelection:
-                        for dataset in list_dataset:
-                            if dataset[1]==hub[0]:
-                                dataset[1]="None"
-                                break
-                        hubs.remove(hub)
-                        insert_logs(f"[INFO] {hub[0]} removed due to inactivity. Continuing without it.")
-                        if len(hubs)==0:
-                            # >>> No more active hub, so we stop the start program
-                            insert_logs("[ERROR] No more users active left. End of the start program.")
-                            return
-                    # >>> Class mode : We stop the start program
-                    else:
-                        insert_logs("[ERROR] One user disconnected. End of the start program.")
-                        for hub in hubs:
-                            for user in user_array:
-                                if user.name == hub[0]:
-                                    update_user_status(user.name,"ONLINE")
-                        return
-            # >>> All the active hub have finished their part
-            if i==len(hubs):
-                client.publish("Data/Server",construct_message("0","MODEL READY"))
-                return
+# 1. Instead of three phases (datasets, models, weight), each with its barrier, every hub gets a single STAGE JOB :
+#    the manifest of the turn, with the part, the model & the weight, each with its version and its sha256
+# 2. The hub fetches them at the same time, skips the ones he already has (same sha256), checks them, and answers READY
+# 3. A single barrier (STAGE) waits for the READY of every hub, then the execution starts
+# 4. Only if every hub of the job handles it (stage:1 given at the connexion) : the old hubs keep the three phases
+# [------------------------------------------------------]
+stage_turn = os.getenv("STAGE_TURN", "1")=="1"
+
+def stage_turn_enabled(job):
+    if not stage_turn or job.mode_of_execution=="MA":
+        return False
+    return all(registry.get(hub[0]) is not None and registry.get(hub[0]).stage for hub in job.hubs)
+
+def give_dataset_part(job,name,part,staged):
+    if staged:
+        stage_hub(job,name,part)
+    else:
+        send_dataset_part(job,name,part)
+
+# The hashes were computed when the files were written (see Adapting dataset thread, Initialisation & Aggregation) :
+# nothing is read here, on the thread of the messages. A hash missing is left out, and the hub downloads the file
+def stage_hub(job,name,part):
+    set_user_part(name,part)
+    model_file=job_model_path(job)
+    fields={"job":job.work_id,"turn":job.number_of_turn,"Mode":job.mode_of_execution,
+            "dataset":job.dataset_id,"part_number":int(Path(part).stem.split("Dataset")[1]),"dataset_name":"Dataset."+job.dataset_extension,
+            "model":job.model_id,"model_name":"Model."+model_file.split(".")[1]}
+    if job.part_hashes.get(part) is not None:
+        fields["dataset_sha256"]=job.part_hashes[part]
+    if job.model_sha256 is not None:
+        fields["model_sha256"]=job.model_sha256
+    if job.partition_key is not None:
+        fields["key"]=job.partition_key
+    if job.mode_of_execution=="FL" and job.weight_sha256 is not None:
+        fields["weight_sha256"]=job.weight_sha256
+    client.publish("hubs/"+name+"/commands",hub_message(name,"STAGE JOB",fields))
+
+# ────────────────[Every hub is ready]───────────────
+def turn_staged(job):
+    publish_job_instruction(job,"START THE EXECUTION")
 
 # ╔══════════════════════════════════════╗
 # ║          10. Sending models          ║
 # ╚══════════════════════════════════════╝
 
-# ────────────────[Send the download message & launch the model reception Thread]───────────────
+# ────────────────[Send the download message & open the model barrier]───────────────
 # [------------------------------------------------------]
 # 1. For each hub that is working, we send him to download the model
 # [------------------------------------------------------] 
-def download_models():
-    insert_logs("[INFO] Sending the models")
-    model_extension=  sql_get_single("SELECT path FROM models WHERE model_id="+model_id+";").split(".")[1]
-    for hub in hubs:
+def download_models(job):
+    insert_logs("[INFO] Sending the models",job=job)
+    model_extension=  job_model_path(job).split(".")[1]
+    for hub in job.hubs:
         if get_user_status(hub[0])!="WAITING":
-            client.publish("hubs/"+hub[0]+"/commands",construct_message(hub[0],"DOWNLOAD MODELS","id:"+str(model_id)+"|name:Model."+model_extension))
-    t=Thread(target=(download_model_check_thread)).start()
+            client.publish("hubs/"+hub[0]+"/commands",hub_message(hub[0],"DOWNLOAD MODELS",{"id":job.model_id,"name":"Model."+model_extension}))
+    open_phase_barrier(job,"MODELS",("WEIGHT","READY","WAITING"),models_downloaded,phase_deadline)
+
+# ────────────────[All the models have been downloaded]───────────────
+def models_downloaded(job):
+    if job.mode_of_execution=="FL":
+        publish_job_instruction(job,"DOWNLOAD THE WEIGHT")
+    else:
+        publish_job_instruction(job,"START THE EXECUTION")
 
-# ────────────────[Model reception Thread]───────────────
-# [------------------------------------------------------]
-# 1. We wait 5 Seconds
-# 2. We check the state of each hubs. If the user is found and the state show that it downloaded the model, skip it
-# 3. If the user isn't recognized (=disconnected), we :
-# - Classic mode : remove it from the active hub list and remove his dataset. If he was the last one, the start program is over
-# - Class Mode : Since one user is down, we totally stop the start program
-# 4. If all the user are ready to move on, we continue. Else, we restart from #1
-# [------------------------------------------------------] 
-def download_model_check_thread():
-    while(True):
-        time.sleep(5)
-        i=0
-        for hub in hubs:
-            j=0
-            # >>> Checking for each hub if he is still registered and his status is correct
-            for k in range(len(user_array)):
-                if user_array[k].name==hub[0] and (user_array[k].status=="WAITING" or user_array[k].status=="MODELS" or user_array[k].status=="WEIGHT" or user_array[k].status=="READY"):
-                    if user_array[k].status=="READY" or user_array[k].status=="WEIGHT" or user_array[k].status=="WAITING":
-                        i+=1
-                    break
-                else:
-                    j+=1
-            if j==len(user_array):
-                # >>> The user is not found, or the status is incorrect, so we're gonna remove him from the hub active list
-                # >>> Classic mode : we remove the user
-                    if not typeOfSelection:
-                        for dataset in list_dataset:
-                            if dataset[1]==hub[0]:
-                                dataset[1]="None"
-                                break
-                        hubs.remove(hub)
-                        insert_logs(f"[INFO] {hub[0]} removed due to inactivity. Continuing without it.")
-                        if len(hubs)==0:
-                            # >>> No more active hub, so we stop the start program
-                            insert_logs("[ERROR] No more users. End of the start program.")
-                            return
-                    # >>> Class mode : We stop the start program
-                    else:
-                        insert_logs("[ERROR] One user disconnected. End of the start program.")
-                        for hub in hubs:
-                            for user in user_array:
-                                if user.name == hub[0]:
-                                    update_user_status(user.name,"ONLINE")
-                        return
-        if i==len(hubs):
-            # >>> All the active hub have finished their part
-            if mode_of_execution=="FL":
-                client.publish("Data/Server",construct_message("0","DOWNLOAD THE WEIGHT"))
-            else:
-                client.publish("Data/Server",construct_message("0","START THE EXECUTION"))
-            return
-        
 # ╔══════════════════════════════════════╗
 # ║         11. Launch execution         ║
 # ╚══════════════════════════════════════╝
 
-# ────────────────[Send the execution message & launch the Execution reception Thread]───────────────
+# ────────────────[Send the execution message & open the execution barrier]───────────────
 # [------------------------------------------------------]
 # 1. For each hub that is working, we send him to launch the model
+# 2. The status is updated before the message, so a quick answer of the hub can't be overwritten
 # [------------------------------------------------------] 
-def launch_execution():
-    insert_logs("[INFO] [Launching the execution]")
-    for hub in hubs:
-        if get_user_status(hub[0])!="WAITING":
-            client.publish("hubs/"+hub[0]+"/commands",construct_message(hub[0],"LAUNCH THE MODEL","Mode:"+mode_of_execution))
+def launch_execution(job):
+    insert_logs("[INFO] [Launching the execution]",job=job)
+    for hub in job.hubs:
+        record=registry.get(hub[0])
+        if record is not None and record.status!="WAITING":
             update_user_status(hub[0],"WORKING")
-    t=Thread(target=(thread_check_execution)).start()
+            record.start_task()
+            client.publish("hubs/"+hub[0]+"/commands",hub_message(hub[0],"LAUNCH THE MODEL",{"Mode":job.mode_of_execution}))
+    open_phase_barrier(job,"EXECUTION",("FINISHED","WAITING"),execution_finished,execution_deadline,hub_finished_treating)
+
+# ────────────────[Work stealing]───────────────
+# In classic mode, a hub that finished his part during the execution takes the next free part at once,
+# instead of waiting for the slowest hub of the round. He already has the model & the weight of the turn,
+# so the part is launched as soon as it is downloaded. The turn ends when no part is left.
+work_stealing = os.getenv("WORK_STEALING", "1")=="1"
 
-# ────────────────[Execution reception Thread]───────────────
 # [------------------------------------------------------]
-# 1. We wait 5 Seconds
-# 2. We check the state of each hubs. If the user is found and the state show that it finished the execution, skip it
-# 3. If the user isn't recognized (=disconnected), we :
-# - Classic mode : remove it from the active hub list and remove his dataset. If he was the last one, the start program is over
-# - Class Mode : Since one user is down, we totally stop the start program
-# 4. If all the user are ready to move on, we continue. Else, we restart from #1
-# [------------------------------------------------------] 
-def thread_check_execution():
-    global list_dataset
-    while(True):
-        time.sleep(5)
-        i=0
-        for hub in hubs:
-            j=0
-            # >>> Checking for each hub if he is still registered and his status is correct
-            for k in range(len(user_array)):
-                if user_array[k].name==hub[0] and (user_array[k].status=="WAITING" or user_array[k].status=="WORKING" or user_array[k].status=="FINISHED"):
-                    if user_array[k].status=="FINISHED"or user_array[k].status=="WAITING":
-                        i+=1
-                        if user_array[k].status=="FINISHED":
-                            insert_logs(f"{user_array[k].name} finished treating.")
-                    break
-                else:
-                    j+=1
-            if j==len(user_array):
-                # >>> The user is not found, or the status is incorrect, so we're gonna remove him from the hub active list
-                # >>> Classic mode : we remove the user
-                    if not typeOfSelection:
-                        for dataset in list_dataset:
-                            if dataset[1]==hub[0]:
-                                dataset[1]="None"
-                                break
-                        hubs.remove(hub)
-                        insert_logs(f"[INFO] {hub[0]} removed due to inactivity. Continuing without it.")
-                        if len(hubs)==0:
-                            # >>> No more active hub, so we stop the start program
-                            insert_logs("[ERROR] No more users. End of the start program.")
-                            return
-                    # >>> Class mode : We stop the start program
-                    else:
-                        insert_logs("[ERROR] One user disconnected. End of the start program.")
-                        for hub in hubs:
-                            for user in user_array:
-                                if user.name == hub[0]:
-                                    update_user_status(user.name,"ONLINE")
-                        return
-        if i==len(hubs):
-            if mode_of_execution!="MA":
-                    # >>> All the active hub have finished their part
-                    insert_logs("Execution finished with success. Checking if more datasets need to be executed")
-
-                    for i in range(0,len(list_dataset)):
-                        if list_dataset[i][1]!="None" and list_dataset[i][1]!="Done":
-                            list_dataset[i][1]="Done"
-                    client.publish("Data/Server",construct_message(str(0),"RELAUNCH THE EXECUTION"))
-            else:
-                    client.publish("Data/Server",construct_message("0","END OF THE TURN"))
-            return
+# 1. Only during the execution phase of a classic turn, for a hub still expected by the barrier
+# 2. The part of the hub is marked as Done, and he is given the first free part (status DATASETS, so the barrier keeps waiting for him)
+# 3. Return False if there is no free part : the hub is then FINISHED
+# [------------------------------------------------------]
+def steal_next_part(job,record):
+    with barrier_lock:
+        barrier=job.barrier
+        if not work_stealing or job.typeOfSelection or job.mode_of_execution=="MA":
+            return False
+        if barrier is None or barrier.closed or barrier.name!="EXECUTION" or record.name not in barrier.pending:
+            return False
+        for dataset in job.list_dataset:
+            if dataset[1]==record.name:
+                dataset[1]="Done"
+        for dataset in job.list_dataset:
+            if dataset[1]=="None":
+                dataset[1]=record.name
+                insert_logs(f"{record.name} finished treating. Taking {Path(dataset[0]).name}.",job=job)
+                update_user_status(record.name,"DATASETS")
+                job.stealing_hubs.add(record.name)
+                send_dataset_part(job,record.name,dataset[0])
+                return True
+        return False
+
+# ────────────────[A stolen part has been downloaded]───────────────
+def launch_stolen_part(job,record):
+    with barrier_lock:
+        if record.name not in job.stealing_hubs:
+            return False
+        job.stealing_hubs.discard(record.name)
+        update_user_status(record.name,"WORKING")
+        record.start_task()
+        client.publish("hubs/"+record.name+"/commands",hub_message(record.name,"LAUNCH THE MODEL",{"Mode":job.mode_of_execution}))
+        return True
+
+# ────────────────[A hub finished his execution]───────────────
+def hub_finished_treating(job,name):
+    if get_user_status(name)=="FINISHED":
+        insert_logs(f"{name} finished treating.",job=job)
+
+# ────────────────[All the hubs finished their execution]───────────────
+def execution_finished(job):
+    list_dataset=job.list_dataset
+    if job.mode_of_execution!="MA":
+        # >>> All the active hub have finished their part
+        insert_logs("Execution finished with success. Checking if more datasets need to be executed",job=job)
+        for i in range(0,len(list_dataset)):
+            if list_dataset[i][1]!="None" and list_dataset[i][1]!="Done":
+                list_dataset[i][1]="Done"
+        publish_job_instruction(job,"RELAUNCH THE EXECUTION")
+    else:
+        publish_job_instruction(job,"END OF THE TURN")
 
 # ╔══════════════════════════════════════╗
 # ║   12. Federated Learning - Weights   ║
 # ╚══════════════════════════════════════╝
 
-# ────────────────[Send the weight message & launch the weight reception Thread]───────────────
+# ────────────────[Send the weight message & open the weight barrier]───────────────
 # [------------------------------------------------------]
 # 1. For each hub that is working, we send him to launch the model
 # [------------------------------------------------------] 
-def download_weight():
-    insert_logs("[INFO] Sending the Weight")
-    for hub in hubs:
+def download_weight(job):
+    insert_logs("[INFO] Sending the Weight",job=job)
+    for hub in job.hubs:
         if get_user_status(hub[0])!="WAITING":
-            client.publish("hubs/"+hub[0]+"/commands",construct_message(hub[0],"DOWNLOAD WEIGHT"))
-    t=Thread(target=(download_weight_check_thread)).start()
-       
-# ────────────────[Weight reception Thread]───────────────
-# [------------------------------------------------------]
-# 1. We wait 5 Seconds
-# 2. We check the state of each hubs. If the user is found and the state show that it finished the execution, skip it
-# 3. If the user isn't recognized (=disconnected), we :
-# - Classic mode : remove it from the active hub list and remove his dataset. If he was the last one, the start program is over
-# - Class Mode : Since one user is down, we totally stop the start program
-# 4. If all the user are ready to move on, we continue. Else, we restart from #1
-# [------------------------------------------------------] 
-def download_weight_check_thread():
-    while(True):
-        time.sleep(5)
-        i=0
-        for hub in hubs:
-            j=0            
-            # >>> Checking for each hub if he is still registered and his status is correct
-            for k in range(len(user_array)):
-                if user_array[k].name==hub[0] and (user_array[k].status=="WAITING" or user_array[k].status=="WEIGHT" or user_array[k].status=="READY"):
-                    if user_array[k].status=="READY" or user_array[k].status=="WAITING":
-                        i+=1
-                    break
-                else:
-                    j+=1
-            if j==len(user_array):
-                # >>> The user is not found, or the status is incorrect, so we're gonna remove him from the hub active list
-                # >>> Classic mode : we remove the user
-                    if not typeOfSelection:
-                        for dataset in list_dataset:
-                            if dataset[1]==hub[0]:
-                                dataset[1]="None"
-                                break
-                        hubs.remove(hub)
-                        insert_logs(f"[INFO] {hub[0]} removed due to inactivity. Continuing without it.")
-                        if len(hubs)==0:
-                            # >>> No more active hub, so we stop the start program
-                            insert_logs("[ERROR] No more users. End of the start program.")
-                            return
-                    # >>> Class mode : We stop the start program
-                    else:
-                        insert_logs("[ERROR] One user disconnected. End of the start program.")
-                        for hub in hubs:
-                            for user in user_array:
-                                if user.name == hub[0]:
-                                    update_user_status(user.name,"ONLINE")
-                        return
-        if i==len(hubs):
-            # >>> All the active hub have finished their part
-            client.publish("Data/Server",construct_message("0","START THE EXECUTION"))
-            return
+            client.publish("hubs/"+hub[0]+"/commands",hub_message(hub[0],"DOWNLOAD WEIGHT",{"job":job.work_id}))
+    open_phase_barrier(job,"WEIGHT",("READY","WAITING"),weight_downloaded,phase_deadline)
 
+# ────────────────[All the weights have been downloaded]───────────────
+def weight_downloaded(job):
+    publish_job_instruction(job,"START THE EXECUTION")
+       
 # ╔══════════════════════════════════════╗
 # ║ 13. Federated Learning - Aggregation ║
 # ╚══════════════════════════════════════╝
-# ────────────────[Launch the aggregation program]───────────────
-# [------------------------------------------------------]
-# 1. We wait 5 Seconds
-# 2. We check the state of each hubs. If the user is found and the state show that it finished the execution, skip it
-# 3. If the user isn't recognized (=disconnected), we :
-# - Classic mode : remove it from the active hub list and remove his dataset. If he was the last one, the start program is over
-# - Class Mode : Since one user is down, we totally stop the start program
-# 4. If all the user are ready to move on, we continue. Else, we restart from #1
+# ────────────────[Aggregation worker]───────────────
+# The model program of a job is imported once, in a worker process kept for the whole job (job.aggregator).
+# The initialisation & the aggregations are then function calls to this worker, instead of a new python3 at each turn.
+# If the model program doesn't give mode_initialization / mode_aggregation, the python3 program is used as before.
+# AGGREGATION_WORKER=0 always uses the python3 program.
+aggregation_worker_enabled = os.getenv("AGGREGATION_WORKER", "1")=="1"
+
+# [------------------------------------------------------]
+# 1. The worker of the job is started at the first use (and started again if it died)
+# 2. The lines printed by the model are written in the logs of the job, under log_name
+# 3. Raise an exception if the mode failed
+# [------------------------------------------------------]
+def run_model_mode(job,model_path,mode,log_name,**arguments):
+    on_log=model_logs(job,log_name)
+    if aggregation_worker_enabled:
+        get_aggregator(job,model_path)
+        start=time.time()
+        try:
+            job.aggregator.call(mode,on_log,**{k:str(v) if isinstance(v,Path) else v for k,v in arguments.items()})
+            insert_logs(f"[INFO] {log_name} done by the aggregation worker in {time.time()-start:.2f}s.",job=job)
+            return
+        except AggregationUnavailable as e:
+            insert_logs(f"[INFO] {e}. Using the python3 program.",job=job)
+    command=["python3",model_path,"--mode",mode]
+    for key,value in arguments.items():
+        command+=["--"+key.replace("_","-"),str(value)]
+    p=subprocess.Popen(command,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True)
+    for line in p.stdout:
+        on_log(line)
+    if p.wait()!=0:
+        raise AggregationWorkerError(f"{model_path} --mode {mode} exited with the code {p.returncode}")
+
+# ────────────────[Worker of a job]───────────────
+def get_aggregator(job,model_path=None):
+    if job.aggregator is None or not job.aggregator.alive():
+        stop_aggregator(job)
+        if model_path is None:
+            model_path=job_model_path(job)
+        job.aggregator=AggregationWorker(model_path)
+    return job.aggregator
+
+# ────────────────[Lines printed by the model, written in the logs of the job]───────────────
+def model_logs(job,log_name):
+    return lambda line: insert_logs(line.rstrip(),log_name,job)
+
+# ────────────────[Stop the worker of a job]───────────────
+def stop_aggregator(job):
+    aggregator,job.aggregator=job.aggregator,None
+    if aggregator is not None:
+        Thread(target=aggregator.stop,daemon=True).start()
+
+# ────────────────[Streaming aggregation]───────────────
+# The weight of each hub is folded in a running weighted mean (FedAvg) by the worker of the job as soon as it arrives,
+# the weight of a hub being the number of rows of his part. The aggregation at the end of the turn then only divides the sums.
+# The files stay in Result/<job> : if the running mean failed, they are folded again at the end of the turn, with the same weights.
+# STREAMING_AGGREGATION=0 always aggregates the files at the end of the turn.
+streaming_aggregation = os.getenv("STREAMING_AGGREGATION", "1")=="1"
+
+# ────────────────[Start the running mean of a turn]───────────────
+def start_streaming_aggregation(job):
+    job.folded=None
+    if not (aggregation_worker_enabled and streaming_aggregation):
+        return
+    try:
+        get_aggregator(job).submit("reset",model_logs(job,"Aggregation"))
+        job.folded=0
+    except Exception as e:
+        insert_logs("[WARNING] The streaming aggregation can't start, the weights will be aggregated at the end of the turn. Exception : "+str(e),job=job)
+
+# ────────────────[Fold the weight of a hub]───────────────
+# [------------------------------------------------------]
+# 1. The part of the hub is found with the name of his weight (dataset<n>.pth -> Dataset<n>.csv)
+# 2. The rows of the part are counted by the dispatcher of the worker, not by the thread of the messages
+# 3. If the worker died during the turn, the running mean is lost : the files will be aggregated at the end of the turn
+# [------------------------------------------------------]
+def fold_hub_weight(job,weight_path,file_name):
+    if job.folded is None:
+        return
+    if job.aggregator is None or not job.aggregator.alive():
+        insert_logs("[WARNING] The aggregation worker stopped during the turn, the weights will be aggregated at the end of the turn.",job=job)
+        job.folded=None
+        return
+    job.aggregator.submit("fold",model_logs(job,"Aggregation"),path=str(weight_path),weight=lambda: hub_weight_samples(job,file_name))
+    job.folded+=1
+
+# ────────────────[Weight of a hub in the mean]───────────────
+# Number of rows of the part of the hub, found with the name of his weight (dataset<n>.pth -> Dataset<n>.csv)
+def hub_weight_samples(job,file_name):
+    part_name="Dataset"+Path(file_name).stem.split("dataset")[-1]
+    part_path=next((dataset[0] for dataset in job.list_dataset if Path(dataset[0]).stem==part_name),None)
+    if part_path is None:
+        return 1
+    return count_dataset_rows(part_path)[0] or 1
+
+# ────────────────[End of the running mean]───────────────
+# Return True if the new weight of the job has been saved, with every weight of the turn folded
+def finalize_streaming_aggregation(job):
+    if job.folded is None or job.aggregator is None:
+        return False
+    failures=job.aggregator.drain()
+    if not failures:
+        try:
+            count=job.aggregator.call("finalize",model_logs(job,"Aggregation"),output_path=str(job.weight_path))
+            if count==job.folded:
+                return True
+            failures=[f"{count} weights folded instead of {job.folded}"]
+        except AggregationWorkerError as e:
+            failures=[str(e)]
+    insert_logs("[WARNING] The streaming aggregation failed ("+" / ".join(failures)+"). Aggregating the files.",job=job)
+    return False
+
+# ────────────────[Weighted aggregation of the files]───────────────
+# [------------------------------------------------------]
+# 1. When the running mean failed, every weight in Result/<job> is folded again by the worker (started again if it died)
+# 2. Each file has the weight it would have had in the running mean (see hub_weight_samples)
+# 3. Return False if the worker can't do it : the files are then aggregated by mode_aggregation
+# [------------------------------------------------------]
+def aggregate_result_files(job):
+    files=sorted(job.result_dir.glob("*.pth"))
+    on_log=model_logs(job,"Aggregation")
+    try:
+        aggregator=get_aggregator(job)
+        aggregator.call("reset",on_log)
+        for path in files:
+            aggregator.call("fold",on_log,path=str(path),weight=hub_weight_samples(job,path.name))
+        count=aggregator.call("finalize",on_log,output_path=str(job.weight_path))
+        if count==len(files):
+            return True
+        failure=f"{count} weights folded instead of {len(files)}"
+    except AggregationWorkerError as e:
+        failure=str(e)
+    insert_logs("[WARNING] The weights can't be folded again ("+failure+"). Using mode_aggregation, without the weights of the hubs.",job=job)
+    return False
+
+# ────────────────[Launch the aggregation]───────────────
+# [------------------------------------------------------]
+# 1. The running mean of the turn is finalized (see Streaming aggregation)
+# 2. If it failed, the weights received in Result/<job> are folded again with the same weights
+# 3. Else (streaming aggregation off), mode_aggregation merges the weights of Result/<job> into the new server weight of the job
+# 4. When it's done, the weight is saved in the logs of the turn and the turn is ended
 # [------------------------------------------------------] 
-def launch_aggregation_federated_learning():
-    t=Thread(target=aggregation_federated_learning_thread).start()
-
-def aggregation_federated_learning_thread():
-        result_file= default_path / "Result"
-        output_path= default_path / "Weights" / "server_weight.pth"
-        model_path=  sql_get_single("SELECT path FROM models WHERE model_id="+model_id+";")
-        p = subprocess.Popen([
-        "python3", 
-        model_path,
-        "--mode", "aggregate", 
-        "--weights-dir",    result_file,
-        "--output-path", output_path
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-        )
-        for line in p.stdout:
-            insert_logs(line.rstrip(),"Aggregation")
-        p.wait()
-        insert_logs("Finished treating the Aggregation.")
-        os.makedirs(default_path / "logs" / str(work_id) / str(number_of_turn) / "result", exist_ok=True)
-        shutil.copy(output_path,default_path / "logs" / str(work_id) / str(number_of_turn) / "result" / "weight_server.pth")
-        client.publish("Data/Server",construct_message("0","END OF THE TURN"))
+def launch_aggregation_federated_learning(job):
+    t=Thread(target=aggregation_federated_learning_thread,args=(job,)).start()
+
+def aggregation_federated_learning_thread(job):
+        start=time.time()
+        try:
+            os.makedirs(job.weight_path.parent, exist_ok=True)
+            aggregated=finalize_streaming_aggregation(job)
+            if not aggregated and aggregation_worker_enabled and streaming_aggregation:
+                aggregated=aggregate_result_files(job)
+            if not aggregated:
+                run_model_mode(job,job_model_path(job),"aggregate","Aggregation",weights_dir=job.result_dir,output_path=job.weight_path)
+            job.weight_sha256=file_sha256(job.weight_path)
+        except Exception as e:
+            insert_logs("[ERROR] The aggregation failed. End of the start program. Exception : "+str(e),job=job)
+            end_job(job,"ERROR")
+            return
+        phase_recorder.record(job,"aggregate",start,time.time())
+        insert_logs("Finished treating the Aggregation.",job=job)
+        os.makedirs(job.turn_dir / "result", exist_ok=True)
+        shutil.copy(job.weight_path,job.turn_dir / "result" / "weight_server.pth")
+        publish_job_instruction(job,"END OF THE TURN")
 
 # ╔══════════════════════════════════════╗
 # ║         14. Files of the logs        ║
 # ╚══════════════════════════════════════╝
-
-def logs_to_file(message, user="Server"):
-    if mode_of_execution!="MA" and mode_of_execution!="None" and user!="Server" :
-        if user!="Initialisation" and user!="Aggregation":
-            for dataset in list_dataset:
-                if dataset[1]==user:
-                    name_of_file=dataset[0].split("/")[-1]
-                    file_directory=default_path / "logs" / str(work_id) / str(number_of_turn) / "logs"
-                    file_path= file_directory / (name_of_file.split(".")[0]+".txt")
+# The logs are written by a background thread : insert_logs only puts them in a bounded queue.
+# The writer inserts them in the database by batches (COPY), and keeps the log files opened.
+
+# Size of the queue, maximum number of logs in a batch, time between two flushes & two fsync (in seconds), number of files kept opened
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+log_batch_size = int(os.getenv("LOG_BATCH_SIZE", "500"))
+log_flush_secs = float(os.getenv("LOG_FLUSH_SECS", "0.5"))
+log_drop_report_secs = float(os.getenv("LOG_DROP_REPORT_SECS", "10"))
+log_fsync_secs = float(os.getenv("LOG_FSYNC_SECS", "5"))
+log_max_open_files = int(os.getenv("LOG_MAX_OPEN_FILES", "64"))
+
+# ────────────────[Getting the file of a log]───────────────
+# [------------------------------------------------------]
+# 1. The file depends on the job (the one given, or the one of the hub), the turn and the part treated by the hub when the log is received
+# 2. It is computed when the log is inserted, the writer only opening the file
+# [------------------------------------------------------]
+def logs_file_path(user="Server",job=None):
+    record=registry.get(user)
+    if job is None and record is not None:
+        job=record.job
+    if job is None or job.number_of_turn==-1:
+        return default_path / "logs" / "Server" / "Server.txt"
+    mode_of_execution=job.mode_of_execution
+    if mode_of_execution!="MA" and user!="Server" :
+        if user!="Initialisation" and user!="Aggregation" and record is not None and record.part is not None:
+            name_of_file=record.part.split("/")[-1]
+            file_path=job.turn_dir / "logs" / (name_of_file.split(".")[0]+".txt")
         else:
-            file_directory=default_path / "logs" / str(work_id) / str(number_of_turn) / "logs"
-            file_path= file_directory / "Server.txt"
+            file_path=job.turn_dir / "logs" / "Server.txt"
     else:
-        if number_of_turn==-1:
-            file_directory=default_path / "logs" / "Server" 
-            file_path=default_path / "logs" / "Server" / "Server.txt"
-        elif mode_of_execution=="MA" and user!="Server" and user!="Initialisation" and user!="Aggregation":
-            file_directory=default_path / "logs" / str(work_id) / str(number_of_turn) / "logs"
-            file_path= file_directory / ("execution.txt")
+        if mode_of_execution=="MA" and user!="Server" and user!="Initialisation" and user!="Aggregation":
+            file_path=job.turn_dir / "logs" / "execution.txt"
         else:
-            file_directory=default_path / "logs" / str(work_id) / str(number_of_turn) / "logs"
-            file_path= file_directory / "Server.txt"
-    os.makedirs(file_directory, exist_ok=True)
-    with open(file_path,"a") as f:
-        f.write(message +"\n")
-    
-
+            file_path=job.turn_dir / "logs" / "Server.txt"
+    return file_path
 
+# ────────────────[Log pipeline]───────────────
+# [------------------------------------------------------]
+# 1. The logs are put in a bounded queue. If it is full, the log is dropped (and counted) instead of blocking the MQTT thread
+# 2. The writer thread takes the logs by batches : every log_batch_size logs, or every log_flush_secs
+#    The number of logs dropped since the last report is printed by the writer, at most every log_drop_report_secs
+# 3. A batch is inserted with a single COPY into logs, on a connexion used only by the writer
+#    If the COPY fails, it is tried again once on a new connexion, then the logs are inserted with executemany
+# 4. The log files are kept opened (the least recently used ones are closed), flushed at every batch and fsync regularly
+# 5. The queue depth and the latency of the flushes can be read with stats()
+# [------------------------------------------------------]
+class LogPipeline:
+    def __init__(self):
+        self.queue=queue.Queue(maxsize=log_queue_size)
+        self.files=OrderedDict()
+        self.connexion=None
+        self.thread=None
+        self.stopping=False
+        self.last_fsync=time.monotonic()
+        self.dropped=0
+        self.reported_drops=0
+        self.last_drop_report=time.monotonic()
+        self.flushes=0
+        self.flushed_logs=0
+        self.flush_time_total=0.0
+        self.last_flush_latency=0.0
+        self.max_flush_latency=0.0
+
+    def start(self):
+        if self.thread is None:
+            self.thread=Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    # Write every log still in the queue, and close the files
+    def stop(self):
+        self.stopping=True
+        if self.thread is not None:
+            self.thread.join()
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def put(self,message,user,file_path):
+        try:
+            self.queue.put_nowait((user,message,datetime.now(),file_path))
+        except queue.Full:
+            self.dropped+=1
+
+    def stats(self):
+        return {
+            "queue_depth":self.queue.qsize(),
+            "dropped":self.dropped,
+            "flushes":self.flushes,
+            "flushed_logs":self.flushed_logs,
+            "last_flush_latency":self.last_flush_latency,
+            "max_flush_latency":self.max_flush_latency,
+            "average_flush_latency":self.flush_time_total/self.flushes if self.flushes else 0.0,
+        }
+
+    def run(self):
+        batch=[]
+        deadline=time.monotonic()+log_flush_secs
+        while not (self.stopping and self.queue.empty() and not batch):
+            try:
+                batch.append(self.queue.get(timeout=max(0.0,deadline-time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch)>=log_batch_size or time.monotonic()>=deadline:
+                if batch:
+                    self.flush(batch)
+                    batch=[]
+                self.report_drops()
+                deadline=time.monotonic()+log_flush_secs
+        self.report_drops(force=True)
+
+    # Print the number of logs dropped since the last report
+    def report_drops(self,force=False):
+        dropped=self.dropped
+        if dropped==self.reported_drops:
+            return
+        if not force and time.monotonic()-self.last_drop_report<log_drop_report_secs:
+            return
+        print("[WARNING] Log queue full, "+str(dropped-self.reported_drops)+" logs dropped since the last report ("+str(dropped)+" in total)")
+        self.reported_drops=dropped
+        self.last_drop_report=time.monotonic()
+
+    def flush(self,batch):
+        start=time.monotonic()
+        self.write_database(batch)
+        self.write_files(batch)
+        latency=time.monotonic()-start
+        self.flushes+=1
+        self.flushed_logs+=len(batch)
+        self.flush_time_total+=latency
+        self.last_flush_latency=latency
+        self.max_flush_latency=max(self.max_flush_latency,latency)
+
+    def write_database(self,batch):
+        rows=[(user,message,"type",timestamp) for user,message,timestamp,_ in batch]
+        # >>> COPY, tried again once on a new connexion
+        for attempt in range(2):
+            try:
+                self.copy_rows(rows)
+                return
+            except Exception as e:
+                print("[ERROR] COPY of "+str(len(rows))+" logs failed ("+e.__class__.__name__+") : "+str(e))
+                self.reset_connexion()
+        # >>> Then the rows are inserted with executemany
+        try:
+            with self.connexion_ready().cursor() as cursor_sql:
+                cursor_sql.executemany("INSERT INTO logs (hub_name, logs, type, timestamp) VALUES (%s, %s, %s, %s)",rows)
+            self.connexion.commit()
+        except Exception as e:
+            print("[ERROR] "+str(len(rows))+" logs couldn't be inserted in the database ("+e.__class__.__name__+") : "+str(e))
+            self.reset_connexion()
+
+    def connexion_ready(self):
+        if self.connexion is None or self.connexion.closed:
+            self.connexion=open_sql_connexion()
+        return self.connexion
+
+    def copy_rows(self,rows):
+        buffer=io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with self.connexion_ready().cursor() as cursor_sql:
+            cursor_sql.copy_expert("COPY logs (hub_name, logs, type, timestamp) FROM STDIN WITH (FORMAT csv)",buffer)
+        self.connexion.commit()
+
+    # After an error, the connexion is closed : a new one is opened at the next write
+    def reset_connexion(self):
+        if self.connexion is None:
+            return
+        try:
+            self.connexion.close()
+        except Exception:
+            pass
+        self.connexion=None
+
+    def write_files(self,batch):
+        lines={}
+        for _,message,_,file_path in batch:
+            lines.setdefault(file_path,[]).append(message+"\n")
+        for file_path,content in lines.items():
+            try:
+                self.open_file(file_path).write("".join(content))
+            except OSError as e:
+                print("[ERROR] Log file "+str(file_path)+" couldn't be written : "+str(e))
+        for f in self.files.values():
+            f.flush()
+        if time.monotonic()-self.last_fsync>=log_fsync_secs:
+            for f in self.files.values():
+                os.fsync(f.fileno())
+            self.last_fsync=time.monotonic()
+
+    def open_file(self,file_path):
+        f=self.files.get(file_path)
+        if f is not None:
+            self.files.move_to_end(file_path)
+            return f
+        os.makedirs(file_path.parent,exist_ok=True)
+        f=open(file_path,"a")
+        self.files[file_path]=f
+        if len(self.files)>log_max_open_files:
+            _,oldest=self.files.popitem(last=False)
+            oldest.close()
+        return f
+
+log_pipeline=LogPipeline()
+
+# ────────────────[Received the weight of a hub]───────────────
+# [------------------------------------------------------]
+# 1. The hub uploaded his weight to the API (PUT /artifact), which checked its sha256 and moved it in Result/<job> :
+#    the message only carries name, sha256 & size, and we check the file is there with the right size
+# 2. Old hubs send the weight inside the message : in base64 in a legacy message, in bytes in a binary one (see decrypt_message)
+# 3. The weight is copied in the logs of the turn and folded in the aggregation of the turn
+# [------------------------------------------------------]
+def received_hub_weight(job,payload_data):
+    if payload_data.get("inside") is not None:
+        decrypt_message(job,payload_data)
+        return
+    file_name=payload_data.get("name")
+    size=payload_data.get("size")
+    weight_path=job.result_dir / Path(file_name or "").name
+    if not file_name or not weight_path.is_file() or str(weight_path.stat().st_size)!=str(size):
+        insert_logs(f"[ERROR] Weight {file_name} of {payload_data[0]} not found in the uploads (sha256 {payload_data.get('sha256')}).",job=job)
+        return
+    shutil.copyfile(weight_path,job.turn_dir / "result" / weight_path.name)
+    fold_hub_weight(job,weight_path,weight_path.name)
 
-def decrypt_message(payload_data):
+def decrypt_message(job,payload_data):
     """
     Prend une chaîne Base64 et recrée le fichier binaire.
     """
     try:
-        # 1. Ré-encoder la chaîne de caractères en octets
-        encoded_bytes = payload_data[3].split("inside:")[1].encode('utf-8')
+        # 1. Un message binaire donne directement les octets, un message texte les donne en Base64
+        inside = payload_data.get("inside")
         
         # 2. Décoder les octets Base64 pour obtenir le contenu binaire original
-        binary_data = base64.b64decode(encoded_bytes)
-        file_name=payload_data[3].split("name:")[1].split("|")[0]
+        binary_data = inside if isinstance(inside, bytes) else base64.b64decode(inside.encode('utf-8'))
+        file_name=payload_data.get("name")
 
-        BASE_DIR = default_path / "Result"
+        BASE_DIR = job.result_dir
     
         # 2. Construire le chemin complet du fichier de sortie
         output_path = os.path.join(BASE_DIR, file_name)
@@ -1203,10 +3011,345 @@ def decrypt_message(payload_data):
             file.write(binary_data)
             
         print(f"Fichier recréé avec succès : {output_path}")
-        shutil.copyfile(output_path,default_path / "logs" / str(work_id) / str(number_of_turn) / "result" / file_name)
+        shutil.copyfile(output_path,job.turn_dir / "result" / file_name)
+        # 4. Ajouter les poids à la moyenne du tour (voir Streaming aggregation)
+        fold_hub_weight(job,output_path,file_name)
     except Exception as e:
         print(f"Erreur lors du décodage et de l'écriture du fichier : {e}")
 
+# ╔══════════════════════════════════════╗
+# ║     14bis. Phase timings & metrics   ║
+# ╚══════════════════════════════════════╝
+# Where the time of a turn goes : each phase of a job (partition, fetch of the dataset, model & weight, execution, upload,
+# aggregation...) is timed, per hub when it concerns a hub. The timings are written in the table phase_timings,
+# and kept in histograms exported in the Prometheus text format on http://<server>:METRICS_PORT/metrics.
+
+# Port of the metrics endpoint (0 = no endpoint), and time between two writes of the timings (in seconds)
+metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+phase_flush_secs = float(os.getenv("PHASE_FLUSH_SECS", "2"))
+# Upper bounds of the buckets of the histograms (in seconds)
+metric_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Phase of a hub reporting to a barrier
+barrier_phases = {"DATASETS": "dataset_fetch", "MODELS": "model_fetch", "WEIGHT": "weight_fetch", "STAGE": "stage"}
+
+class Histogram:
+    __slots__=("counts","sum","count")
+
+    def __init__(self):
+        self.counts=[0]*(len(metric_buckets)+1)
+        self.sum=0.0
+        self.count=0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(metric_buckets,value)]+=1
+        self.sum+=value
+        self.count+=1
+
+# ────────────────[Registry of the metrics]───────────────
+# [------------------------------------------------------]
+# 1. A metric is identified by its name and its labels : observe() for a histogram, inc() for a counter
+# 2. render() gives every metric in the Prometheus text format (cumulative buckets, _sum & _count)
+# 3. The values kept elsewhere (log pipeline, SQL timings) are read when rendering, by the collectors given to collect() :
+#    a collector returns (name, kind, labels, value) for each of its values
+# [------------------------------------------------------]
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms={}
+        self.counters={}
+        self.descriptions={}
+        self.collectors=[]
+        self.lock=threading.Lock()
+
+    def collect(self,collector):
+        self.collectors.append(collector)
+
+    def describe(self,name,description):
+        self.descriptions[name]=description
+
+    def observe(self,name,value,**labels):
+        key=(name,tuple(sorted(labels.items())))
+        with self.lock:
+            histogram=self.histograms.get(key)
+            if histogram is None:
+                histogram=self.histograms[key]=Histogram()
+            histogram.observe(max(0.0,value))
+
+    def inc(self,name,value=1,**labels):
+        key=(name,tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key]=self.counters.get(key,0)+value
+
+    def render(self):
+        lines=[]
+        with self.lock:
+            for kind,metrics in (("counter",self.counters),("histogram",self.histograms)):
+                for name in sorted({name for name,_ in metrics}):
+                    if name in self.descriptions:
+                        lines.append(f"# HELP {name} {self.descriptions[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric,labels),value in sorted(metrics.items()):
+                        if metric!=name:
+                            continue
+                        if kind=="counter":
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+                            continue
+                        cumulative=0
+                        for bound,count in zip(metric_buckets+("+Inf",),value.counts):
+                            cumulative+=count
+                            lines.append(f"{name}_bucket{format_labels(labels+(('le',str(bound)),))} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                        lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+        samples={}
+        for collector in self.collectors:
+            try:
+                for name,kind,labels,value in collector():
+                    samples.setdefault((name,kind),[]).append((tuple(sorted(labels.items())),value))
+            except Exception:
+                traceback.print_exc()
+        for (name,kind),values in samples.items():
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels,value in values:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines)+"\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join(f'{key}="{str(value).replace(chr(92),chr(92)*2).replace(chr(34),chr(92)+chr(34))}"' for key,value in labels)+"}"
+
+metrics=MetricsRegistry()
+metrics.describe("fl_phase_seconds","Duration of a phase of a turn")
+metrics.describe("fl_turn_seconds","Duration of a turn")
+metrics.describe("fl_barrier_wait_seconds","Time between the opening and the closing of a phase barrier")
+metrics.describe("fl_straggler_gap_seconds","Time between the first and the last hub reporting to a phase barrier")
+metrics.describe("fl_bytes_transferred_total","Bytes of the datasets, models & weights sent to or received from the hubs")
+
+# ────────────────[Metrics of the log pipeline]───────────────
+def log_pipeline_metrics():
+    stats=log_pipeline.stats()
+    return [
+        ("fl_log_queue_depth","gauge",{},stats["queue_depth"]),
+        ("fl_log_dropped_total","counter",{},stats["dropped"]),
+        ("fl_log_flushes_total","counter",{},stats["flushes"]),
+        ("fl_log_flushed_total","counter",{},stats["flushed_logs"]),
+        ("fl_log_flush_latency_seconds","gauge",{"stat":"last"},stats["last_flush_latency"]),
+        ("fl_log_flush_latency_seconds","gauge",{"stat":"max"},stats["max_flush_latency"]),
+        ("fl_log_flush_latency_seconds","gauge",{"stat":"average"},stats["average_flush_latency"]),
+    ]
+
+metrics.collect(log_pipeline_metrics)
+
+# ────────────────[Metrics of the SQL queries]───────────────
+def sql_metrics():
+    samples=[]
+    for query,count,total,maximum in sql_timings.summary():
+        samples.append(("fl_sql_queries_total","counter",{"query":query},count))
+        samples.append(("fl_sql_query_seconds_total","counter",{"query":query},total))
+        samples.append(("fl_sql_query_max_seconds","gauge",{"query":query},maximum))
+    return samples
+
+metrics.collect(sql_metrics)
+metrics.describe("fl_sql_queries_total","Queries executed by the server, per query text")
+metrics.describe("fl_sql_query_seconds_total","Time spent in the queries, per query text")
+metrics.describe("fl_sql_query_max_seconds","Longest execution of a query, per query text")
+metrics.describe("fl_log_queue_depth","Logs waiting in the queue of the log pipeline")
+metrics.describe("fl_log_dropped_total","Logs dropped because the queue of the log pipeline was full")
+metrics.describe("fl_log_flushes_total","Batches of logs written by the log pipeline")
+metrics.describe("fl_log_flushed_total","Logs written by the log pipeline")
+metrics.describe("fl_log_flush_latency_seconds","Time to write a batch of logs (last, max & average)")
+
+# ────────────────[Phase recorder]───────────────
+# [------------------------------------------------------]
+# 1. record() puts the duration of the phase in the histogram at once, and the row in pending
+# 2. Every phase_flush_secs, the pending rows are written with a single INSERT
+# 3. If the write fails, the rows are kept for the next one (at most phase_pending_max rows)
+# [------------------------------------------------------]
+phase_pending_max = 10000
+
+class PhaseRecorder:
+    def __init__(self,interval):
+        self.interval=interval
+        self.pending=[]
+        self.lock=threading.Lock()
+        self.thread=None
+        self.stopping=threading.Event()
+
+    def record(self,job,phase,start,end,hub=None,size=None):
+        metrics.observe("fl_phase_seconds",end-start,phase=phase)
+        if size:
+            metrics.inc("fl_bytes_transferred_total",size,phase=phase)
+        if job.trace is not None:
+            job.trace.add(job.number_of_turn,phase,start,end,hub,size)
+        with self.lock:
+            if len(self.pending)<phase_pending_max:
+                self.pending.append((job.work_id,job.number_of_turn,hub,phase,datetime.fromtimestamp(start),datetime.fromtimestamp(end),end-start,size))
+
+    def start(self):
+        if self.thread is None:
+            self.thread=Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            rows,self.pending=self.pending,[]
+        try:
+            with sql_cursor() as cursor_sql:
+                execute_values(cursor_sql,"INSERT INTO phase_timings (job_id, turn, hub_name, phase, start_time, end_time, duration, bytes) VALUES %s",rows)
+        except Exception as e:
+            print("[ERROR] "+str(len(rows))+" phase timings couldn't be written in the database ("+e.__class__.__name__+") : "+str(e))
+            with self.lock:
+                self.pending=(rows+self.pending)[:phase_pending_max]
+
+phase_recorder=PhaseRecorder(phase_flush_secs)
+
+# ────────────────[Job trace]───────────────
+# [------------------------------------------------------]
+# 1. JOB_TRACE=1 : every phase recorded for a job is also kept as a span of its timeline (Trace Event Format),
+#    and written in logs/<work_id>/trace.json at each turn and at the end of the job
+# 2. One track per hub, and three for the server : its phases (partition, aggregation, turn), the barriers, and the
+#    preparation of the next turn (which overlaps the others)
+# 3. The file loads in chrome://tracing or https://ui.perfetto.dev
+# [------------------------------------------------------]
+job_trace = os.getenv("JOB_TRACE", "0")=="1"
+# Track of the phases of the server that overlap the others
+trace_server_tracks = {"prepare_next": "Server - next turn"}
+
+class JobTrace:
+    def __init__(self):
+        self.events=[]
+        self.tracks={}
+        self.lock=threading.Lock()
+
+    def track(self,name):
+        tid=self.tracks.get(name)
+        if tid is None:
+            tid=self.tracks[name]=len(self.tracks)+1
+            self.events.append({"name":"thread_name","ph":"M","pid":1,"tid":tid,"args":{"name":name}})
+            self.events.append({"name":"thread_sort_index","ph":"M","pid":1,"tid":tid,"args":{"sort_index":tid}})
+        return tid
+
+    def add(self,turn,phase,start,end,hub=None,size=None):
+        if hub is not None:
+            name=hub
+        elif phase.startswith("barrier_"):
+            name="Server - barriers"
+        else:
+            name=trace_server_tracks.get(phase,"Server")
+        arguments={"turn":turn+1}
+        if size:
+            arguments["bytes"]=size
+        with self.lock:
+            self.events.append({"name":phase,"cat":"turn "+str(turn+1),"ph":"X","pid":1,"tid":self.track(name),
+                                "ts":int(start*1e6),"dur":max(0,int((end-start)*1e6)),"args":arguments})
+
+    # The file is replaced at once, a viewer never reads half of it
+    def write(self,path,work_id):
+        with self.lock:
+            events=[{"name":"process_name","ph":"M","pid":1,"args":{"name":"Job "+str(work_id)}}]+list(self.events)
+        os.makedirs(path.parent,exist_ok=True)
+        temporary_path=path.with_name(path.name+".tmp")
+        with open(temporary_path,"w") as f:
+            json.dump({"traceEvents":events,"displayTimeUnit":"ms"},f)
+        os.replace(temporary_path,path)
+
+def write_job_trace(job):
+    if job.trace is None or job.work_id is None:
+        return
+    try:
+        job.trace.write(job.trace_path,job.work_id)
+    except Exception as e:
+        print("[ERROR] The trace of the job "+str(job.work_id)+" couldn't be written : "+str(e))
+
+# ────────────────[A barrier closed]───────────────
+# The wait of the barrier, and the gap between the first and the last hub reporting
+def phase_barrier_closed(barrier):
+    now=time.time()
+    metrics.observe("fl_barrier_wait_seconds",now-barrier.opened,phase=barrier.name)
+    if len(barrier.arrivals)>=2:
+        metrics.observe("fl_straggler_gap_seconds",max(barrier.arrivals)-min(barrier.arrivals),phase=barrier.name)
+    phase_recorder.record(barrier.job,"barrier_"+barrier.name.lower(),barrier.opened,now)
+
+# ────────────────[A hub reported to a barrier]───────────────
+def phase_barrier_arrival(barrier,name):
+    now=time.time()
+    barrier.arrivals.append(now)
+    phase=barrier_phases.get(barrier.name)
+    if phase is None:
+        return
+    path=None
+    if phase=="dataset_fetch":
+        record=registry.get(name)
+        path=record.part if record is not None else None
+    elif phase=="model_fetch":
+        path=job_model_path(barrier.job)
+    elif phase=="weight_fetch":
+        path=barrier.job.weight_path
+    size=os.path.getsize(path) if path is not None and os.path.isfile(path) else None
+    phase_recorder.record(barrier.job,phase,barrier.opened,now,name,size)
+
+# ────────────────[Timings given by a hub]───────────────
+# [------------------------------------------------------]
+# 1. READY (see Staging the turn) : the time & bytes of the fetch of the dataset, the model & the weight
+# 2. WAITING FOR WORK : the execution (since LAUNCH THE MODEL), minus the upload of the weight, given by the hub
+# [------------------------------------------------------]
+def record_staged_fetches(job,name,payload_data):
+    now=time.time()
+    for kind in ("dataset","model","weight"):
+        seconds=payload_data.get(kind+"_secs")
+        if seconds is not None:
+            phase_recorder.record(job,kind+"_fetch",now-float(seconds),now,name,int(payload_data.get(kind+"_bytes") or 0))
+
+def record_execution(job,record,payload_data):
+    if record.task_start is None:
+        return
+    now=time.time()
+    upload=float(payload_data.get("upload_secs") or 0)
+    phase_recorder.record(job,"execute",record.task_start,now-upload,record.name)
+    if job.mode_of_execution=="FL":
+        size=payload_data.get("size")
+        phase_recorder.record(job,"upload",now-upload,now,record.name,int(size) if size else None)
+
+# ────────────────[Metrics endpoint]───────────────
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0]!="/metrics":
+            self.send_error(404)
+            return
+        body=metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+def start_metrics_server():
+    if metrics_port<=0:
+        return
+    try:
+        server=ThreadingHTTPServer(("",metrics_port),MetricsHandler)
+    except OSError as e:
+        print("[ERROR] The metrics endpoint couldn't be started on the port "+str(metrics_port)+" : "+str(e))
+        return
+    server.daemon_threads=True
+    Thread(target=server.serve_forever,daemon=True).start()
+
 # ╔══════════════════════════════════════╗
 # ║        15. Handling exceptions       ║
 # ╚══════════════════════════════════════╝
@@ -1228,6 +3371,12 @@ def main():
     verbose=True
     # Function to launch the connexion to the sql database
     connect_sql()
+    # The statuses and the logs still waiting are written before leaving
+    data_consumer.stop()
+    sensor_archive.stop()
+    phase_recorder.stop()
+    status_writer.stop()
+    log_pipeline.stop()
 
 
 if __name__=="__main__":
@@ -0,0 +1,138 @@
+# ╔══════════════════════════════════════╗
+# ║    Tests of the aggregation worker   ║
+# ╚══════════════════════════════════════╝
+# Run with : python3 -m pytest Serveur_Client
+
+import pytest
+
+from aggregation_worker import AggregationUnavailable, AggregationWorker, AggregationWorkerError
+
+MODEL_PROGRAM = '''
+import sys
+
+def mode_initialization(input_dim, output_path):
+    print("init", input_dim)
+    with open(output_path, "w") as f:
+        f.write(str(input_dim))
+
+def mode_aggregation(weights_dir, output_path):
+    if weights_dir == "exit":
+        sys.exit(3)
+    raise RuntimeError("no weight in " + weights_dir)
+'''
+
+@pytest.fixture
+def worker(tmp_path):
+    model_path = tmp_path / "model.py"
+    model_path.write_text(MODEL_PROGRAM)
+    worker = AggregationWorker(model_path)
+    yield worker
+    worker.stop()
+
+# ────────────────[Calls of the modes]───────────────
+def test_init_runs_in_the_worker_and_gives_its_logs(worker, tmp_path):
+    logs = []
+    output_path = tmp_path / "weight.txt"
+    assert worker.call("init", logs.append, input_dim=200, output_path=str(output_path)) == str(output_path)
+    assert output_path.read_text() == "200"
+    assert logs == ["init 200"]
+
+def test_error_and_exit_of_the_model_keep_the_worker_running(worker, tmp_path):
+    with pytest.raises(AggregationWorkerError, match="no weight in"):
+        worker.call("aggregate", weights_dir="results", output_path="unused")
+    with pytest.raises(AggregationWorkerError, match="exited with the code 3"):
+        worker.call("aggregate", weights_dir="exit", output_path="unused")
+    assert worker.alive()
+    output_path = tmp_path / "weight.txt"
+    worker.call("init", input_dim=5, output_path=str(output_path))
+    assert output_path.read_text() == "5"
+
+def test_missing_function_is_unavailable(tmp_path):
+    model_path = tmp_path / "model.py"
+    model_path.write_text("def mode_aggregation(weights_dir, output_path):\n    pass\n")
+    worker = AggregationWorker(model_path)
+    try:
+        with pytest.raises(AggregationUnavailable):
+            worker.call("init", input_dim=1, output_path="unused")
+    finally:
+        worker.stop()
+
+def test_submitted_requests_run_in_order_and_drain_gives_the_errors(worker, tmp_path):
+    paths = [tmp_path / f"weight{i}.txt" for i in range(3)]
+    for i, path in enumerate(paths):
+        # >>> An argument given as a function is computed by the dispatcher, just before sending
+        worker.submit("init", input_dim=lambda i=i: i * 10, output_path=str(path))
+    worker.submit("aggregate", weights_dir="results", output_path="unused")
+    failures = worker.drain()
+    assert [path.read_text() for path in paths] == ["0", "10", "20"]
+    assert len(failures) == 1 and "no weight in" in failures[0]
+    assert worker.drain() == []
+
+def test_import_error_is_given_to_the_caller(tmp_path):
+    model_path = tmp_path / "model.py"
+    model_path.write_text("raise ImportError('missing module')\n")
+    worker = AggregationWorker(model_path)
+    try:
+        with pytest.raises(AggregationWorkerError, match="missing module"):
+            worker.call("init", input_dim=1, output_path="unused")
+    finally:
+        worker.stop()
+
+# ────────────────[Running FedAvg]───────────────
+def test_running_average_is_the_weighted_mean(tmp_path):
+    torch = pytest.importorskip("torch")
+    from aggregation_worker import RunningAverage
+    paths = []
+    for i, (value, count) in enumerate([(1.0, 1), (4.0, 3), (10.0, 6)]):
+        path = tmp_path / f"dataset{i}.pth"
+        torch.save({"layer.weight": torch.full((2, 2), value), "layer.num_batches_tracked": torch.tensor(count)}, path)
+        paths.append((path, count))
+    average = RunningAverage(torch)
+    for path, weight in paths:
+        average.fold(path, weight)
+    output_path = tmp_path / "server_weight.pth"
+    average.finalize(output_path)
+    state_dict = torch.load(output_path)
+    # >>> (1*1 + 4*3 + 10*6) / (1+3+6) = 73/10
+    assert torch.allclose(state_dict["layer.weight"], torch.full((2, 2), 7.3))
+    assert state_dict["layer.weight"].dtype == torch.float32
+    # >>> A counter keeps the value of the first weight
+    assert state_dict["layer.num_batches_tracked"].item() == 1
+    assert average.count == 0 and average.sums is None
+
+def test_running_average_refuses_bad_weights(tmp_path):
+    torch = pytest.importorskip("torch")
+    from aggregation_worker import RunningAverage
+    first, other = tmp_path / "first.pth", tmp_path / "other.pth"
+    torch.save({"a": torch.zeros(1)}, first)
+    torch.save({"b": torch.zeros(1)}, other)
+    average = RunningAverage(torch)
+    with pytest.raises(ValueError):
+        average.finalize(tmp_path / "out.pth")
+    with pytest.raises(ValueError):
+        average.fold(first, 0)
+    average.fold(first, 1)
+    with pytest.raises(ValueError):
+        average.fold(other, 1)
+
+def test_worker_folds_the_weights_as_they_arrive(tmp_path):
+    torch = pytest.importorskip("torch")
+    model_path = tmp_path / "model.py"
+    model_path.write_text("import torch\n")
+    weights = []
+    for i, (value, count) in enumerate([(2.0, 1), (8.0, 3)]):
+        path = tmp_path / f"dataset{i}.pth"
+        torch.save({"w": torch.tensor([value])}, path)
+        weights.append((path, count))
+    worker = AggregationWorker(model_path)
+    try:
+        worker.call("reset")
+        for path, count in weights:
+            worker.submit("fold", path=str(path), weight=lambda count=count: count)
+        assert worker.drain() == []
+        output_path = tmp_path / "server_weight.pth"
+        assert worker.call("finalize", output_path=str(output_path)) == 2
+        # >>> (2*1 + 8*3) / 4 = 6.5
+        assert torch.load(output_path)["w"].item() == pytest.approx(6.5)
+    finally:
+        worker.stop()
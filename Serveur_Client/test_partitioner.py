@@ -0,0 +1,62 @@
+# ╔══════════════════════════════════════╗
+# ║   Tests of the streaming partitioner ║
+# ╚══════════════════════════════════════╝
+# Run with : python3 -m pytest Serveur_Client
+
+import csv
+import io
+
+import pytest
+
+server = pytest.importorskip("server_main_program")
+
+# The parts of the file, read back with the csv reader
+def read_parts(path, sizes, quoted):
+    header_bytes, bounds = server.locate_parts(path, sizes, quoted)
+    data = path.read_bytes()
+    parts = [list(csv.reader(io.StringIO(data[start:end].decode("utf-8"), newline=""))) for start, end in zip(bounds, bounds[1:])]
+    return header_bytes, bounds, parts
+
+def split_sizes(rows, parts):
+    return [int((i + 1) * rows / parts) - int(i * rows / parts) for i in range(parts)]
+
+def expected_parts(text, sizes):
+    rows = list(csv.reader(io.StringIO(text, newline="")))[1:]
+    parts = []
+    for size in sizes:
+        parts.append(rows[:size])
+        rows = rows[size:]
+    return parts
+
+CASES = {
+    "plain": "a,b\n" + "".join(f"{i},{i * i}\n" for i in range(23)),
+    "crlf": "a,b\r\n" + "".join(f"{i},{i * i}\r\n" for i in range(23)),
+    "no final newline": "a,b\n" + "\n".join(f"{i},{i * i}" for i in range(23)),
+    "quoted": 'a,b\n' + "".join(f'{i},"line {i}\nstill {i}, with a comma"\n' for i in range(23)),
+    "quoted crlf": 'a,b\r\n' + "".join(f'{i},"x""{i}""\r\ny"\r\n' for i in range(23)),
+}
+
+@pytest.mark.parametrize("name", list(CASES))
+@pytest.mark.parametrize("chunk_size", [5, 64, 1 << 20])
+@pytest.mark.parametrize("parts", [1, 3, 7])
+def test_parts_hold_the_rows_in_order(tmp_path, monkeypatch, name, chunk_size, parts):
+    # >>> A small block makes the parts end across the blocks read
+    monkeypatch.setattr(server, "partition_chunk_size", chunk_size)
+    text = CASES[name]
+    path = tmp_path / "dataset.csv"
+    path.write_bytes(text.encode("utf-8"))
+    rows, quoted = server.count_dataset_rows(path)
+    assert rows == 23
+    assert quoted == ('"' in text)
+    sizes = split_sizes(rows, parts)
+    header_bytes, bounds, found = read_parts(path, sizes, quoted)
+    assert header_bytes.decode("utf-8").rstrip("\r\n") == "a,b"
+    assert bounds[-1] == len(text.encode("utf-8"))
+    assert found == expected_parts(text, sizes)
+
+def test_header_without_newline_gets_one(tmp_path):
+    path = tmp_path / "dataset.csv"
+    path.write_bytes(b"a,b")
+    header_bytes, bounds = server.locate_parts(path, [], False)
+    assert header_bytes == b"a,b\n"
+    assert bounds == [3]
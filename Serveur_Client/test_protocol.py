@@ -0,0 +1,96 @@
+# ╔══════════════════════════════════════╗
+# ║        Tests of the message codec    ║
+# ╚══════════════════════════════════════╝
+# Run with : python3 -m pytest Serveur_Client
+
+import re
+from pathlib import Path
+
+import pytest
+
+import protocol
+
+FIELDS = {
+    "id": "3",
+    "part_number": 12,
+    "name": "Dataset.csv",
+    "ratio": 0.25,
+    "ready": True,
+    "key": None,
+    "blob": b"\x00\x01weight",
+    "hubs": ["hub1", "hub2"],
+    "text": "a\0b",
+}
+
+# ────────────────[Binary encoding]───────────────
+def test_binary_round_trip_keeps_the_types():
+    message = protocol.decode(protocol.encode("0", "hub1", "STAGE JOB", FIELDS))
+    assert message.binary
+    assert (message[0], message[1], message[2]) == ("0", "hub1", "STAGE JOB")
+    assert message.fields == FIELDS
+    assert message.get("part_number") == 12
+    assert message.get("missing", "default") == "default"
+
+def test_binary_round_trip_without_fields():
+    message = protocol.decode(protocol.encode("hub1", "0", "READY"))
+    assert (message[0], message[1], message[2], message[3]) == ("hub1", "0", "READY", "")
+    assert message.fields == {}
+
+@pytest.mark.parametrize("fields", [{"id": "3", "name": "Dataset.csv"}, {"job": 42, "part_number": 1}, FIELDS])
+def test_truncated_binary_frame_is_refused(fields):
+    payload = protocol.encode("0", "hub1", "DOWNLOAD DATASETS", fields)
+    for size in range(1, len(payload)):
+        with pytest.raises(protocol.ProtocolError):
+            protocol.decode(payload[:size])
+
+def test_unknown_version_is_refused():
+    payload = bytearray(protocol.encode("0", "hub1", "READY", {"job": 1}))
+    payload[1] = protocol.VERSION + 1
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode(bytes(payload))
+
+def test_nul_in_a_name_is_refused():
+    with pytest.raises(protocol.ProtocolError):
+        protocol.encode("0", "hub\0", "READY")
+
+# ────────────────[Legacy encoding]───────────────
+def test_legacy_round_trip_gives_the_details_as_text():
+    text = protocol.encode("0", "hub1", "DOWNLOAD DATASETS", {"id": 3, "part_number": 12, "name": "Dataset.csv"}, binary=False)
+    assert text == "[0] [hub1] [DOWNLOAD DATASETS] [id:3|part_number:12|name:Dataset.csv]"
+    message = protocol.decode(text.encode())
+    assert not message.binary
+    assert message.fields == {"id": "3", "part_number": "12", "name": "Dataset.csv"}
+    # >>> The old hubs read the details by position
+    assert message[3].split("name:")[1] == "Dataset.csv"
+
+@pytest.mark.parametrize("text", [
+    "[0] [hub1] [HEARTBEAT] []",
+    "[hub1] [0] [WAITING FOR WORK] [size:12|name:dataset1.pth]",
+    "[aa:bb:cc] [0] [Asking for connexion] [CAPACITY:12GO|proto:2|stage:1] trailing",
+    "[0] [hub1] [END OF THE START PROGRAM]",
+])
+def test_legacy_decoding_matches_the_old_regex(text):
+    blocks = re.findall(r"\[(.*?)\]", text)
+    message = protocol.decode_legacy(text)
+    assert list(message) == (blocks + [""])[:4]
+
+def test_legacy_braces_keep_their_brackets():
+    text = "[API] [0] [START] [numberOfTurn:2|{hub1,[a]}|rules:x]"
+    message = protocol.decode(text.encode())
+    assert message.groups == ["hub1,[a]"]
+    assert message.get("numberOfTurn") == "2"
+    assert message.get("rules") == "x"
+
+def test_legacy_first_value_of_a_field_is_kept():
+    message = protocol.decode_legacy("[0] [hub1] [X] [name:a|name:b]")
+    assert message.get("name") == "a"
+
+def test_not_a_message():
+    assert protocol.decode(b"hello") is None
+    assert protocol.decode(b"\xff\xfe") is None
+
+# ────────────────[Copy of the hubs]───────────────
+def test_hub_copy_is_identical():
+    here = Path(__file__).resolve().parent
+    hub_copy = here.parent / "Hub_Client" / "Hub_Client" / "protocol.py"
+    assert hub_copy.read_bytes() == (here / "protocol.py").read_bytes()